@@ -27,6 +27,8 @@ def get_parser() -> argparse.ArgumentParser:
     parser.add_argument('--log', help='specify a custom log file path')
     parser.add_argument('--retry', action='store_true',
                         help='enable checking for already-merged files')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='recheck all replicas instead of reusing results from previous runs')
 
     in_group = parser.add_argument_group('input arguments')
     in_group.add_argument('input_mode', nargs='?', default=None, metavar='MODE',
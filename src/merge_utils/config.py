@@ -9,8 +9,9 @@ import fnmatch
 from datetime import datetime, timezone
 from typing import Any, Optional
 
-from merge_utils import io_utils, __version__
+from merge_utils import io_utils, config_keys, __version__
 from merge_utils.config_keys import ConfigKey, ConfigDict, ConfigMap, ConfigList, type_defs, key_defs
+from merge_utils.config_keys import FrozenDict
 
 logger = logging.getLogger(__name__)
 
@@ -22,10 +23,25 @@ OList = Optional[list]
 
 # Configuration dictionary
 cfg_dict = ConfigDict()
+# Frozen snapshot of the configuration, and the config revision it was taken at
+_frozen = {'revision': -1, 'cfg': None}
 
 def __getattr__(name: str) -> Any:
     return cfg_dict.__getattr__(name)
 
+def frozen() -> FrozenDict:
+    """
+    Get an immutable snapshot of the configuration built from plain Python values
+    (dicts, tuples, frozensets and scalars), for fast lookups in inner loops.
+    The snapshot is rebuilt automatically after any change to the configuration.
+
+    :return: Frozen configuration dictionary
+    """
+    if _frozen['revision'] != config_keys.revision:
+        _frozen['cfg'] = cfg_dict._freeze() # pylint: disable=protected-access
+        _frozen['revision'] = config_keys.revision
+    return _frozen['cfg']
+
 def get_key(name: str) -> ConfigKey:
     """Get a config key by name"""
     if not name:
@@ -78,14 +94,18 @@ def check_cfg_version(ver: str, file_name: str) -> bool:
                       file_name, ver, __version__)
     return False
 
-def update(file_name: str) -> None:
+def update(file_name: str, cached: bool = False) -> None:
     """
     Update the global configuration with values from the provided dictionary.
     
     :param file_name: Name of the configuration file.
+    :param cached: Reuse a previously parsed copy of the file if it has not changed.
     :return: None
     """
-    cfg = io_utils.read_config_file(file_name)
+    if cached:
+        cfg = io_utils.read_cached_config(file_name)
+    else:
+        cfg = io_utils.read_config_file(file_name)
     errors = []
     # Check version compatibility
     ver = cfg.pop('version', None)
@@ -108,12 +128,13 @@ def update(file_name: str) -> None:
                           errors, level=logging.CRITICAL)
         sys.exit(1)
 
-def uuid(skip: OInt = None, limit: OInt = None, chunk: OList = None) -> str:
+def uuid(skip: OInt = None, limit: OInt = None, chunk: OList = None, group: OInt = None) -> str:
     """Generate a unique identifier based on the job tag and timestamp.
     
     :param skip: Number of initial entries to skip.
     :param limit: Maximum number of entries to process.
     :param chunk: Optional chunk id list to include in the UUID.
+    :param group: Optional locality group number to include in the UUID.
     :return: Unique identifier string.
     """
     timestamp = cfg_dict.job.timestamp
@@ -127,6 +148,8 @@ def uuid(skip: OInt = None, limit: OInt = None, chunk: OList = None) -> str:
     out = f"{timestamp}"
     if chunk:
         out = f"c{'-'.join(map(str, chunk))}_{out}"
+    if group is not None:
+        out = f"g{group:0{pad}d}_{out}"
     if limit:
         out = f"l{limit:0{pad}d}_{out}"
     if skip:
@@ -235,6 +258,29 @@ def custom_serializer(obj):
         return obj._json() # pylint: disable=protected-access
     raise TypeError(f"Object of type {obj.__class__.__name__} is not JSON serializable")
 
+def export() -> dict:
+    """
+    Export the current configuration as a JSON-serializable dictionary.
+
+    :return: Dictionary of configuration settings
+    """
+    return json.loads(json.dumps(cfg_dict, default=custom_serializer))
+
+def restore(data: dict) -> None:
+    """
+    Restore a configuration exported by another process (e.g. in a worker process).
+
+    :param data: Dictionary of configuration settings from export()
+    :return: None
+    """
+    if not cfg_dict._locked: # pylint: disable=protected-access
+        load_defaults()
+    cfg_dict._clear() # pylint: disable=protected-access
+    errors = cfg_dict._update(data) # pylint: disable=protected-access
+    if errors:
+        io_utils.log_list("Failed to restore configuration:", errors, level=logging.CRITICAL)
+        sys.exit(1)
+
 def dump() -> None:
     """
     Dump the current configuration to the tmp directory or stdout.
@@ -272,6 +318,19 @@ def override(args: dict, arg: str, option: ConfigKey, name: OStr = None) -> OStr
         return None
     return str(option)
 
+def set_cache_opts(args: dict) -> None:
+    """
+    Disable the replica cache if requested on the command line.
+
+    :param args: Dictionary of command-line arguments.
+    :return: None
+    """
+    if args.pop("no_cache", False):
+        logger.info("Overriding replica cache: disabled")
+        ttls = cfg_dict.validation.cache_ttl
+        for key in ttls.keys():
+            ttls[key] = 0.0
+
 def set_cmd_opts(args: dict) -> None:
     """
     Override configuration settings with command-line arguments.
@@ -322,11 +381,27 @@ def set_cmd_opts(args: dict) -> None:
         logger.warning("Already-done checking is disabled without a job tag specified!")
         cfg_dict.validation.handling.already_done = 'include'
 
+    # Replica cache
+    set_cache_opts(args)
+
     # Output settings
     override(args, "name", cfg_dict.output.name, "output name")
     override(args, "namespace", cfg_dict.output.namespace, "output namespace")
     override(args, "method", cfg_dict.method.method_name, "merge method")
 
+def load_defaults() -> None:
+    """
+    Load the default configuration files and lock the config schema.
+
+    :return: None
+    """
+    defaults_dir = os.path.join(io_utils.pkg_dir(), 'config', 'defaults')
+    for cfg_file in os.listdir(defaults_dir):
+        path = os.path.join(defaults_dir, cfg_file)
+        if os.path.isfile(path):
+            update(path, cached=True)
+    cfg_dict._lock()  # pylint: disable=protected-access
+
 def load(args: Optional[dict] = None) -> None:
     """
     Load the specified configuration files.
@@ -337,12 +412,7 @@ def load(args: Optional[dict] = None) -> None:
     """
     io_utils.log_print("Loading configuration...")
     # Load default configuration files first
-    defaults_dir = os.path.join(io_utils.pkg_dir(), 'config', 'defaults')
-    for cfg_file in os.listdir(defaults_dir):
-        path = os.path.join(defaults_dir, cfg_file)
-        if os.path.isfile(path):
-            update(path)
-    cfg_dict._lock()  # pylint: disable=protected-access
+    load_defaults()
     logger.info("Loaded default configuration files.")
 
     if args is None:
@@ -391,3 +461,4 @@ def resume(job_dir: str, args: dict) -> None:
     local = override(args, "local", cfg_dict.output.local)
     if local and out_mode in ['validate', 'dids']:
         logger.warning("Option --local has no effect in output mode '%s'", out_mode)
+    set_cache_opts(args)
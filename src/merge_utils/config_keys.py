@@ -4,13 +4,52 @@ from __future__ import annotations
 import logging
 import operator
 from abc import ABC, abstractmethod
-from typing import Any
+from typing import Any, NamedTuple
 
 logger = logging.getLogger(__name__)
 
 type_defs = {}
 key_defs = {}
 string_keys = set()
+revision = 0 # Incremented whenever any config value changes
+
+class FrozenDict(dict):
+    """Immutable dictionary with attribute access, used for frozen config snapshots"""
+    __slots__ = ()
+
+    def __getattr__(self, key):
+        try:
+            return self[key]
+        except KeyError as err:
+            raise AttributeError(f"Frozen config has no member named '{key}'") from err
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("Frozen config snapshots cannot be modified")
+
+    __setitem__ = __delitem__ = __setattr__ = __delattr__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+class SizeSpec(NamedTuple):
+    """Frozen size prediction specification, with coefficients for (s,n,a,b)"""
+    s: float = 0
+    n: float = 0
+    a: float = 0
+    b: float = 0
+
+    def __bool__(self):
+        return any(coeff != 0 for coeff in self)
+
+    def __call__(self, sizes: list) -> float:
+        """Evaluate the size spec for a given list of input sizes"""
+        return self.evaluate(sum(sizes), len(sizes))
+
+    def evaluate(self, s: float, n: int) -> float:
+        """Evaluate the size spec from the total size and number of the inputs"""
+        a = s/n if n > 0 else 0
+        return self.s*s + self.n*n + self.a*a + self.b
 
 class ConfigKey(ABC):
     """Base class for configuration keys"""
@@ -41,6 +80,8 @@ class ConfigKey(ABC):
 
     def _update(self, value) -> list:
         """Recursively update the config tree and return any errors"""
+        global revision # pylint: disable=global-statement
+        revision += 1
         val_type, _, val = parse_type(value)
         if val_type is None:
             self._clear()
@@ -73,6 +114,10 @@ class ConfigKey(ABC):
         """Return a JSON-serializable representation of the config key"""
         return self._value
 
+    def _freeze(self):
+        """Return an immutable plain Python copy of the config value"""
+        return self._value
+
     def __str__(self):
         return str(self._value)
 
@@ -497,6 +542,9 @@ class ConfigSizeSpec(ConfigKey):
         """Return a JSON-serializable representation of the config key"""
         return str(self)
 
+    def _freeze(self):
+        return SizeSpec(*self._value) if self._value else SizeSpec()
+
 class ConfigTuple(ConfigValue):
     """Class to manage a configuration tuple"""
     _type: str = 'tuple'
@@ -521,6 +569,9 @@ class ConfigTuple(ConfigValue):
             self._value[idx] = value[idx] if idx < len(value) else default
         return []
 
+    def _freeze(self):
+        return tuple(self._value) if self._value is not None else None
+
 class ConfigCollection(ConfigKey):
     """Base class for configuration collections"""
 
@@ -578,6 +629,9 @@ class ConfigSet(ConfigCollection):
     def _json(self):
         return list(self._value)
 
+    def _freeze(self):
+        return frozenset(self._value)
+
     def __getitem__(self, key):
         raise AttributeError("ConfigSet does not support indexing")
 
@@ -585,6 +639,8 @@ class ConfigSet(ConfigCollection):
         raise AttributeError("ConfigSet does not support indexing")
 
     def __ior__(self, other):
+        global revision # pylint: disable=global-statement
+        revision += 1
         if isinstance(other, ConfigSet):
             self._value |= other._value
         elif isinstance(other, (set, list)):
@@ -671,12 +727,19 @@ class ConfigMap(ConfigCollection):
     def _json(self):
         return {key: val._json() for key, val in self._value.items()} # pylint: disable=protected-access
 
+    def _freeze(self):
+        return FrozenDict(
+            (key, val._freeze()) for key, val in self._value.items() # pylint: disable=protected-access
+        )
+
     def __getitem__(self, key):
         return self._value[key]
 
     def __setitem__(self, key, value):
         if value is None and key not in self._required:
             if key in self._value:
+                global revision # pylint: disable=global-statement
+                revision += 1
                 del self._value[key]
             return
         self._value[key]._set(value) # pylint: disable=protected-access
@@ -738,6 +801,9 @@ class ConfigList(ConfigCollection):
             self._value.append(new_key)
         return errors
 
+    def _freeze(self):
+        return tuple(val._freeze() for val in self._value) # pylint: disable=protected-access
+
     def __getitem__(self, idx):
         return self._value[idx]
 
@@ -766,6 +832,56 @@ class ConfigList(ConfigCollection):
             err_str = '\n  '.join(errs)
             raise TypeError(self._err(f"Failed to extend:\n  {err_str}"))
 
+class ConfigStrList(ConfigCollection):
+    """
+    Class to manage a plain list of strings, e.g. for very long input lists.
+    Unlike a ConfigList, entries are stored as native strings instead of individual
+    ConfigString keys, so they are never name-formatted.
+    """
+    _type: str = 'str_list'
+    _conversions: set = {'list'}
+
+    def __init__(self, name: str, val_type = None):
+        super().__init__(name, 'str')
+        self._value = []
+
+    def _clear(self) -> None:
+        self._value = []
+
+    def _do_update(self, value) -> list:
+        self._value.extend(str(item) for item in value)
+        return []
+
+    def _json(self):
+        return list(self._value)
+
+    def _freeze(self):
+        return tuple(self._value)
+
+    def __getitem__(self, idx):
+        return self._value[idx]
+
+    def __setitem__(self, idx, value):
+        global revision # pylint: disable=global-statement
+        revision += 1
+        self._value[idx] = str(value)
+
+    def append(self, item) -> None:
+        """Append a new string to the list"""
+        if item is None:
+            return
+        global revision # pylint: disable=global-statement
+        revision += 1
+        self._value.append(str(item))
+
+    def extend(self, items: list) -> None:
+        """Extend the list with new strings"""
+        if items is None:
+            return
+        global revision # pylint: disable=global-statement
+        revision += 1
+        self._value.extend(str(item) for item in items)
+
 class ConfigDict(ConfigKey):
     """Class to manage a configuration dictionary"""
     _type: str = 'dict'
@@ -827,6 +943,11 @@ class ConfigDict(ConfigKey):
     def _json(self):
         return {key: val._json() for key, val in self._value.items()} # pylint: disable=protected-access
 
+    def _freeze(self):
+        return FrozenDict(
+            (key, val._freeze()) for key, val in self._value.items() # pylint: disable=protected-access
+        )
+
     def items(self):
         """Get the items in the config dict"""
         return self._value.items()
@@ -934,6 +1055,7 @@ CONFIG_CLASSES = {
     'set': ConfigSet,
     'map': ConfigMap,
     'list': ConfigList,
+    'str_list': ConfigStrList,
     'dict': ConfigDict
 }
 
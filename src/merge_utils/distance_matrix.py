@@ -0,0 +1,220 @@
+"""Matrix of distances from input files to merging sites, used for scheduling."""
+from __future__ import annotations
+
+import logging
+import collections
+
+from merge_utils.merge_set import MergeFile
+from merge_utils.replicas import Status
+
+logger = logging.getLogger(__name__)
+
+# NumPy is optional, the matrix falls back to lists of rows without it
+np = None # pylint: disable=invalid-name
+HAS_NUMPY = None
+
+INF = float('inf')
+
+def import_numpy() -> bool:
+    """
+    Import NumPy on first use.
+
+    :return: True if NumPy is available
+    """
+    global np, HAS_NUMPY # pylint: disable=global-statement
+    if HAS_NUMPY is None:
+        try:
+            import numpy as np #type: ignore pylint: disable=import-error,import-outside-toplevel,redefined-outer-name
+            HAS_NUMPY = True
+        except ImportError:
+            logger.info("NumPy not found, using pure python distance matrix")
+            HAS_NUMPY = False
+    return HAS_NUMPY
+
+class DistanceMatrix:
+    """
+    Minimum distance from each input file to each merging site, over the file's good replicas.
+    The matrix is built once after all replicas are resolved, so that chunk distances and
+    best-site assignments are reductions over rows instead of rebuilding per-file dictionaries.
+    """
+
+    def __init__(self, files: list[MergeFile], distances: dict):
+        """
+        Build the distance matrix.
+
+        :param files: list of MergeFile objects with resolved replicas
+        :param distances: dictionary of {RSE name: {site: distance}}
+        """
+        self.sites = list(dict.fromkeys(site for dists in distances.values() for site in dists))
+        self.rows = {file.did: row for row, file in enumerate(files)}
+        rses = {rse: idx for idx, rse in enumerate(distances)}
+        # Flatten the good replicas into (file row, RSE index, replica distance) triplets
+        good = {status for status in Status if status.good}
+        replica_rows, replica_rses, replica_dists = [], [], []
+        for row, file in enumerate(files):
+            for replica in file.replicas:
+                if replica.status in good and replica.rse.name in rses:
+                    replica_rows.append(row)
+                    replica_rses.append(rses[replica.rse.name])
+                    replica_dists.append(replica.distance)
+        rse_dists = [[dists.get(site, INF) for site in self.sites] for dists in distances.values()]
+        if import_numpy():
+            self.data = np.full((len(files), len(self.sites)), INF)
+            if replica_rows:
+                rse_dists = np.array(rse_dists, dtype=float).reshape(len(rses), len(self.sites))
+                values = rse_dists[replica_rses] + np.array(replica_dists, dtype=float)[:, None]
+                # Replicas are grouped by file, so scatter them into a (file, replica, site)
+                # array padded with inf and take the minimum over each file's replicas
+                replica_rows = np.array(replica_rows)
+                starts = np.flatnonzero(np.diff(replica_rows, prepend=-1))
+                counts = np.diff(starts, append=len(replica_rows))
+                positions = np.arange(len(replica_rows)) - np.repeat(starts, counts)
+                padded = np.full((len(files), counts.max(), len(self.sites)), INF)
+                padded[replica_rows, positions] = values
+                self.data = padded.min(axis=1)
+        else:
+            self.data = [[INF] * len(self.sites) for _ in files]
+            for row, rse, dist in zip(replica_rows, replica_rses, replica_dists):
+                self.data[row] = [min(old, new + dist)
+                                  for old, new in zip(self.data[row], rse_dists[rse])]
+        logger.debug("Built %d x %d file-site distance matrix", len(files), len(self.sites))
+
+    def indices(self, files: list[MergeFile]) -> list[int]:
+        """
+        Get the matrix rows for a list of files.
+
+        :param files: list of MergeFile objects
+        :return: list of row indices
+        """
+        return [self.rows[file.did] for file in files]
+
+    def file(self, file: MergeFile) -> dict:
+        """
+        Get the distances from a file to the merging sites.
+
+        :param file: MergeFile object to get distances for
+        :return: dictionary of {site: distance}
+        """
+        row = self.data[self.rows[file.did]]
+        if min(row, default=INF) == INF:
+            raise RuntimeError(f"File {file.did} has no available replicas")
+        return dict(zip(self.sites, (float(dist) for dist in row)))
+
+    def chunk(self, files: list[MergeFile]) -> dict:
+        """
+        Get the total distances from a group of files to the merging sites.
+        If any file is unreachable from a site, the group is also unreachable from that site.
+
+        :param files: list of MergeFile objects
+        :return: dictionary of {site: total distance}
+        """
+        rows = self.indices(files)
+        if HAS_NUMPY:
+            totals = self.data[rows].sum(axis=0)
+        else:
+            totals = [sum(col) for col in zip(*(self.data[row] for row in rows))]
+        return dict(zip(self.sites, (float(dist) for dist in totals)))
+
+    def best_sites(self, files: list[MergeFile]) -> list:
+        """
+        Get the nearest merging site for each of a list of files.
+
+        :param files: list of MergeFile objects
+        :return: list of site names, in the same order as the files
+        """
+        rows = self.indices(files)
+        if HAS_NUMPY:
+            best = self.data[rows].argmin(axis=1)
+        else:
+            best = [min(range(len(self.sites)), key=self.data[row].__getitem__) for row in rows]
+        return [self.sites[idx] for idx in best]
+
+    def assign(self, files: list[MergeFile], capacity: dict) -> list:
+        """
+        Assign files to merging sites with the minimum total distance, without exceeding
+        the capacity of any site. Files with identical distance rows are solved together,
+        so the flow problem only grows with the number of distinct replica layouts.
+
+        :param files: list of MergeFile objects
+        :param capacity: dictionary of {site: maximum number of files}, missing sites are unlimited
+        :return: list of site names in the same order as the files, or None for files
+                 that could not be placed within the site capacities
+        """
+        classes = collections.defaultdict(list)
+        for idx, row in enumerate(self.indices(files)):
+            classes[tuple(float(dist) for dist in self.data[row])].append(idx)
+        costs = list(classes)
+        limits = [capacity.get(site) for site in self.sites]
+        flows = min_cost_flow([len(members) for members in classes.values()], limits, costs)
+        sites = [None] * len(files)
+        for members, flow in zip(classes.values(), flows):
+            members = iter(members)
+            for site, count in zip(self.sites, flow):
+                for _ in range(count):
+                    sites[next(members)] = site
+        return sites
+
+def min_cost_flow(supply: list[int], capacity: list[int], costs: list[list[float]]) -> list[list[int]]:
+    """
+    Solve a transportation problem with successive shortest paths, sending as much supply
+    as possible to the sinks at the minimum total cost. Costs may be negative.
+
+    :param supply: number of units available from each source
+    :param capacity: maximum number of units for each sink, or None for no limit
+    :param costs: matrix of costs per unit from each source to each sink, inf if not allowed
+    :return: matrix of the number of units sent from each source to each sink
+    """
+    n_src, n_sink = len(supply), len(capacity)
+    total = sum(supply)
+    # Nodes are the start, sources, sinks, and end
+    start, end = 0, n_src + n_sink + 1
+    graph = [[] for _ in range(end + 1)] # [target, capacity, cost, reverse edge index]
+    def add_edge(node1, node2, cap, cost):
+        graph[node1].append([node2, cap, cost, len(graph[node2])])
+        graph[node2].append([node1, 0, -cost, len(graph[node1]) - 1])
+    for src, units in enumerate(supply):
+        add_edge(start, 1 + src, units, 0)
+        for sink, cost in enumerate(costs[src]):
+            if cost != INF:
+                add_edge(1 + src, 1 + n_src + sink, units, cost)
+    for sink, cap in enumerate(capacity):
+        add_edge(1 + n_src + sink, end, total if cap is None else min(cap, total), 0)
+    while True:
+        # Find the cheapest path with free capacity (SPFA handles the negative costs)
+        dist = [INF] * len(graph)
+        prev = [None] * len(graph)
+        queued = [False] * len(graph)
+        dist[start] = 0
+        queue = collections.deque([start])
+        while queue:
+            node = queue.popleft()
+            queued[node] = False
+            for idx, (target, cap, cost, _) in enumerate(graph[node]):
+                if cap > 0 and dist[node] + cost < dist[target]:
+                    dist[target] = dist[node] + cost
+                    prev[target] = (node, idx)
+                    if not queued[target]:
+                        queued[target] = True
+                        queue.append(target)
+        if dist[end] == INF:
+            break
+        # Send as much as possible along the path
+        units = total
+        node = end
+        while node != start:
+            parent, idx = prev[node]
+            units = min(units, graph[parent][idx][1])
+            node = parent
+        node = end
+        while node != start:
+            parent, idx = prev[node]
+            edge = graph[parent][idx]
+            edge[1] -= units
+            graph[node][edge[3]][1] += units
+            node = parent
+    flows = [[0] * n_sink for _ in range(n_src)]
+    for src in range(n_src):
+        for target, cap, cost, rev in graph[1 + src]:
+            if n_src < target <= n_src + n_sink and cost != INF:
+                flows[src][target - n_src - 1] = graph[target][rev][1]
+    return flows
@@ -0,0 +1,350 @@
+"""Scheduling of work across storage endpoints, with per-RSE and per-host limits and health tracking."""
+from __future__ import annotations
+
+import math
+import time
+import logging
+import asyncio
+import collections
+
+from merge_utils import config
+
+logger = logging.getLogger(__name__)
+
+# Circuit breaker states
+CLOSED = 'closed'       # Endpoint is healthy, all requests go through
+OPEN = 'open'           # Endpoint is failing, requests are skipped
+HALF_OPEN = 'half-open' # Endpoint is being re-tested with a few sample requests
+
+class EndpointQueue:
+    """
+    Work queue that interleaves items for different storage endpoints in round-robin
+    order, and only hands out items for an endpoint while its RSE and host are below
+    their concurrency limits. A slow endpoint can then only hold up its own items.
+    """
+
+    def __init__(self, rse_limit: int = 0, host_limit: int = 0):
+        """
+        Initialize the EndpointQueue.
+
+        :param rse_limit: maximum number of active items per RSE (0 for no limit)
+        :param host_limit: maximum number of active items per host (0 for no limit)
+        """
+        self.rse_limit = rse_limit
+        self.host_limit = host_limit
+        self.queues = {}
+        self.order = collections.deque()
+        self.active_rses = collections.Counter()
+        self.active_hosts = collections.Counter()
+        self.unfinished = 0
+        self.closed = False
+        self.cond = asyncio.Condition()
+        self.finished = asyncio.Event()
+        self.finished.set()
+
+    def __len__(self) -> int:
+        """Return the number of items waiting in the queue"""
+        return sum(len(queue) for queue in self.queues.values())
+
+    def available(self, key: tuple[str, str]) -> bool:
+        """
+        Check if an endpoint is below its concurrency limits.
+
+        :param key: tuple of (RSE name, host name)
+        :return: True if another item for this endpoint can be started
+        """
+        rse, host = key
+        if self.rse_limit and self.active_rses[rse] >= self.rse_limit:
+            return False
+        if self.host_limit and self.active_hosts[host] >= self.host_limit:
+            return False
+        return True
+
+    async def put(self, key: tuple[str, str], item) -> None:
+        """
+        Add an item to the queue for an endpoint.
+
+        :param key: tuple of (RSE name, host name)
+        :param item: item to process
+        """
+        async with self.cond:
+            if key not in self.queues:
+                self.queues[key] = collections.deque()
+                self.order.append(key)
+            self.queues[key].append(item)
+            self.unfinished += 1
+            self.finished.clear()
+            self.cond.notify()
+
+    async def get(self) -> tuple:
+        """
+        Wait for the next item from an endpoint with free capacity.
+        The caller must call done() with the returned key once the item is processed.
+
+        :return: tuple of (key, item), or None if the queue was closed and is empty
+        """
+        async with self.cond:
+            while True:
+                for _ in range(len(self.order)):
+                    key = self.order[0]
+                    self.order.rotate(-1)
+                    if not self.available(key):
+                        continue
+                    queue = self.queues[key]
+                    item = queue.popleft()
+                    if not queue:
+                        del self.queues[key]
+                        self.order.remove(key)
+                    self.active_rses[key[0]] += 1
+                    self.active_hosts[key[1]] += 1
+                    return key, item
+                if self.closed and not self.order:
+                    return None
+                await self.cond.wait()
+
+    async def done(self, key: tuple[str, str]) -> None:
+        """
+        Mark an item as processed and free its endpoint slots.
+
+        :param key: key returned by get()
+        """
+        async with self.cond:
+            self.active_rses[key[0]] -= 1
+            self.active_hosts[key[1]] -= 1
+            self.unfinished -= 1
+            if self.unfinished == 0:
+                self.finished.set()
+            self.cond.notify_all()
+
+    async def join(self) -> None:
+        """Wait until every item in the queue has been processed"""
+        await self.finished.wait()
+
+    async def close(self) -> None:
+        """Stop handing out items once the queue is empty, releasing any waiting workers"""
+        async with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+class EndpointError(Exception):
+    """Error raised when a storage endpoint does not respond, as opposed to a per-file error"""
+
+class EndpointHealth:
+    """Outcomes of recent requests to a storage endpoint, with a circuit breaker"""
+
+    def __init__(self, window: int = 100):
+        """
+        Initialize the EndpointHealth.
+
+        :param window: number of recent requests to keep statistics for
+        """
+        self.samples = collections.deque(maxlen=window) # (success, latency in ms)
+        self.requests = 0
+        self.failures = 0
+        self.state = CLOSED
+        self.opened = 0.0
+        self.probing = 0
+        self.probed = 0
+
+    @property
+    def success_rate(self) -> float:
+        """Fraction of recent requests that succeeded, or None if there are no samples"""
+        if not self.samples:
+            return None
+        return sum(ok for ok, _ in self.samples) / len(self.samples)
+
+    def percentile(self, fraction: float) -> float:
+        """
+        Get a percentile of the recent request latencies.
+
+        :param fraction: percentile as a fraction, e.g. 0.99 for the p99
+        :return: latency in ms, or None if there are no samples
+        """
+        latencies = sorted(latency for _, latency in self.samples if latency is not None)
+        if not latencies:
+            return None
+        return latencies[max(0, math.ceil(fraction * len(latencies)) - 1)]
+
+    def allow(self, cooldown: float, probes: int) -> bool:
+        """
+        Check if a request may be sent to the endpoint.
+        An open circuit lets a few probe requests through once the cooldown has passed.
+
+        :param cooldown: time in seconds before re-testing an open circuit
+        :param probes: number of successful probe requests needed to close the circuit
+        :return: True if the request should be sent
+        """
+        if self.state == OPEN:
+            if time.monotonic() - self.opened < cooldown:
+                return False
+            self.state = HALF_OPEN
+            self.probing = 0
+            self.probed = 0
+        if self.state == HALF_OPEN:
+            if self.probing >= probes:
+                return False
+            self.probing += 1
+        return True
+
+    def record(self, success: bool, latency: float) -> None:
+        """
+        Record the outcome of a request.
+
+        :param success: True if the endpoint responded
+        :param latency: time taken by the request in ms
+        """
+        self.samples.append((success, latency))
+        self.requests += 1
+        self.failures += not success
+
+    def update(self, success: bool, cfg) -> bool:
+        """
+        Update the circuit state after recording a request.
+
+        :param success: True if the endpoint responded
+        :param cfg: frozen validation.health config section
+        :return: True if this request opened the circuit
+        """
+        if self.state == HALF_OPEN:
+            self.probing = max(0, self.probing - 1)
+            if not success:
+                self.state = OPEN
+                self.opened = time.monotonic()
+                return False
+            self.probed += 1
+            if self.probed >= cfg.probes:
+                # Start with a clean slate so old failures don't reopen the circuit
+                self.state = CLOSED
+                self.samples.clear()
+            return False
+        if self.state == CLOSED and not success and len(self.samples) >= cfg.min_requests:
+            if 1 - self.success_rate >= cfg.failure_rate:
+                self.state = OPEN
+                self.opened = time.monotonic()
+                return True
+        return False
+
+class HealthMonitor:
+    """
+    Tracks the success rate and latency of storage requests for each RSE and host.
+    Timeouts adapt to the observed latency of each host, and a circuit breaker for each
+    (RSE, host) endpoint skips requests to endpoints that are failing hard.
+    """
+
+    def __init__(self):
+        """Initialize the HealthMonitor"""
+        self.endpoints = {}
+        self.rses = {}
+        self.hosts = {}
+
+    @staticmethod
+    def get(stats: dict, name) -> EndpointHealth:
+        """
+        Get the health record for a name, creating it if necessary.
+
+        :param stats: dictionary of health records
+        :param name: RSE name, host name, or (RSE, host) key
+        :return: EndpointHealth object
+        """
+        if name not in stats:
+            stats[name] = EndpointHealth(int(config.frozen().validation.health.window or 1))
+        return stats[name]
+
+    def is_open(self, key: tuple[str, str]) -> bool:
+        """
+        Check if the circuit for an endpoint is open.
+
+        :param key: tuple of (RSE name, host name)
+        :return: True if requests to the endpoint are currently being skipped
+        """
+        health = self.endpoints.get(key)
+        return health is not None and health.state != CLOSED
+
+    def state(self, key: tuple[str, str]) -> str:
+        """
+        Get the circuit breaker state of an endpoint.
+
+        :param key: tuple of (RSE name, host name)
+        :return: one of CLOSED, OPEN or HALF_OPEN
+        """
+        health = self.endpoints.get(key)
+        return CLOSED if health is None else health.state
+
+    def retry_in(self, key: tuple[str, str]) -> float:
+        """
+        Get how long to wait before a skipped request to an endpoint is worth retrying.
+        An open circuit is re-tested after its cooldown, and a half-open circuit once
+        its probe requests have had time to finish.
+
+        :param key: tuple of (RSE name, host name)
+        :return: time to wait in seconds
+        """
+        health = self.endpoints.get(key)
+        if health is None or health.state == CLOSED:
+            return 0.0
+        if health.state == HALF_OPEN:
+            return self.timeout(key)
+        cooldown = float(config.frozen().validation.health.cooldown or 0)
+        return max(0.0, health.opened + cooldown - time.monotonic())
+
+    def allow(self, key: tuple[str, str]) -> bool:
+        """
+        Check if a request may be sent to an endpoint.
+        Every allowed request must be followed by a call to record().
+
+        :param key: tuple of (RSE name, host name)
+        :return: True if the request should be sent
+        """
+        cfg = config.frozen().validation.health
+        if not cfg.enabled:
+            return True
+        return self.get(self.endpoints, key).allow(float(cfg.cooldown or 0), int(cfg.probes or 1))
+
+    def timeout(self, key: tuple[str, str]) -> float:
+        """
+        Get the timeout for a request to an endpoint, based on the p99 latency of its host.
+
+        :param key: tuple of (RSE name, host name)
+        :return: timeout in seconds
+        """
+        cfg = config.frozen().validation.health
+        health = self.hosts.get(key[1])
+        if not cfg.enabled or health is None or len(health.samples) < cfg.min_requests:
+            return float(cfg.timeout)
+        p99 = health.percentile(0.99)
+        if p99 is None:
+            return float(cfg.timeout)
+        return min(max(cfg.timeout_factor * p99 / 1000, cfg.min_timeout), cfg.max_timeout)
+
+    def record(self, key: tuple[str, str], success: bool, latency: float) -> None:
+        """
+        Record the outcome of a request to an endpoint.
+
+        :param key: tuple of (RSE name, host name)
+        :param success: True if the endpoint responded
+        :param latency: time taken by the request in ms
+        """
+        cfg = config.frozen().validation.health
+        if not cfg.enabled:
+            return
+        self.get(self.rses, key[0]).record(success, latency)
+        self.get(self.hosts, key[1]).record(success, latency)
+        health = self.get(self.endpoints, key)
+        health.record(success, latency)
+        if health.update(success, cfg):
+            logger.warning("Skipping replicas on RSE %s at %s for %.0f s after %.0f%% of checks"
+                           " failed", key[0], key[1], cfg.cooldown,
+                           100 * (1 - health.success_rate))
+
+    def summary(self) -> None:
+        """Log the success rate and latency percentiles of each RSE and host"""
+        for kind, stats in (("RSE", self.rses), ("host", self.hosts)):
+            for name, health in sorted(stats.items()):
+                if not health.samples:
+                    continue
+                p50, p99 = health.percentile(0.5), health.percentile(0.99)
+                logger.info("%s %s: %d checks, %d failed, p50 = %.0f ms, p99 = %.0f ms",
+                            kind, name, health.requests, health.failures, p50 or 0, p99 or 0)
+
+# Shared health records for all RSEs
+health = HealthMonitor()
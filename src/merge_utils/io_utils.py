@@ -7,6 +7,11 @@ import logging.config
 import json
 import pathlib
 import math
+import hashlib
+import importlib.util
+import signal
+import asyncio
+import subprocess
 from collections.abc import Iterable
 
 # tomllib was added to the standard library in Python 3.10, need tomli for DUNE
@@ -15,10 +20,14 @@ try:
 except ImportError:
     import tomli as tomllib # type: ignore
 
-import yaml # type: ignore pylint: disable=import-error
-
 logger = logging.getLogger(__name__)
 
+# Paths of configuration files that have already been located
+cfg_paths = {}
+
+# Helper modules loaded from the runner scripts directory
+runner_modules = {}
+
 def pkg_dir() -> str:
     """Get the base directory of the package"""
     directory = os.environ.get('MERGE_UTILS_DIR')
@@ -26,6 +35,17 @@ def pkg_dir() -> str:
         return directory
     return os.path.dirname(os.path.dirname(os.path.dirname(__file__)))
 
+def cache_dir() -> str:
+    """
+    Get the directory for data cached between jobs. This is $MERGE_UTILS_CACHE if set,
+    otherwise merge-utils in the user's cache directory ($XDG_CACHE_HOME or ~/.cache).
+    """
+    directory = os.environ.get('MERGE_UTILS_CACHE')
+    if directory:
+        return directory
+    base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'merge-utils')
+
 def src_dir() -> str:
     """Get the source directory of the package"""
     return os.path.join(pkg_dir(), 'src', 'merge_utils')
@@ -103,7 +123,12 @@ def find_cfg(name: str) -> str:
     :return: Full path to the configuration file
     :raises FileNotFoundError: If the file does not exist
     """
-    return find_file(name, [os.path.join(pkg_dir(), "config")], recursive=True)
+    name = str(name)
+    path = cfg_paths.get(name)
+    if path is None or not os.path.exists(path):
+        path = find_file(name, [os.path.join(pkg_dir(), "config")], recursive=True)
+        cfg_paths[name] = path
+    return path
 
 def find_runner(name: str) -> str:
     """
@@ -153,13 +178,118 @@ def read_config_file(name: str = None) -> dict:
         with open(path, mode="rb") as f:
             cfg = tomllib.load(f)
     elif suffix in [".yaml", ".yml"]:
+        import yaml # type: ignore pylint: disable=import-error,import-outside-toplevel
+        loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
         with open(path, encoding="utf-8") as f:
-            cfg = yaml.safe_load(f)
+            cfg = yaml.load(f, Loader=loader)
     else:
         logger.error("Unknown file type: %s", suffix)
         raise ValueError(f"Unknown file type: {suffix}")
     return cfg
 
+def read_cached_config(name: str) -> dict:
+    """
+    Read a configuration file, reusing a JSON copy of the parsed contents
+    from the cache directory if the file has not been modified since.
+
+    :param name: Name of the configuration file
+    :return: Dictionary containing the configuration settings
+    """
+    path = find_cfg(name)
+    stat = os.stat(path)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    digest = hashlib.sha1(path.encode('utf-8')).hexdigest()
+    cache = os.path.join(cache_dir(), 'config', f"{digest}.json")
+    try:
+        with open(cache, encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached['path'] == path and cached['stamp'] == stamp:
+            logger.debug("Using cached copy of config file %s", path)
+            return cached['config']
+    except (OSError, ValueError, TypeError, KeyError):
+        pass
+    cfg = read_config_file(path)
+    try:
+        # Files with values that JSON can't represent exactly, e.g. dates, are not cached
+        text = json.dumps({'path': path, 'stamp': stamp, 'config': cfg})
+        if json.loads(text)['config'] != cfg:
+            raise ValueError("config does not survive a JSON round trip")
+        os.makedirs(os.path.dirname(cache), mode=0o700, exist_ok=True)
+        tmp = f"{cache}.{os.getpid()}"
+        with open(tmp, 'w', encoding="utf-8") as f:
+            f.write(text)
+        os.replace(tmp, cache)
+    except (OSError, TypeError, ValueError) as err:
+        logger.debug("Failed to cache config file %s: %s", path, err)
+    return cfg
+
+def runner_module(name: str):
+    """
+    Import a helper module from the runner scripts directory. These modules are shipped
+    with the merge jobs, so they only depend on the standard library.
+
+    :param name: name of the module, without the .py extension
+    :return: imported module
+    """
+    module = runner_modules.get(name)
+    if module is None:
+        spec = importlib.util.spec_from_file_location(name, find_runner(f"{name}.py"))
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        runner_modules[name] = module
+    return module
+
+def checksums(path: str, algos: Iterable[str] = ('adler32',), buffer_size: int = None) -> dict:
+    """
+    Calculate several checksums of a file in a single pass, using the same implementation
+    as the merge jobs. Unsupported algorithms are left out of the results.
+
+    :param path: path to the local file
+    :param algos: names of the checksum algorithms to calculate
+    :param buffer_size: size of the read buffer in bytes, defaults to CHECKSUM_BUFFER
+    :return: dictionary of {algorithm: checksum} for each supported algorithm
+    """
+    algos = list(algos)
+    if not algos:
+        return {}
+    module = runner_module('checksum_utils')
+    results = module.checksums(path, algos, buffer_size or module.CHECKSUM_BUFFER)
+    for algo in set(algos) - set(results):
+        logger.debug("Unsupported checksum algorithm: %s", algo)
+    return results
+
+async def run_cmd(cmd: list[str], timeout: float = None) -> subprocess.CompletedProcess:
+    """
+    Run an external command as an asyncio subprocess, without tying up a worker thread.
+    The command runs in its own process group, which is killed if the timeout expires or
+    the calling task is cancelled, so no child process is left holding the output pipes.
+
+    :param cmd: command and arguments to run
+    :param timeout: maximum run time in seconds, or None to wait indefinitely
+    :return: CompletedProcess with the return code and decoded stdout and stderr
+    :raises subprocess.TimeoutExpired: if the command did not finish in time
+    :raises OSError: if the command could not be started
+    """
+    cmd = [str(arg) for arg in cmd]
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+        start_new_session=True
+    )
+    try:
+        stdout, stderr = await asyncio.wait_for(proc.communicate(), timeout=timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError) as err:
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        await asyncio.shield(proc.wait())
+        if isinstance(err, asyncio.TimeoutError):
+            raise subprocess.TimeoutExpired(cmd, timeout) from err
+        raise
+    return subprocess.CompletedProcess(cmd, proc.returncode,
+                                       stdout.decode(errors='replace'),
+                                       stderr.decode(errors='replace'))
+
 def setup_log(name: str = None, log_file: str = None, verbosity: int = 0) -> None:
     """Configure logging"""
     logger_config = read_config_file("logging.json")
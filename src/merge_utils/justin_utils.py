@@ -1,41 +1,137 @@
 """Utility functions for interacting with the JustIN web API."""
 
-import logging
+import os
 import csv
+import json
+import time
+import logging
 import asyncio
-import requests
 
-from merge_utils import config
+from merge_utils import io_utils, config
 
 logger = logging.getLogger(__name__)
 
 SITE_STORAGE_URL = "/api/info/sites_storages.csv"
+SITE_STORAGE_FIELDS = ['site', 'rse', 'dist', 'site_enabled', 'rse_read', 'rse_write']
+
+class SiteStorageTable:
+    """Site-storage table from JustIN, saved to disk so that later runs can reuse it"""
+
+    def __init__(self, path: str = None):
+        """
+        Initialize the SiteStorageTable.
+
+        :param path: path to the JSON cache file, defaults to 'justin_sites.json' in the cache directory
+        """
+        self.path = path
+        self.data = None
+
+    @staticmethod
+    def ttl() -> float:
+        """Get how long the cached table stays valid before checking for changes, in seconds"""
+        return float(config.sites.justin_ttl or 0) * 3600
+
+    def load(self) -> dict:
+        """
+        Read the cached table on first use.
+
+        :return: dictionary with the url, fetched timestamp, etag, modified date, and rows
+        """
+        if self.data is not None:
+            return self.data
+        self.data = {}
+        self.path = self.path or os.path.join(io_utils.cache_dir(), 'justin_sites.json')
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            if not isinstance(data['rows'], list):
+                raise TypeError("Cached rows are not a list")
+            self.data = data
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logger.debug("No usable JustIN site table at %s: %s", self.path, err)
+        return self.data
+
+    def save(self) -> None:
+        """Write the table back to disk"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}"
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump(self.data, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logger.debug("Failed to save JustIN site table %s: %s", self.path, err)
+
+    async def rows(self, url: str) -> list[list[str]]:
+        """
+        Get the rows of the site-storage table, only contacting JustIN once the cached copy
+        has expired. Expired tables are revalidated with the ETag and Last-Modified headers
+        from the previous response, and used as a fallback if JustIN cannot be reached.
+
+        :param url: full URL of the site-storage CSV file
+        :return: list of CSV rows, or None if the table is not available
+        """
+        data = self.load()
+        cached = data if data.get('url') == url else {}
+        if cached and time.time() - cached['fetched'] <= self.ttl():
+            logger.debug("Using cached JustIN site table from %s", self.path)
+            return cached['rows']
+        import requests # pylint: disable=import-outside-toplevel
+        headers = {}
+        if cached.get('etag'):
+            headers['If-None-Match'] = cached['etag']
+        if cached.get('modified'):
+            headers['If-Modified-Since'] = cached['modified']
+        try:
+            res = await asyncio.to_thread(
+                requests.get, url, headers=headers, verify=False, timeout=60)
+        except requests.RequestException as err:
+            logger.error("JustIN connection error: %s", err)
+            res = None
+        if res is not None and res.status_code == 304 and cached:
+            logger.debug("JustIN site table has not changed")
+            cached['fetched'] = time.time()
+            self.save()
+            return cached['rows']
+        if res is not None and res.ok:
+            self.data = {
+                'url': url,
+                'fetched': time.time(),
+                'etag': res.headers.get('ETag'),
+                'modified': res.headers.get('Last-Modified'),
+                'rows': list(csv.reader(res.iter_lines(decode_unicode=True)))
+            }
+            self.save()
+            return self.data['rows']
+        if res is not None:
+            logger.error("JustIN request failed with status %d", res.status_code)
+        if cached:
+            logger.warning("Using expired JustIN site table from %s",
+                           time.strftime('%Y-%m-%d %H:%M', time.localtime(cached['fetched'])))
+            return cached['rows']
+        return None
+
+table = SiteStorageTable()
 
 async def get_site_rse_distances() -> dict:
     """
-    Retrieve site-RSE distances from the JustIN web API.
+    Retrieve site-RSE distances from the JustIN web API, or the cached site-storage table.
     Adds site distance offsets from the config
     Does NOT add RSE distance offsets, since those are already accounted for by the PathFinder
 
     :return: dictionary of {rse: {site: distance}} for all reachable site-RSE pairs
     """
-    # Query JustIN for site-RSE distances
     full_url = str(config.sites.justin_url) + SITE_STORAGE_URL
-    try:
-        res = await asyncio.to_thread(requests.get, full_url, verify=False, timeout=60)
-        connected = res.ok
-    except requests.ConnectionError as err:
-        logger.error("JustIN connection error: %s", err)
-        connected = False
-    if not connected:
+    rows = await table.rows(full_url)
+    if rows is None:
         return {}
-    # Parse the CSV response
+    # Parse the CSV rows
     distances = {}
-    text = res.iter_lines(decode_unicode=True)
-    fields = ['site', 'rse', 'dist', 'site_enabled', 'rse_read', 'rse_write']
-    reader = csv.DictReader(text, fields)
     default_dist = config.sites.site_distances['default']
-    for row in reader:
+    for values in rows:
+        if len(values) < len(SITE_STORAGE_FIELDS):
+            continue
+        row = dict(zip(SITE_STORAGE_FIELDS, values))
         # Skip disabled sites and RSEs with no read/write access
         if not row['site_enabled']:
             continue
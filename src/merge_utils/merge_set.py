@@ -9,7 +9,7 @@ import math
 import enum
 from typing import Iterable, Generator, Optional
 
-from merge_utils import io_utils, config, meta, metacat_utils
+from merge_utils import io_utils, config, meta, naming, metacat_utils
 
 logger = logging.getLogger(__name__)
 
@@ -43,7 +43,7 @@ class MergeFileError(enum.Flag):
         first_err = self.first
         err_name = first_err.name
         assert err_name is not None
-        mode = str(config.validation.handling[err_name.lower()])
+        mode = config.frozen().validation.handling[err_name.lower()]
         # If the mode is 'include' but there are multiple errors, check the next error handling
         if mode == 'include' and first_err != self:
             return MergeFileError(self.value & ~first_err.value).handling
@@ -79,10 +79,18 @@ ERROR_MESSAGES = {
 class MergeFile:
     """A generic data file with metadata"""
 
-    def __init__(self, data: dict):
-        """Initialize the MergeFile with a metadata dictionary"""
+    def __init__(self, data: dict, record: Optional[tuple] = None):
+        """
+        Initialize the MergeFile with a metadata dictionary
+
+        :param data: dictionary with the file metadata
+        :param record: optional validation record from validate_files, to skip validation
+        """
         # Set name and check for errors
         self._did = f"{data['namespace']}:{data['name']}"
+        if record is not None:
+            self.restore(data, record)
+            return
         self.errors = data.get('errors', MergeFileError(0))
         if isinstance(self.errors, str):
             self.errors = MergeFileError[self.errors]
@@ -128,6 +136,40 @@ class MergeFile:
             io_utils.log_list("File %s has {n} parent{s} without an FID:" % self.did,
                               list(missing), logging.ERROR)
 
+    def record(self, metadata: dict) -> tuple:
+        """
+        Get a compact record of the validation results, to send back from a worker process.
+
+        :param metadata: copy of the metadata dictionary before validation
+        :return: tuple of (error flags, changed metadata values, removed metadata keys)
+        """
+        new_metadata = getattr(self, 'metadata', metadata)
+        changed = {k: v for k, v in new_metadata.items() if k not in metadata or metadata[k] != v}
+        removed = [k for k in metadata if k not in new_metadata]
+        return (self.errors.value, changed, removed)
+
+    def restore(self, data: dict, record: tuple) -> None:
+        """
+        Set up the file from a validation record instead of validating it again.
+
+        :param data: dictionary with the file metadata
+        :param record: tuple of (error flags, changed metadata values, removed metadata keys)
+        """
+        errors, changed, removed = record
+        self.errors = MergeFileError(errors)
+        self.fid = data.get('fid', None)
+        self.parents = set()
+        if config.output.grandparents:
+            self.parents = {p['fid'] for p in data.get('parents', []) if p.get('fid')}
+        self.replicas = []
+        self.size = data.get('size', None)
+        algos = config.frozen().validation.checksums
+        self.checksums = {a: c for a, c in data.get('checksums', {}).items() if a in algos}
+        self.metadata = data.get('metadata') or {}
+        self.metadata.update(changed)
+        for key in removed:
+            self.metadata.pop(key, None)
+
     def validate(self) -> None:
         """Check for errors or invalid metadata"""
         if not self.size:
@@ -138,7 +180,7 @@ class MergeFile:
             logger.error("No checksums for %s", self)
             self.errors |= MergeFileError.INVALID
             return
-        algos = set(str(algo) for algo in config.validation.checksums)
+        algos = config.frozen().validation.checksums
         self.checksums = {algo: csum for algo, csum in self.checksums.items() if algo in algos}
         if len(self.checksums) == 0:
             logger.warning("No valid checksum for %s", self)
@@ -201,6 +243,21 @@ class MergeFile:
             values.append(value)
         return tuple(values)
 
+def validate_files(files: list) -> list[tuple]:
+    """
+    Validate a list of file metadata dictionaries (e.g. in a worker process).
+    Only the errors and metadata fixes are returned, since sending whole MergeFile
+    objects back to the main process would cost about as much as validating them.
+
+    :param files: list of dictionaries with file metadata
+    :return: list of validation records for MergeFile
+    """
+    records = []
+    for file in files:
+        metadata = dict(file.get('metadata') or {})
+        records.append(MergeFile(file).record(metadata))
+    return records
+
 class MergeSet:
     """Class to keep track of a set of files for merging"""
 
@@ -324,22 +381,25 @@ class MergeSet:
         if not file.good:
             return
         # Check for consistency
+        consistent = config.frozen().metadata.consistent
         if self.consistent_fields is None:
-            self.consistent_fields = file.get_fields(config.metadata.consistent)
+            self.consistent_fields = file.get_fields(consistent)
         elif MergeFileError.INCONSISTENT not in self.errors:
-            if file.get_fields(config.metadata.consistent) != self.consistent_fields:
+            if file.get_fields(consistent) != self.consistent_fields:
                 self.errors |= MergeFileError.INCONSISTENT
 
-    def add(self, skip: int, files: Iterable) -> list:
+    def add(self, skip: int, files: Iterable, records: Optional[list] = None) -> list:
         """
         Add a batch of files to the set.
 
+        :param skip: index of the first file in the batch
         :param files: collection of dictionaries with file metadata
+        :param records: optional list of validation records for the files, from validate_files
         :return: list of good MergeFile objects that were added
         """
         new_files = []
         for idx, file in enumerate(files, start=skip):
-            new_file = MergeFile(file)
+            new_file = MergeFile(file, records[idx - skip] if records else None)
             for child in file.get('children', []):
                 if child['fid'] in self.children:
                     new_file.errors |= MergeFileError.ALREADY_DONE
@@ -574,8 +634,94 @@ class MergeSet:
             group_sizes[max_idx+1] -= max_delta
         return divs
 
-    def groups(self) -> Generator[MergeChunk, None, None]:
-        """Split the files into groups for merging"""
+    def site_partitions(self, indices: list[int], matrix) -> list[list[int]]:
+        """
+        Partition files by their nearest merging site. Sites whose files would fill less than
+        the grouping.tolerance fraction of a group are dropped one at a time, smallest first,
+        and their files are moved to the nearest of the remaining sites.
+
+        :param indices: Indices of files to partition
+        :param matrix: DistanceMatrix with the distances from each good file to each site
+        :return: List of lists of file indices, one per site, in order of their first file
+        """
+        cfg = config.frozen()
+        indices = [i for i in indices if self.at(i).good and self.at(i).did in matrix.rows]
+        parts = collections.defaultdict(list)
+        for idx, site in zip(indices, matrix.best_sites([self.at(i) for i in indices])):
+            parts[site].append(idx)
+        # Measure the partitions in the same units as the grouping target
+        if cfg.output.grouping.mode == 'count':
+            target = cfg.output.grouping.target
+            def amount(part):
+                return len(part)
+        else:
+            target = cfg.output.grouping.target * 1024**3
+            known = [self.at(i).size for i in indices if self.at(i).size]
+            avg = sum(known) / len(known) if known else 0
+            outputs = cfg.method.outputs
+            spec = outputs[0].size if outputs and outputs[0].size else sum
+            def amount(part):
+                return spec([self.at(i).size or avg for i in part])
+        def new_sites(site):
+            """Find the nearest other site for each file, or None if any file cannot move"""
+            others = [s for s in parts if s != site]
+            sites = []
+            for idx in parts[site]:
+                dists = matrix.file(self.at(idx))
+                new_site = min(others, key=lambda s, d=dists: d.get(s, float('inf')))
+                if dists.get(new_site, float('inf')) == float('inf'):
+                    return None
+                sites.append(new_site)
+            return sites
+        # Other partitions only grow, so each site only needs to be checked once
+        threshold = cfg.output.grouping.tolerance * target
+        for site in sorted(parts, key=lambda s: amount(parts[s])):
+            if len(parts) == 1 or amount(parts[site]) >= threshold:
+                continue
+            sites = new_sites(site)
+            if sites is None:
+                continue
+            logger.debug("Moving %d files from site %s to other sites", len(sites), site)
+            for idx, new_site in zip(parts.pop(site), sites):
+                parts[new_site].append(idx)
+        return sorted((sorted(part) for part in parts.values()), key=lambda part: part[0])
+
+    def locality_groups(self, partitions: list[list[int]]) -> Generator[MergeChunk, None, None]:
+        """
+        Split each site partition into groups for merging. Since the files at each site may be
+        interleaved with files from other sites, the groups have no skip and limit, and are
+        numbered by the index of their first input file instead, so that a group keeps its
+        number when the sites of other groups change between runs.
+
+        :param partitions: List of lists of file indices, one per site
+        :return: Generator of MergeChunk objects
+        """
+        small_groups = False
+        for part in partitions:
+            if config.output.grouping.mode == 'count':
+                divs = self.group_by_count(len(part))
+            else:
+                divs = self.group_by_size(part)
+            for start, end in zip([0] + divs, divs + [len(part)]):
+                files = [self.at(i) for i in part[start:end]]
+                group = MergeChunk(files=files, group=part[start])
+                if len(group) < config.method.chunks.min_count:
+                    small_groups = True
+                logger.debug("Yielding group %d with %d good files", group.group, len(group))
+                yield group
+        if small_groups:
+            io_utils.log_print(
+                "Some groups were smaller than the minimum chunk size, "
+                "consider adjusting grouping parameters or tolerance",
+                logging.WARNING)
+
+    def groups(self, matrix = None) -> Generator[MergeChunk, None, None]:
+        """
+        Split the files into groups for merging
+
+        :param matrix: DistanceMatrix for grouping files by merging site, if enabled
+        :return: Generator of MergeChunk objects
+        """
         # Finish expanding all names before making groups
         meta.make_names(self.good_files)
         # Get indices of files that should count towards grouping
@@ -590,6 +736,13 @@ class MergeSet:
         if len(indices) == 0:
             logger.critical("No files to group")
             sys.exit(1)
+        # Group the files at each merging site separately, if there is more than one site
+        if config.output.grouping.locality and matrix is not None:
+            partitions = self.site_partitions(indices, matrix)
+            if len(partitions) > 1:
+                io_utils.log_print(f"Grouping inputs from {len(partitions)} merging sites")
+                yield from self.locality_groups(partitions)
+                return
         if config.output.grouping.mode == 'count':
             divs = self.group_by_count(len(indices))
         elif config.output.grouping.mode == 'size':
@@ -641,9 +794,11 @@ class MergeSet:
 class MergeChunk:
     """Class to keep track of a chunk of files for merging"""
 
-    def __init__(self, skip: OInt = None, limit: OInt = None, files: OList = None):
+    def __init__(self, skip: OInt = None, limit: OInt = None, files: OList = None,
+                 group: OInt = None):
         self.skip = skip
         self.limit = limit
+        self.group = group
         self.files = []
         self.gaps = set()
         for i, f in enumerate(files or []):
@@ -669,6 +824,13 @@ class MergeChunk:
             return 0
         return max(child.tier for child in self.children) + 1
 
+    @property
+    def leaves(self) -> list[MergeChunk]:
+        """Get the pass 1 chunks below this chunk, in order"""
+        if not self.children:
+            return [self]
+        return [leaf for child in self.children for leaf in child.leaves]
+
     @property
     def chunk_id(self) -> list[int]:
         """Get the chunk indices for the chunk"""
@@ -682,7 +844,8 @@ class MergeChunk:
 
     def make_name(self, name: str, chunk: list[int]) -> str:
         """Get the name for a chunk output"""
-        output = name.format(UUID=config.uuid(self.skip, self.limit, chunk))
+        uuid = config.uuid(self.skip, self.limit, chunk, self.group)
+        output = naming.compile_template(str(name)).render({'UUID': uuid})
         if len(output) <= config.naming.max_length:
             return output
         logger.critical("Output name is %d characters long, exceeding the maximum of %d:\n  %s",
@@ -766,6 +929,8 @@ class MergeChunk:
             md['merge.skip'] = self.skip
         if self.limit is not None:
             md['merge.limit'] = self.limit
+        if self.group is not None:
+            md['merge.group'] = self.group
         chunk_id = self.chunk_id
         if chunk_id:
             md['merge.chunk'] = chunk_id
@@ -797,7 +962,8 @@ class MergeChunk:
         # Build the settings dictionary from the spec
         settings = {
             'streaming': config.input.streaming.value,
-            'method': spec.method_name.value
+            'method': spec.method_name.value,
+            'checksums': list(config.frozen().validation.checksums)
         }
         for key in ['cfg', 'script', 'cmd']:
             if spec[key]:
@@ -840,8 +1006,37 @@ class MergeChunk:
             if file not in self.files:
                 logger.critical("Child chunk contains file not in parent chunk: %s", file)
                 sys.exit(1)
-        child = MergeChunk(self.skip, self.limit, files=files)
+        child = MergeChunk(self.skip, self.limit, files=files, group=self.group)
         child.site = self.site
         child.parent = self
         self.children.append(child)
         return child
+
+    def add_tier(self, groups: list[list[MergeChunk]]) -> list[MergeChunk]:
+        """
+        Insert a tier of intermediate chunks between this chunk and its children.
+        A group with a single child is kept as a direct child of this chunk, since an
+        intermediate chunk would only merge it again.
+
+        :param groups: list of groups of child chunks, each merged by one intermediate chunk
+        :return: list of new children of this chunk
+        """
+        if sorted(map(id, sum(groups, []))) != sorted(map(id, self.children)):
+            logger.critical("Intermediate chunks must contain each child chunk exactly once")
+            sys.exit(1)
+        self.children = []
+        for group in groups:
+            if len(group) == 1:
+                self.children.append(group[0])
+                continue
+            child = MergeChunk(self.skip, self.limit, files=[f for c in group for f in c.files],
+                               group=self.group)
+            # Merge at the same site as the inputs if possible
+            sites = {c.site for c in group}
+            child.site = sites.pop() if len(sites) == 1 else self.site
+            child.parent = self
+            child.children = group
+            for grandchild in group:
+                grandchild.parent = child
+            self.children.append(child)
+        return self.children
@@ -18,25 +18,26 @@ def fix(name: str, metadata: dict) -> None:
     :param metadata: metadata dictionary
     """
     fixes = []
+    cfg = config.frozen().metadata.fixes
     # Fix misspelled keys
-    for key, replacement in config.metadata.fixes.bad_keys.items():
+    for key, replacement in cfg.bad_keys.items():
         if key in metadata:
             fixes.append(f"Key '{key}' -> '{replacement}'")
-            metadata[str(replacement)] = metadata.pop(key)
+            metadata[replacement] = metadata.pop(key)
 
     # Fix missing keys
-    for key, value in config.metadata.fixes.missing_keys.items():
+    for key, value in cfg.missing_keys.items():
         if key not in metadata:
             fixes.append(f"Key '{key}' value None -> '{value}'")
-            metadata[key] = value._value # pylint: disable=protected-access
+            metadata[key] = value
 
     # Fix misspelled values
-    for key, replacements in config.metadata.fixes.bad_values.items():
+    for key, replacements in cfg.bad_values.items():
         value = metadata.get(key, None)
         replacement = replacements.get(value, None)
         if replacement is not None:
             fixes.append(f"Key '{key}' value '{value}' -> '{replacement}'")
-            metadata[key] = replacement._value # pylint: disable=protected-access
+            metadata[key] = replacement
 
     if fixes:
         io_utils.log_list("Applying {n} metadata fix{es} to file %s:" % name, fixes, logging.DEBUG)
@@ -49,28 +50,30 @@ def check_required(metadata: dict) -> list:
     :return: List of any missing required keys
     """
     errs = []
+    cfg = config.frozen().metadata
+    optional = cfg.optional
     # Check for required keys
     required = set()
-    for key in [str(k) for k in config.metadata.required]:
+    for key in cfg.required:
         required.add(key)
         if key not in metadata:
-            if key in config.metadata.optional:
+            if key in optional:
                 continue
             errs.append(f"Missing required key: {key}")
 
     # Check for conditionally required keys
     name_dict = naming.Formatter(metadata)
-    for spec in config.metadata.conditional:
+    for spec in cfg.conditional:
         condition = spec.cond
         if not name_dict.eval(condition):
             #logger.debug("Skipping condition: %s", condition)
             continue
         logger.debug("Matched condition: %s", condition)
-        for key in [str(k) for k in spec.required]:
+        for key in spec.required:
             if key in required:
                 continue
             required.add(key)
-            if key not in metadata and key not in config.metadata.optional:
+            if key not in metadata and key not in optional:
                 errs.append(f"Missing conditionally required key: {key} (from {condition})")
 
     return errs
@@ -91,8 +94,9 @@ def validate(name: str, metadata: dict, requirements: bool = True) -> bool:
     if requirements:
         errs.extend(check_required(metadata))
 
+    cfg = config.frozen()
     # Check for restricted keys
-    for key, options in config.metadata.restricted.items():
+    for key, options in cfg.metadata.restricted.items():
         if key not in metadata:
             continue
         value = metadata[key]
@@ -100,8 +104,8 @@ def validate(name: str, metadata: dict, requirements: bool = True) -> bool:
             errs.append(f"Invalid value for {key}: {value}")
 
     # Check value types
-    for key, expected_type in config.metadata.types.items():
-        if key not in metadata or key in config.metadata.restricted:
+    for key, expected_type in cfg.metadata.types.items():
+        if key not in metadata or key in cfg.metadata.restricted:
             continue
         value = metadata[key]
         type_name = type(value).__name__
@@ -110,7 +114,7 @@ def validate(name: str, metadata: dict, requirements: bool = True) -> bool:
         errs.append(f"Invalid type for {key}: {value} (expected {expected_type})")
 
     if errs:
-        crit = config.validation.handling.invalid == 'quit'
+        crit = cfg.validation.handling.invalid == 'quit'
         lvl = logging.CRITICAL if crit else logging.ERROR
         io_utils.log_list("File %s has {n} invalid metadata key{s}:" % name, errs, lvl)
         return False
@@ -676,7 +680,7 @@ def make_names(files: list):
         sys.exit(1)
     formatter.format(config.output.name)
     # Max length, accounting for unexpanded {UUID}
-    max_length = config.naming.max_length - len(config.uuid(1,1,[1])) + 6
+    max_length = config.naming.max_length - len(config.uuid(1,1,[1],1)) + 6
     # Check each output stream file name
     for idx, output in enumerate(config.method.outputs):
         logger.debug("Formatting output %d name: %s", idx, output.name)
@@ -3,13 +3,22 @@
 import logging
 import sys
 import asyncio
-
-import metacat.webapi as metacat #pylint: disable=import-error
+import importlib
 
 #from merge_utils import config
 
 logger = logging.getLogger(__name__)
 
+# The MetaCat client is slow to import, so only load it when we first connect
+metacat = None # pylint: disable=invalid-name
+
+def import_metacat():
+    """Import the MetaCat web API client on first use"""
+    global metacat # pylint: disable=global-statement
+    if metacat is None:
+        metacat = importlib.import_module('metacat.webapi')
+    return metacat
+
 class MetaCatWrapper:
     """Class for sending asynchronous requests to the MetaCat web API."""
 
@@ -21,7 +30,8 @@ class MetaCatWrapper:
         """Connect to the MetaCat web API"""
         if not self.client:
             logger.debug("Connecting to MetaCat")
-            self.client = await asyncio.to_thread(metacat.MetaCatClient)
+            webapi = await asyncio.to_thread(import_metacat)
+            self.client = await asyncio.to_thread(webapi.MetaCatClient)
         else:
             logger.debug("Already connected to MetaCat")
 
@@ -1,8 +1,11 @@
 """Utilities for expanding name templates using metadata."""
 
 import os
+import re
 import sys
+import string
 import logging
+import functools
 
 from merge_utils import config, io_utils, config_keys
 
@@ -74,6 +77,123 @@ def read_dict(data: dict, key: any) -> tuple:
         return None, ["invalid index"]
     return val, []
 
+FIELD_ACCESSOR = re.compile(r"\.([^.\[]*)|\[([^\]]*)\]")
+
+def split_field_name(name: str) -> tuple:
+    """
+    Split a replacement field name into its first key and its attribute or index accessors,
+    following the same rules as str.format().
+
+    :param name: field name, e.g. 'a.b[0]'
+    :return: tuple of (first key, list of (is_attribute, key) pairs)
+    """
+    first = re.match(r"[^.\[]*", name).group()
+    pos = len(first)
+    path = []
+    while pos < len(name):
+        match = FIELD_ACCESSOR.match(name, pos)
+        if match is None:
+            if name[pos] == '[':
+                raise ValueError("Missing ']' in format string")
+            raise ValueError("Only '.' or '[' may follow ']' in format field specifier")
+        attr, key = match.groups()
+        if not (attr or key):
+            raise ValueError("Empty attribute in format string")
+        if attr is not None:
+            path.append((True, attr))
+        else:
+            path.append((False, int(key) if key.isdigit() else key))
+        pos = match.end()
+    return (int(first) if first.isdigit() else first), path
+
+class TemplateField:
+    """A single pre-parsed replacement field from a name template."""
+    __slots__ = ('first', 'path', 'conversion', 'spec')
+
+    def __init__(self, name: str, conversion: str, spec: str):
+        """
+        Parse a replacement field.
+
+        :param name: field name, including any attribute or index accessors
+        :param conversion: optional conversion character ('s', 'r', or 'a')
+        :param spec: format specification, which may itself contain fields
+        """
+        first, rest = split_field_name(name)
+        if first == '' or isinstance(first, int):
+            raise ValueError("Format string contains positional fields")
+        self.first = first
+        self.path = tuple(rest)
+        self.conversion = conversion
+        self.spec = compile_template(spec) if '{' in spec else spec
+
+    def render(self, mapping) -> str:
+        """
+        Look up the field value in a mapping and format it.
+
+        :param mapping: mapping to look up field values in
+        :return: formatted field
+        """
+        obj = mapping[self.first]
+        for is_attr, key in self.path:
+            obj = getattr(obj, key) if is_attr else obj[key]
+        if self.conversion == 's':
+            obj = str(obj)
+        elif self.conversion == 'r':
+            obj = repr(obj)
+        elif self.conversion == 'a':
+            obj = ascii(obj)
+        elif self.conversion is not None:
+            raise ValueError(f"Unknown conversion specifier {self.conversion}")
+        spec = self.spec
+        if isinstance(spec, Template):
+            spec = spec.render(mapping)
+        return format(obj, spec)
+
+class Template:
+    """A name template pre-parsed into literal text and replacement fields."""
+
+    def __init__(self, template: str):
+        """
+        Parse a template string.
+
+        :param template: template string in str.format syntax
+        """
+        self.template = template
+        self.parts = []
+        for literal, name, spec, conversion in string.Formatter().parse(template):
+            field = None if name is None else TemplateField(name, conversion, spec)
+            self.parts.append((literal, field))
+        self.fields = [field for _, field in self.parts if field is not None]
+
+    def __str__(self):
+        return self.template
+
+    def render(self, mapping) -> str:
+        """
+        Fill in the template, equivalent to template.format_map(mapping).
+
+        :param mapping: mapping to look up field values in
+        :return: formatted string
+        """
+        if not self.fields:
+            return ''.join(literal for literal, _ in self.parts)
+        out = []
+        for literal, field in self.parts:
+            out.append(literal)
+            if field is not None:
+                out.append(field.render(mapping))
+        return ''.join(out)
+
+@functools.lru_cache(maxsize=1024)
+def compile_template(template: str) -> Template:
+    """
+    Parse a template string once and cache the result for reuse.
+
+    :param template: template string in str.format syntax
+    :return: compiled Template object
+    """
+    return Template(template)
+
 class Formatter:
     """Wrapper class to access metadata dictionary."""
 
@@ -138,14 +258,15 @@ class Formatter:
             if spec:
                 return f"{{{key}:{spec}}}"
             return f"{{{key}}}"
+        cfg = config.frozen().naming
         if isinstance(val, str):
             # Apply specific abbreviations
-            abbr = str(config.naming.abbreviations.get(key, {}).get(val, ''))
+            abbr = str(cfg.abbreviations.get(key, {}).get(val, ''))
             if abbr:
                 logger.debug("Abbreviating key '%s' value '%s' to '%s'", key, val, abbr)
                 val = abbr
             # Remove known extensions
-            for ext in config.naming.extensions:
+            for ext in cfg.extensions:
                 if val.endswith(f".{ext}"):
                     logger.debug("Stripping extension '.%s' from '%s'", ext, val)
                     val = val[:-(len(ext)+1)]
@@ -158,7 +279,7 @@ class Formatter:
             self.errors.append(f"Invalid format spec '{output}' for value '{val}'")
             return output
         # Apply general substitutions
-        for old, new in config.naming.substitutions.items():
+        for old, new in cfg.substitutions.items():
             output = output.replace(str(old), str(new))
         return output
 
@@ -295,7 +416,7 @@ class Formatter:
         # Perform formatting
         self.reset()
         self.defer_uuid = defer_uuid
-        result = str(template).format_map(self)
+        result = compile_template(str(template)).render(self)
         if self.errors:
             io_utils.log_list(
                 f"Config key '{name}' could not be formatted:\n  (got '{result}')",
@@ -316,7 +437,7 @@ class Formatter:
         """
         self.reset()
         logger.debug("Evaluating condition '%s'", condition)
-        expr = str(condition).format_map(self)
+        expr = compile_template(str(condition)).render(self)
         if self.errors:
             io_utils.log_list(
                 f"Error evaluating condition expression '{condition}':",
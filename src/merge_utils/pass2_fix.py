@@ -1,4 +1,4 @@
-"""Update pass 2 json files and add to cvmfs directory before submission"""
+"""Update pass 2+ json files and add to cvmfs directory before submission"""
 
 import sys
 import os
@@ -50,7 +50,7 @@ def get_pfns(inputs: set) -> dict:
         print(f"ERROR: Failed to retrieve {len(unreachable)} file(s) from Rucio:")
         for did in unreachable:
             print(f"  {did}")
-        print("Did the first merging pass complete successfully?")
+        print("Did the previous merging pass complete successfully?")
         sys.exit(1)
 
     return found
@@ -58,7 +58,8 @@ def get_pfns(inputs: set) -> dict:
 def main():
     """Main function for command line execution"""
     cfg_dir = sys.argv[1]
-    cfgs = get_cfgs(cfg_dir, sys.argv[2:])
+    pass_num = int(sys.argv[2])
+    cfgs = get_cfgs(cfg_dir, sys.argv[3:])
     job_dir = os.path.dirname(cfg_dir)
 
     inputs = set()
@@ -69,16 +70,16 @@ def main():
     print("Retrieving physical file paths from Rucio")
     pfns = get_pfns(inputs)
 
-    cfg_pass2 = os.path.join(job_dir, "config_pass2.tar")
-    if os.path.exists(cfg_pass2):
-        os.remove(cfg_pass2)
+    cfg_pass = os.path.join(job_dir, f"config_pass{pass_num}.tar")
+    if os.path.exists(cfg_pass):
+        os.remove(cfg_pass)
     cfg_base = os.path.join(job_dir, "config.tar")
     if not os.path.isfile(cfg_base):
         print(f"ERROR: Base configuration file {cfg_base} does not exist!")
         sys.exit(1)
-    shutil.copyfile(cfg_base, cfg_pass2)
+    shutil.copyfile(cfg_base, cfg_pass)
 
-    with tarfile.open(cfg_pass2, "a") as tar:
+    with tarfile.open(cfg_pass, "a") as tar:
         for name, cfg in cfgs.items():
             cfg['inputs'] = [pfns[did] for did in cfg['inputs']]
             fix_name = os.path.join(cfg_dir, name.replace('.json', '_fixed.json'))
@@ -89,15 +90,15 @@ def main():
             tar.add(fix_name, name)
 
     print("Uploading corrected configuration files to cvmfs")
-    proc = subprocess.run(['justin-cvmfs-upload', cfg_pass2], capture_output=True, check=False)
+    proc = subprocess.run(['justin-cvmfs-upload', cfg_pass], capture_output=True, check=False)
     if proc.returncode != 0:
         print(f"Failed to upload configuration files: {proc.stderr.decode('utf-8')}")
         sys.exit(1)
     cvmfs_dir = proc.stdout.decode('utf-8').strip()
     print(f"Uploaded configuration files to {cvmfs_dir}")
 
-    print("Submitting pass 2 jobs to JustIN")
-    subprocess.run([os.path.join(job_dir, "pass2_justin.sh"), cvmfs_dir], check=False)
+    print(f"Submitting pass {pass_num} jobs to JustIN")
+    subprocess.run([os.path.join(job_dir, f"pass{pass_num}_justin.sh"), cvmfs_dir], check=False)
 
 if __name__ == '__main__':
     main()
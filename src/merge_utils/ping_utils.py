@@ -0,0 +1,134 @@
+"""Utility functions for measuring network round-trip times to storage hosts."""
+
+import os
+import json
+import math
+import time
+import logging
+import asyncio
+import subprocess
+
+from merge_utils import io_utils, config
+
+logger = logging.getLogger(__name__)
+
+async def ping(host: str, timeout: float = 2) -> float:
+    """
+    Ping a host once with a bounded timeout.
+
+    :param host: host name to ping
+    :param timeout: maximum time to wait for a reply in seconds
+    :return: round-trip time in ms, or inf if the ping failed
+    """
+    cmd = ['ping', '-c', '1', '-W', str(max(1, math.ceil(timeout))), host]
+    try:
+        ret = await io_utils.run_cmd(cmd, timeout=timeout + 1)
+    except OSError as err:
+        logger.debug("Failed to run ping for %s: %s", host, err)
+        return float('inf')
+    except subprocess.TimeoutExpired:
+        logger.debug("Timed out pinging %s", host)
+        return float('inf')
+    if ret.returncode != 0:
+        logger.debug("Failed to ping %s", host)
+        return float('inf')
+    try:
+        rtt = float(ret.stdout.split()[-2].split('/')[0]) # min ping time
+    except (IndexError, ValueError):
+        logger.debug("Could not parse ping output for %s", host)
+        return float('inf')
+    logger.debug("Pinged %s, t = %.1f ms", host, rtt)
+    return rtt
+
+class PingCache:
+    """Round-trip times to hosts, saved to disk so that later runs can reuse them"""
+
+    def __init__(self, path: str = None):
+        """
+        Initialize the PingCache.
+
+        :param path: path to the JSON cache file, defaults to 'pings.json' in the cache directory
+        """
+        self.path = path
+        self.rtts = None
+        self.pending = {}
+
+    def load(self) -> dict:
+        """
+        Read the cached round-trip times on first use.
+
+        :return: dictionary of {host: (rtt, timestamp)}
+        """
+        if self.rtts is not None:
+            return self.rtts
+        self.rtts = {}
+        self.path = self.path or os.path.join(io_utils.cache_dir(), 'pings.json')
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                self.rtts = {host: (float(rtt), float(timestamp))
+                             for host, (rtt, timestamp) in json.load(f).items()}
+        except (OSError, ValueError, TypeError, AttributeError) as err:
+            logger.debug("No usable ping cache at %s: %s", self.path, err)
+            self.rtts = {}
+        return self.rtts
+
+    def save(self) -> None:
+        """Write the successful round-trip times back to disk"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}"
+            rtts = {host: val for host, val in self.rtts.items() if val[0] != float('inf')}
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump(rtts, f)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logger.debug("Failed to save ping cache %s: %s", self.path, err)
+
+    def get(self, host: str) -> float:
+        """
+        Get a cached round-trip time, if it has not expired.
+
+        :param host: host name
+        :return: round-trip time in ms, or None if there is no valid entry
+        """
+        entry = self.load().get(host)
+        if entry is None:
+            return None
+        ttl = float(config.sites.ping_ttl or 0) * 3600
+        if time.time() - entry[1] > ttl:
+            return None
+        return entry[0]
+
+    async def ping(self, hosts: set[str]) -> dict:
+        """
+        Get round-trip times for a set of hosts, pinging any new hosts concurrently.
+        Failed pings are only remembered for this run, so unreachable hosts are retried next time.
+
+        :param hosts: set of host names
+        :return: dictionary of {host: rtt in ms}, with inf for unreachable hosts
+        """
+        rtts = {}
+        new_hosts = []
+        for host in hosts:
+            rtt = self.get(host)
+            if rtt is not None:
+                rtts[host] = rtt
+            elif host not in self.pending:
+                new_hosts.append(host)
+        timeout = float(config.sites.ping_timeout or 1)
+        for host in new_hosts:
+            self.pending[host] = asyncio.ensure_future(ping(host, timeout))
+        # Wait for our hosts, including pings started by other callers
+        waiting = [host for host in hosts if host not in rtts]
+        results = await asyncio.gather(*[self.pending[host] for host in waiting])
+        rtts.update(zip(waiting, results))
+        if new_hosts:
+            now = time.time()
+            for host in new_hosts:
+                del self.pending[host]
+                self.rtts[host] = (rtts[host], now)
+            self.save()
+        return rtts
+
+# Shared cache for all RSEs
+pings = PingCache()
@@ -0,0 +1,168 @@
+"""Staging of nearline input files from tape before their merge jobs are submitted."""
+from __future__ import annotations
+
+import time
+import logging
+import asyncio
+import collections
+from typing import AsyncGenerator
+
+from merge_utils import config, tape_utils
+from merge_utils.merge_set import MergeChunk
+from merge_utils.replicas import Replica, Status, get_path
+
+logger = logging.getLogger(__name__)
+
+# Stage request states that will not change any more
+FINAL_STATES = {'COMPLETED', 'FAILED', 'CANCELLED'}
+
+class Prestager:
+    """
+    Sends bulk stage requests for the nearline inputs of scheduled chunks to the tape
+    REST API of their RSEs, and releases each chunk once all of its inputs are online.
+    """
+
+    def __init__(self):
+        """Initialize the Prestager"""
+        self.replicas = collections.defaultdict(list) # {(api_url, path): [replicas]}
+        self.requests = collections.defaultdict(list) # {api_url: [request ids]}
+        self.states = {} # {(api_url, path): state}
+
+    @staticmethod
+    def nearline(chunk: MergeChunk) -> list[Replica]:
+        """
+        Get the replicas in a chunk that can be staged with a tape REST API.
+
+        :param chunk: scheduled MergeChunk, with a single replica selected for each file
+        :return: list of NEARLINE replicas on RSEs with a tape REST API
+        """
+        replicas = []
+        for file in chunk.files:
+            for replica in file.replicas:
+                if replica.status == Status.NEARLINE and replica.rse.tape_api:
+                    replicas.append(replica)
+        return replicas
+
+    def waiting(self, chunk: MergeChunk) -> int:
+        """
+        Count the files in a chunk that are still being staged.
+
+        :param chunk: MergeChunk to check
+        :return: number of inputs that are not yet online
+        """
+        count = 0
+        for replica in self.nearline(chunk):
+            key = (replica.rse.tape_api, get_path(replica.path))
+            if key in self.states and self.states[key] not in FINAL_STATES:
+                count += 1
+        return count
+
+    async def submit(self, chunks: list[MergeChunk]) -> None:
+        """
+        Send one bulk stage request per tape REST API for the nearline inputs of the chunks.
+
+        :param chunks: list of scheduled MergeChunk objects
+        """
+        paths = collections.defaultdict(list)
+        for chunk in chunks:
+            for replica in self.nearline(chunk):
+                api_url = replica.rse.tape_api
+                path = get_path(replica.path)
+                if (api_url, path) not in self.replicas:
+                    paths[api_url].append(path)
+                self.replicas[(api_url, path)].append(replica)
+        lifetime = config.frozen().sites.prestage.lifetime
+        results = await asyncio.gather(*[
+            tape_utils.stage(api_url, api_paths, lifetime) for api_url, api_paths in paths.items()
+        ], return_exceptions=True)
+        for (api_url, api_paths), res in zip(paths.items(), results):
+            if isinstance(res, tape_utils.TapeAPIError):
+                # Jobs will still trigger staging when they read the files, just more slowly
+                logger.warning("Failed to request staging from %s:\n  %s", api_url, res)
+                continue
+            if isinstance(res, BaseException):
+                raise res
+            logger.info("Requested staging of %d files from %s", len(api_paths), api_url)
+            self.requests[api_url].extend(res)
+            for path in api_paths:
+                self.states[(api_url, path)] = 'SUBMITTED'
+
+    async def poll(self) -> None:
+        """Update the state of all unfinished stage requests"""
+        calls = [(api_url, request_id)
+                 for api_url, request_ids in self.requests.items() for request_id in request_ids]
+        results = await asyncio.gather(*[
+            tape_utils.stage_status(api_url, request_id) for api_url, request_id in calls
+        ], return_exceptions=True)
+        for (api_url, request_id), res in zip(calls, results):
+            if isinstance(res, tape_utils.TapeAPIError):
+                logger.warning("Failed to get status of stage request %s:\n  %s", request_id, res)
+                continue
+            if isinstance(res, BaseException):
+                raise res
+            for path, state in res.items():
+                key = (api_url, path)
+                if key not in self.states or self.states[key] in FINAL_STATES:
+                    continue
+                self.states[key] = state
+                if state == 'COMPLETED':
+                    for replica in self.replicas[key]:
+                        replica.status = Status.ONLINE
+                        if replica.rse.staging:
+                            replica.distance -= replica.rse.staging
+                elif state in FINAL_STATES:
+                    logger.warning("Staging %s for %s", state.lower(), path)
+            # Stop polling requests once all of their files are final
+            if all(state in FINAL_STATES for state in res.values()):
+                self.requests[api_url].remove(request_id)
+
+    async def release(self, chunks: list[MergeChunk]) -> AsyncGenerator[list[MergeChunk], None]:
+        """
+        Stage the nearline inputs of a list of chunks, yielding each chunk as soon as all of
+        its inputs are online. Chunks that become ready together are yielded as one list.
+        Chunks that are still waiting when sites.prestage.max_wait runs out are released
+        anyway, and their jobs will stage the files when reading them.
+
+        :param chunks: list of scheduled MergeChunk objects
+        :return: generator of lists of MergeChunk objects that are ready to merge
+        """
+        cfg = config.frozen().sites.prestage
+        if not cfg.enabled:
+            yield chunks
+            return
+        await self.submit(chunks)
+        ready = []
+        waiting = []
+        for chunk in chunks:
+            if self.waiting(chunk):
+                waiting.append(chunk)
+            else:
+                ready.append(chunk)
+        if ready:
+            yield ready
+        if not waiting:
+            return
+        logger.info("Waiting for %d chunks to be staged", len(waiting))
+        deadline = time.monotonic() + float(cfg.max_wait or 0) * 3600
+        delay = float(cfg.poll or 1)
+        while waiting:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning("Timed out waiting for staging, releasing %d chunks with %d files"
+                               " still on tape", len(waiting), sum(map(self.waiting, waiting)))
+                yield waiting
+                return
+            # Back off exponentially, since large stage requests can take hours
+            await asyncio.sleep(min(delay, remaining))
+            delay = min(2 * delay, float(cfg.max_poll or delay))
+            await self.poll()
+            ready = []
+            still_waiting = []
+            for chunk in waiting:
+                if self.waiting(chunk):
+                    still_waiting.append(chunk)
+                else:
+                    ready.append(chunk)
+            if ready:
+                yield ready
+            waiting = still_waiting
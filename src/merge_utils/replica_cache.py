@@ -0,0 +1,182 @@
+"""Persistent cache of replica verification results, shared between runs."""
+from __future__ import annotations
+
+import os
+import time
+import logging
+import sqlite3
+import threading
+
+from merge_utils import io_utils, config
+
+logger = logging.getLogger(__name__)
+
+# Replica statuses that come from a conclusive check of the storage system
+CACHED_STATUSES = {'ONLINE', 'NEARLINE', 'OFFLINE', 'MISSING', 'BAD_SIZE', 'BAD_CHECKSUM'}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS replicas (
+    pfn TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    checksum TEXT NOT NULL,
+    status TEXT NOT NULL,
+    latency REAL,
+    verified REAL NOT NULL,
+    PRIMARY KEY (pfn, size, checksum)
+)
+"""
+
+def checksum_key(cksums: dict) -> str:
+    """
+    Convert a dictionary of checksums to a canonical string for use as a key.
+
+    :param cksums: dict of {algorithm: checksum}, or None
+    :return: string of the form 'algo1:csum1,algo2:csum2'
+    """
+    if not cksums:
+        return ''
+    return ','.join(f"{algo}:{cksums[algo]}" for algo in sorted(cksums))
+
+class ReplicaCache:
+    """On-disk cache of replica statuses, keyed by (PFN, size, checksum)"""
+
+    def __init__(self, path: str = None):
+        """
+        Initialize the ReplicaCache.
+
+        :param path: path to the SQLite database, defaults to 'replicas.sqlite' in the cache directory
+        """
+        self.path = path
+        self.db = None
+        self.enabled = True
+        self.deferred = []
+        self.lock = threading.Lock()
+
+    def ttl(self, status: str) -> float:
+        """
+        Get how long a cached status stays valid.
+
+        :param status: name of the replica status
+        :return: time to live in seconds, or 0 if the status should not be cached
+        """
+        if status not in CACHED_STATUSES:
+            return 0
+        ttls = config.frozen().validation.cache_ttl
+        if status in ttls:
+            return float(ttls[status] or 0) * 3600
+        return float(ttls.get('default') or 0) * 3600
+
+    def connect(self) -> sqlite3.Connection:
+        """
+        Open the database on first use.
+        The connection may be used from worker threads, callers must hold the lock.
+
+        :return: database connection, or None if the cache is unavailable
+        """
+        if self.db is not None or not self.enabled:
+            return self.db
+        # Leave the database alone if caching is disabled for every status
+        max_ttl = max(self.ttl(status) for status in CACHED_STATUSES)
+        if max_ttl <= 0:
+            logger.debug("Replica cache is disabled")
+            self.enabled = False
+            return None
+        path = self.path or os.path.join(io_utils.cache_dir(), 'replicas.sqlite')
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            self.db = sqlite3.connect(path, timeout=10, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute(SCHEMA)
+            # Drop entries that have expired for every status
+            self.db.execute("DELETE FROM replicas WHERE verified < ?", (time.time() - max_ttl,))
+            self.db.commit()
+            logger.debug("Opened replica cache %s", path)
+        except (OSError, sqlite3.Error) as err:
+            logger.warning("Replica cache %s is unavailable: %s", path, err)
+            self.db = None
+            self.enabled = False
+        return self.db
+
+    def get(self, pfn: str, size: int = None, cksums: dict = None) -> tuple[str, float]:
+        """
+        Look up a recent verification result for a replica.
+        This blocks on the database, so async callers should run it in a worker thread.
+
+        :param pfn: physical file name of the replica
+        :param size: expected file size used for the check
+        :param cksums: expected checksums used for the check
+        :return: tuple of (status name, latency in ms), or None if there is no valid entry
+        """
+        with self.lock:
+            db = self.connect()
+            if db is None:
+                return None
+            try:
+                row = db.execute(
+                    "SELECT status, latency, verified FROM replicas "
+                    "WHERE pfn = ? AND size = ? AND checksum = ?",
+                    (pfn, size or 0, checksum_key(cksums))
+                ).fetchone()
+            except sqlite3.Error as err:
+                logger.debug("Replica cache lookup failed for %s: %s", pfn, err)
+                return None
+        if row is None:
+            return None
+        status, latency, verified = row
+        if time.time() - verified > self.ttl(status):
+            return None
+        return status, latency
+
+    def put(self, replica, pfn: str, size: int = None, cksums: dict = None) -> None:
+        """
+        Queue a verification result to be written on the next flush.
+        Replicas with a deferred locality check are held until their status is known.
+
+        :param replica: Replica object that was checked
+        :param pfn: physical file name the replica was checked under
+        :param size: expected file size used for the check
+        :param cksums: expected checksums used for the check
+        """
+        if not self.enabled:
+            return
+        self.deferred.append((replica, (pfn, size or 0, checksum_key(cksums))))
+
+    def flush(self) -> None:
+        """
+        Write all resolved verification results to the database in a single transaction.
+        This blocks on the database, so async callers should run it in a worker thread.
+        """
+        rows = []
+        now = time.time()
+        pending, self.deferred = self.deferred, []
+        for replica, key in pending:
+            status = replica.status.name
+            if status == 'UNKNOWN':
+                self.deferred.append((replica, key))
+            elif self.ttl(status) > 0:
+                rows.append(key + (status, replica.latency, now))
+        if not rows:
+            return
+        with self.lock:
+            db = self.connect()
+            if db is None:
+                return
+            try:
+                with db:
+                    db.executemany("INSERT OR REPLACE INTO replicas VALUES (?, ?, ?, ?, ?, ?)",
+                                   rows)
+                logger.debug("Saved %d replica checks to the cache", len(rows))
+            except sqlite3.Error as err:
+                logger.warning("Failed to update replica cache: %s", err)
+
+    def close(self) -> None:
+        """Write any remaining results and close the database"""
+        self.flush()
+        self.deferred.clear()
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+# Shared cache for all RSEs
+cache = ReplicaCache()
@@ -7,12 +7,13 @@ import logging
 import enum
 import asyncio
 import collections
-import zlib
+import time
+import math
 from dataclasses import dataclass
 from typing import AsyncGenerator
 from abc import ABC, abstractmethod
 
-from merge_utils import io_utils, config
+from merge_utils import io_utils, config, xrootd_utils, tape_utils, replica_cache, ping_utils, endpoints
 from merge_utils.merge_set import MergeSet, MergeFile, MergeFileError
 from merge_utils.retriever import MetaRetriever, InputBatch
 from merge_utils.rucio_utils import RucioWrapper
@@ -69,6 +70,72 @@ def get_path(url: str) -> str:
 
 # Utility functions for converting between local paths and xrootd URLs
 
+class PrefixTrie:
+    """Character trie of string prefixes, for longest-prefix matching of paths and URLs"""
+    # Key for the (prefix, value) pair stored at a node, cannot collide with a single character
+    END = ''
+
+    def __init__(self, items: dict = None):
+        """
+        Initialize the PrefixTrie.
+
+        :param items: optional dictionary of {prefix: value} pairs to insert
+        """
+        self.root = {}
+        for prefix, value in (items or {}).items():
+            self.insert(prefix, value)
+
+    def insert(self, prefix: str, value) -> None:
+        """
+        Add a prefix to the trie, replacing any existing value for the same prefix.
+
+        :param prefix: prefix string
+        :param value: value to return for paths matching this prefix
+        """
+        node = self.root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self.END] = (prefix, value)
+
+    def match(self, path: str) -> tuple:
+        """
+        Find the longest prefix matching the start of a path.
+
+        :param path: path or URL to match
+        :return: tuple of (prefix, value), or None if no prefix matches
+        """
+        node = self.root
+        best = node.get(self.END)
+        for char in path:
+            node = node.get(char)
+            if node is None:
+                break
+            best = node.get(self.END, best)
+        return best
+
+# Tries for the local site's xrootd mappings, rebuilt when the configuration changes
+_xrootd_tries = {'cfg': None, 'to_xrootd': None, 'to_path': None}
+
+def xrootd_tries() -> tuple[PrefixTrie, PrefixTrie]:
+    """
+    Get the tries for converting local paths to xrootd URLs and vice versa
+
+    :return: tuple of (path trie with URL prefix values, URL trie with path prefix values),
+             or (None, None) if there is no local site
+    """
+    cfg = config.frozen()
+    if _xrootd_tries['cfg'] is not cfg:
+        to_xrootd = to_path = None
+        if cfg.local.site:
+            urls = cfg.local.xrootd[cfg.local.site]
+            # If several URLs map to the same path, prefer the first listed
+            to_xrootd = PrefixTrie()
+            for url, path in reversed(urls.items()):
+                to_xrootd.insert(path, url)
+            to_path = PrefixTrie(urls)
+        _xrootd_tries.update(cfg=cfg, to_xrootd=to_xrootd, to_path=to_path)
+    return _xrootd_tries['to_xrootd'], _xrootd_tries['to_path']
+
 def path_to_xrootd(path: str) -> str:
     """
     Convert a local file path to an xrootd URL
@@ -76,14 +143,11 @@ def path_to_xrootd(path: str) -> str:
     :param path: local file path
     :return: xrootd URL corresponding to the local file path, or None if conversion fails
     """
-    if not config.local.site:
+    trie = xrootd_tries()[0]
+    match = trie.match(path) if trie else None
+    if match is None:
         return None
-    urls = config.local.xrootd[str(config.local.site)]
-    for url_prefix, path_prefix in sorted(urls.items(), key=lambda x: len(x[0]), reverse=True):
-        path_prefix = str(path_prefix)
-        if path.startswith(path_prefix):
-            return path.replace(path_prefix, url_prefix, 1)
-    return None
+    return match[1] + path[len(match[0]):]
 
 def xrootd_to_path(url: str) -> str:
     """
@@ -92,14 +156,11 @@ def xrootd_to_path(url: str) -> str:
     :param url: xrootd URL
     :return: local file path corresponding to the xrootd URL, or None if conversion fails
     """
-    if not config.local.site:
+    trie = xrootd_tries()[1]
+    match = trie.match(url) if trie else None
+    if match is None:
         return None
-    urls = config.local.xrootd[str(config.local.site)]
-    for url_prefix, path_prefix in sorted(urls.items(), key=lambda x: len(x[0]), reverse=True):
-        path_prefix = str(path_prefix)
-        if url.startswith(url_prefix):
-            return url.replace(url_prefix, path_prefix, 1)
-    return None
+    return match[1] + url[len(match[0]):]
 
 # Classes for representing file replicas and their statuses
 
@@ -121,6 +182,7 @@ class Status(enum.Enum, metaclass=StatusMeta):
     NEARLINE        = enum.auto()
     OFFLINE         = enum.auto()
     UNKNOWN         = enum.auto()
+    UNCHECKED       = enum.auto() # Presumed good, skipped after a closer replica was confirmed
     UNREACHABLE     = enum.auto()
     MISSING         = enum.auto()
     BAD_SIZE        = enum.auto()
@@ -130,7 +192,7 @@ class Status(enum.Enum, metaclass=StatusMeta):
     @property
     def good(self) -> bool:
         """Return True if this status indicates a good file replica"""
-        return self in {Status.ONLINE, Status.NEARLINE}
+        return self in {Status.ONLINE, Status.NEARLINE, Status.UNCHECKED}
 
     @property
     def bad(self) -> bool:
@@ -144,6 +206,7 @@ class Replica:
     rse: 'BaseRSE' = None
     status: Status = Status.UNREACHABLE # Assume unreachable until we can check otherwise
     distance: float = float('inf')
+    latency: float = None # Time taken to check the replica in ms
 
     @property
     def protocol(self) -> str:
@@ -165,6 +228,9 @@ class Replica:
         # If both replicas have the same status, sort by distance
         if self.distance != other.distance:
             return self.distance < other.distance
+        # Prefer verified replicas over unchecked ones at the same distance
+        if (self.status == Status.UNCHECKED) != (other.status == Status.UNCHECKED):
+            return other.status == Status.UNCHECKED
         return self.path < other.path
 
     def __str__(self) -> str:
@@ -172,6 +238,16 @@ class Replica:
             return f"{self.rse.name}: {self.status.name}"
         return f"{self.rse.name}: {self.status.name} (d = {self.distance})"
 
+# Replica statuses corresponding to tape REST API localities
+LOCALITY_STATUS = {
+    'DISK':             Status.ONLINE,
+    'DISK_AND_TAPE':    Status.ONLINE,
+    'TAPE':             Status.NEARLINE,
+    'LOST':             Status.MISSING,
+    'NONE':             Status.MISSING,
+    'UNAVAILABLE':      Status.OFFLINE,
+}
+
 # Classes for representing RSEs and checking the status of replicas on those RSEs
 
 class BaseRSE(ABC):
@@ -183,10 +259,18 @@ class BaseRSE(ABC):
         self.distance = float('inf')
         self.disk = None
         self.staging = None
+        self.tape_api = None
         self.read = True
         self.write = True
 
-    def ping(self) -> float:
+    @property
+    def hosts(self) -> set[str]:
+        """Get the set of remote hosts for this RSE"""
+        if 'file' in self.urls:
+            return set()
+        return set(get_host(url) for url in self.urls.values())
+
+    async def ping(self) -> float:
         """Get the ping time to the RSE in ms"""
         if len(self.urls) == 0:
             logger.warning("No URLs found for RSE %s, cannot ping", self.name)
@@ -195,17 +279,8 @@ class BaseRSE(ABC):
             logger.debug("RSE %s is local, skipping ping", self.name)
             return 0.0
         # Try pinging the URLs
-        best_ping = float('inf')
-        hosts = set(get_host(url) for url in self.urls.values())
-        for host in hosts:
-            cmd = ['ping', '-c', '1', host]
-            ret = subprocess.run(cmd, capture_output=True, check=False)
-            if ret.returncode != 0:
-                logger.debug("Failed to ping %s", host)
-                continue
-            ping = float(ret.stdout.split()[-2].split(b'/')[0]) # min ping time
-            logger.debug("Pinged %s, t = %.1f ms", host, ping)
-            best_ping = min(best_ping, ping)
+        rtts = await ping_utils.pings.ping(self.hosts)
+        best_ping = min(rtts.values())
         if best_ping != float('inf'):
             logger.info("Best ping to RSE %s is %.1f ms", self.name, best_ping)
             return best_ping
@@ -213,6 +288,71 @@ class BaseRSE(ABC):
         logger.warning("Failed to ping any URLs for RSE %s", self.name)
         return float('inf')
 
+    @staticmethod
+    def xrootd_server(replica: Replica) -> tuple[str, str]:
+        """
+        Split a replica xrootd URL into the server URL and the path on that server
+
+        :param replica: Replica object with an xrootd path
+        :return: tuple of (server URL, path)
+        """
+        protocol = replica.protocol
+        if protocol != 'root':
+            raise ValueError(f"Unsupported protocol for xrdfs: {protocol}")
+        host = get_host(replica.path)
+        port = get_port(replica.path)
+        return f"{protocol}://{host}:{port}", get_path(replica.path)
+
+    async def xrootd_stat(self, replica: Replica, timeout: float = 1) -> xrootd_utils.StatInfo:
+        """
+        Get the size and permissions of a remote file, over a persistent session if the
+        XRootD bindings are available or with xrdfs otherwise.
+        In case of failure, set the replica status accordingly and return None
+
+        :param replica: Replica object to check
+        :param timeout: timeout in seconds
+        :return: StatInfo for the file, or None if it failed
+        :raises EndpointError: if the server did not respond
+        """
+        if not xrootd_utils.sessions.available:
+            ls = await self.xrdfs(replica, 'ls -l', timeout)
+            if ls is None:
+                return None
+            ls_perm, _, _, ls_size, _ = ls.split() # permissions, date, time, size, name
+            return xrootd_utils.StatInfo(size=int(ls_size), readable=ls_perm[1] == 'r')
+        server, path = self.xrootd_server(replica)
+        try:
+            return await xrootd_utils.sessions.stat(server, path, timeout)
+        except xrootd_utils.XRootDError as err:
+            if err.transport:
+                raise endpoints.EndpointError(str(err)) from err
+            logger.debug("%s", err)
+            replica.status = Status.MISSING if err.missing else Status.UNREACHABLE
+            return None
+
+    async def xrootd_checksums(self, replica: Replica, timeout: float = 1) -> str:
+        """
+        Query the checksums of a remote file, over a persistent session if the
+        XRootD bindings are available or with xrdfs otherwise.
+        In case of failure, set the replica status accordingly and return None
+
+        :param replica: Replica object to check
+        :param timeout: timeout in seconds
+        :return: lines of 'algorithm checksum' pairs, or None if it failed
+        :raises EndpointError: if the server did not respond
+        """
+        if not xrootd_utils.sessions.available:
+            return await self.xrdfs(replica, 'query checksum', timeout)
+        server, path = self.xrootd_server(replica)
+        try:
+            return await xrootd_utils.sessions.checksum(server, path, timeout)
+        except xrootd_utils.XRootDError as err:
+            if err.transport:
+                raise endpoints.EndpointError(str(err)) from err
+            logger.debug("%s", err)
+            replica.status = Status.MISSING if err.missing else Status.UNREACHABLE
+            return None
+
     async def xrdfs(self, replica: Replica, cmd: str, timeout: float = 1) -> str:
         """
         Run an xrdfs command on a replica and return the output
@@ -222,46 +362,39 @@ class BaseRSE(ABC):
         :param cmd: xrdfs command to run (e.g. 'ls -l')
         :param timeout: timeout for the xrdfs command in seconds
         :return: stdout of the xrdfs command, or None if it failed
+        :raises EndpointError: if the server did not respond
         """
-        protocol = replica.protocol
-        if protocol != 'root':
-            raise ValueError(f"Unsupported protocol for xrdfs: {protocol}")
-        host = get_host(replica.path)
-        port = get_port(replica.path)
-        path = get_path(replica.path)
-        url = f"{protocol}://{host}:{port}"
+        url, path = self.xrootd_server(replica)
+        host = get_host(url)
         full_cmd = ['xrdfs', url] + cmd.split() + [path]
         try:
-            ret = await asyncio.to_thread(subprocess.run, full_cmd, capture_output=True,
-                                          text=True, check=False, timeout=timeout)
-        except subprocess.TimeoutExpired:
-            logger.debug("Timeout accessing xrootd server %s", host)
-            replica.status = Status.UNREACHABLE
-            return None
+            ret = await io_utils.run_cmd(full_cmd, timeout=timeout)
+        except subprocess.TimeoutExpired as err:
+            raise endpoints.EndpointError(f"Timeout accessing xrootd server {host}") from err
         if ret.returncode != 0:
             replica.status = Status.UNREACHABLE
-            if ret.returncode == 51:
-                logger.debug("Invalid xrootd server %s", host)
-            elif ret.returncode == 52:
+            if ret.returncode == 52:
                 logger.debug("Auth failed for xrootd server %s", host)
             elif ret.returncode == 54:
                 logger.debug("No such file %s", replica.path)
                 replica.status = Status.MISSING
-            elif ret.returncode != 0:
-                logger.debug("Failed to access %s\n  %s", replica.path, ret.stderr.strip())
+            else:
+                raise endpoints.EndpointError(
+                    f"Failed to access {replica.path}\n  {ret.stderr.strip()}")
             return None
         return ret.stdout.strip()
 
-    async def checksum_xrootd(self, replica: Replica, cksums: dict) -> bool:
+    async def checksum_xrootd(self, replica: Replica, cksums: dict, timeout: float = 1) -> bool:
         """
         Check the checksums of a remote file against expected values
         
         :param replica: Replica object to check
         :param cksums: dict of {algorithm: expected_checksum} pairs to check against
+        :param timeout: timeout in seconds
         :return: True if any matching checksums are found, False otherwise
         """
         logger.debug("RSE %s Checking xrootd checksums for file %s", self.name, replica.path)
-        xrdfs_cksums = await self.xrdfs(replica, 'query checksum')
+        xrdfs_cksums = await self.xrootd_checksums(replica, timeout)
         if xrdfs_cksums is None:
             logger.warning("Failed to get checksums for file %s", replica.path)
             return False
@@ -283,53 +416,31 @@ class BaseRSE(ABC):
         logger.warning("Checksum failed for file %s", replica.path)
         return False
 
-    async def checksum_adler32(self, filename: str, chunk_size=8192) -> str:
-        """Calculate the Adler-32 checksum of a file, working in chunks"""
-        checksum = 1  # Adler-32 state must be initialized to 1 (not 0)
-        with open(filename, "rb") as f:
-            while chunk := f.read(chunk_size):
-                checksum = zlib.adler32(chunk, checksum)
-        return "%08x" % checksum
-
     async def checksum_local(self, path: str, cksums: dict) -> bool:
         """
-        Check the checksums of a local file against expected values
+        Check the checksums of a local file against expected values.
+        All algorithms are calculated in a single pass over the file in a worker thread.
         
         :param path: path to the local file
         :param cksums: dict of {algorithm: expected_checksum} pairs to check against
         :return: True if any matching checksums are found, False otherwise
         """
         logger.debug("RSE %s Checking local checksums for file %s", self.name, path)
-        algorithms = [
-            ('adler32', 'xrdadler32'),
-            ('md5', 'md5sum'),
-            ('sha256', 'sha256sum'),
-            ('sha512', 'sha512sum')
-        ]
-        # Check known algorithms
-        for algo, cmd in algorithms:
-            if algo not in cksums:
-                continue
-            expected = cksums[algo]
-            if algo == 'adler32':
-                actual = await self.checksum_adler32(path)
-            else:
-                ret = await asyncio.to_thread(subprocess.run, [cmd, path],
-                                                capture_output=True, text=True, check=False)
-                if ret.returncode != 0:
-                    logger.debug("Failed to run %s for file %s: %s", cmd, path, ret.stderr.strip())
-                    continue
-                actual = ret.stdout.strip().split()[0]
-            if actual == expected:
-                return True
+        try:
+            actual = await asyncio.to_thread(io_utils.checksums, path, cksums.keys())
+        except OSError as err:
+            logger.warning("Failed to read file %s: %s", path, err)
+            return False
+        # Any matching checksum is enough, as with the per-algorithm tools used before
+        if any(csum == cksums[algo] for algo, csum in actual.items()):
+            return True
+        for algo, csum in actual.items():
             logger.warning("File %s has bad %s checksum: %s != %s",
-                            path, algo, actual, expected)
+                            path, algo, csum, cksums[algo])
+        if actual:
             return False
         # Failed to verify any checksums
-        checked = set(a[0] for a in algorithms)
-        unchecked = set(cksums.keys()) - checked
-        if unchecked:
-            logger.debug("Missing commands for checksum algorithms: %s", ', '.join(unchecked))
+        logger.debug("Unsupported checksum algorithms: %s", ', '.join(cksums.keys()))
         logger.warning("Checksum failed for file %s", path)
         return False
 
@@ -338,18 +449,18 @@ class BaseRSE(ABC):
         Check if a replica is online or nearline by using gfal-xattr to query user.status
 
         :param replica: Replica object to check
+        :param timeout: timeout in seconds
         """
         logger.debug("RSE %s Checking xrootd cache status for file %s", self.name, replica.path)
         # Skip cache check if the distance is already too high
-        if replica.distance > config.sites.max_distance:
+        if replica.distance > config.frozen().sites.max_distance:
             replica.status = Status.UNREACHABLE
             return
         # Assume nearline unless we can confirm it is online
         replica.status = Status.NEARLINE
-        cmd = ['gfal-xattr', '-t', int(timeout), replica.path, 'user.status']
+        cmd = ['gfal-xattr', '-t', str(max(1, math.ceil(timeout))), replica.path, 'user.status']
         try:
-            ret = await asyncio.to_thread(subprocess.run, cmd, capture_output=True,
-                                          text=True, check=False, timeout=timeout+1)
+            ret = await io_utils.run_cmd(cmd, timeout=timeout+1)
         except subprocess.TimeoutExpired:
             logger.debug("Timeout running gfal-xattr on %s", replica.path)
             return
@@ -381,11 +492,12 @@ class BaseRSE(ABC):
             status = stats.readline().strip()
         replica.status = Status[status]
 
-    async def check_cache(self, replica: Replica) -> None:
+    async def check_cache(self, replica: Replica, timeout: float = 1) -> None:
         """
         Check if a replica is online or nearline using the appropriate method
 
         :param replica: Replica object to check
+        :param timeout: timeout for remote queries in seconds
         """
         logger.debug("RSE %s Checking cache status for file %s", self.name, replica.path)
         # For non-dcache RSEs, set status to ONLINE or NEARLINE depending on tape vs disk type
@@ -400,13 +512,42 @@ class BaseRSE(ABC):
         if replica.protocol == 'file':
             logger.debug("RSE %s checking local cache for file %s", self.name, replica.path)
             await asyncio.to_thread(self.cache_local, replica)
+        elif self.tape_api:
+            # Leave the status unknown until the bulk locality query in check_locality
+            logger.debug("RSE %s deferring cache check for file %s", self.name, replica.path)
+            replica.status = Status.UNKNOWN
+            return
         else:
             logger.debug("RSE %s checking xrootd cache for file %s", self.name, replica.path)
-            await self.cache_xrootd(replica)
+            await self.cache_xrootd(replica, timeout)
         # If the file is not online, add the staging penalty to the distance
         if replica.status != Status.ONLINE:
             replica.distance += self.staging
 
+    async def check_locality(self, replicas: list[Replica]) -> None:
+        """
+        Check if a list of replicas are online or nearline with a bulk tape REST API query
+
+        :param replicas: list of Replica objects with deferred cache checks
+        """
+        paths = collections.defaultdict(list)
+        for replica in replicas:
+            paths[get_path(replica.path)].append(replica)
+        logger.debug("RSE %s checking locality for %d files", self.name, len(paths))
+        try:
+            localities = await tape_utils.archive_info(self.tape_api, list(paths))
+        except tape_utils.TapeAPIError as err:
+            logger.warning("Bulk locality query for RSE %s failed, assuming NEARLINE:\n  %s",
+                           self.name, err)
+            localities = {}
+        for path, path_replicas in paths.items():
+            status = LOCALITY_STATUS.get(localities.get(path), Status.NEARLINE)
+            for replica in path_replicas:
+                replica.status = status
+                # If the file is not online, add the staging penalty to the distance
+                if status != Status.ONLINE:
+                    replica.distance += self.staging
+
     async def check_local(self, replica: Replica, size: int = None, cksums: dict = None):
         """
         Check the status of a local file replica
@@ -432,63 +573,142 @@ class BaseRSE(ABC):
         # Check the cache status of the file
         await self.check_cache(replica)
 
-    async def check_xrootd(self, replica: Replica, size: int = None, cksums: dict = None):
+    async def check_xrootd(self, replica: Replica, size: int = None, cksums: dict = None,
+                           timeout: float = 1):
         """
         Check the status of a remote file replica accessed via xrootd
 
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :param timeout: timeout for each storage request in seconds
         """
         # If we have an expected size, make sure the file exists and matches that size
         if size:
-            ls = await self.xrdfs(replica, 'ls -l')
-            if ls is None:
+            info = await self.xrootd_stat(replica, timeout)
+            if info is None:
                 return
-            ls_perm, _, _, ls_size, _ = ls.split() # permissions, date, time, size, name
             # Make sure the file is readable
-            if ls_perm[1] != 'r':
+            if not info.readable:
                 logger.debug("File %s is not readable", replica.path)
                 return
             # Check the size
-            if ls_size != size:
+            if info.size != size:
                 replica.status = Status.BAD_SIZE
                 return
             # Check the checksums, if we have expected values
-            if cksums and not await self.checksum_xrootd(replica, cksums):
+            if cksums and not await self.checksum_xrootd(replica, cksums, timeout):
                 replica.status = Status.BAD_CHECKSUM
                 return
         # Check the cache status of the file
-        await self.check_cache(replica)
+        await self.check_cache(replica, timeout)
+
+    async def check_cached(self, replica: Replica, size: int = None, cksums: dict = None) -> bool:
+        """
+        Set the status of a replica from a recent verification result, if there is one
+
+        :param replica: Replica object to check
+        :param size: expected file size used for the check
+        :param cksums: expected checksums used for the check
+        :return: True if a valid cached result was found
+        """
+        if not replica_cache.cache.enabled:
+            return False
+        cached = await asyncio.to_thread(replica_cache.cache.get, replica.path, size, cksums)
+        if cached is None:
+            return False
+        logger.debug("RSE %s using cached status %s for replica %s",
+                     self.name, cached[0], replica.path)
+        replica.status = Status[cached[0]]
+        replica.latency = cached[1]
+        # If the file is not online, add the staging penalty to the distance
+        if replica.status == Status.NEARLINE and self.staging:
+            replica.distance += self.staging
+        return True
+
+    def presume(self, replica: Replica) -> None:
+        """
+        Set the status of a replica that will not be checked, because a closer replica
+        of the same file was confirmed. It stays available as a fallback, with the
+        staging penalty added in case the file is only on tape.
 
-    async def check(self, replica: Replica, size: int = None, cksums: dict = None):
+        :param replica: Replica object to set the status of
         """
-        Check the status of a file replica on the RSE
+        replica.distance = self.distance
+        if self.distance > config.frozen().sites.max_distance:
+            replica.status = Status.UNREACHABLE
+        elif self.read is False:
+            replica.status = Status.OFFLINE
+        else:
+            replica.status = Status.UNCHECKED
+            replica.distance += self.staging or 0
+
+    async def check(self, replica: Replica, size: int = None, cksums: dict = None) -> bool:
+        """
+        Check the status of a file replica on the RSE, reusing recent results from
+        the replica cache where possible
 
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :return: True if the replica status was set, False if the check was deferred
+                 because the endpoint's circuit breaker is open
         """
         logger.debug("RSE %s checking replica %s", self.name, replica.path)
         replica.distance = self.distance
         # Don't bother checking bad RSEs
-        if self.distance > config.sites.max_distance:
+        if self.distance > config.frozen().sites.max_distance:
             logger.debug("RSE %s is too far away (d = %d)", self.name, self.distance)
             replica.status = Status.UNREACHABLE
-            return
+            return True
         if self.read is False:
             logger.debug("RSE %s is not readable", self.name)
             replica.status = Status.OFFLINE
-            return
+            return True
+        # Only touch the storage system if we don't have a recent result
+        pfn = replica.path
+        if not await self.check_cached(replica, size=size, cksums=cksums):
+            # Defer replicas on endpoints that are failing hard, so they can be retried later
+            key = (self.name, get_host(pfn))
+            if not endpoints.health.allow(key):
+                logger.debug("RSE %s is failing at %s, deferring replica %s",
+                             self.name, key[1], pfn)
+                return False
+            responded = False
+            start = time.perf_counter()
+            try:
+                await self.verify(replica, size=size, cksums=cksums,
+                                  timeout=endpoints.health.timeout(key))
+                responded = True
+            except endpoints.EndpointError as err:
+                logger.debug("RSE %s did not respond for replica %s: %s", self.name, pfn, err)
+                replica.status = Status.UNREACHABLE
+            finally:
+                replica.latency = 1000 * (time.perf_counter() - start)
+                endpoints.health.record(key, responded, replica.latency)
+            replica_cache.cache.put(replica, pfn, size=size, cksums=cksums)
+        # For local files, try to convert to xrootd URL if possible
+        if replica.protocol == 'file' and 'xrootd' in self.urls:
+            replica.path = replica.path.replace(self.urls['file'], self.urls['xrootd'], 1)
+        return True
+
+    async def verify(self, replica: Replica, size: int = None, cksums: dict = None,
+                     timeout: float = 1):
+        """
+        Check the status of a file replica on the storage system
+
+        :param replica: Replica object to check
+        :param size: optionally check the file size against an expected value
+        :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        :param timeout: timeout for each remote storage request in seconds
+        :raises EndpointError: if the storage system did not respond
+        """
         # Check replica using the appropriate method based on the protocol
         protocol = replica.protocol
-        # For local files, check directly but try to convert to xrootd URL if possible
+        # For local files, check directly
         if protocol == 'file':
             logger.debug("RSE %s checking local replica %s", self.name, replica.path)
             await self.check_local(replica, size=size, cksums=cksums)
-            print("finished local check")
-            if 'xrootd' in self.urls:
-                replica.path = replica.path.replace(self.urls['file'], self.urls['xrootd'], 1)
             return
         # For local RSEs, get local path and check directly
         if 'file' in self.urls:
@@ -501,7 +721,7 @@ class BaseRSE(ABC):
         # For xrootd files, check using xrdfs and gfal-xattr
         if protocol == 'root':
             logger.debug("RSE %s checking xrootd replica %s", self.name, replica.path)
-            await self.check_xrootd(replica, size=size, cksums=cksums)
+            await self.check_xrootd(replica, size=size, cksums=cksums, timeout=timeout)
             return
         # If we get here, we don't know how to check this replica
         logger.debug("Unsupported protocol %s for replica %s", protocol, replica.path)
@@ -520,6 +740,7 @@ class GenericRSE(BaseRSE):
             if name in config.sites.dcache:
                 url = str(config.sites.dcache[name]['url'])
                 self.staging = float(config.sites.dcache[name]['staging'])
+                self.tape_api = config.sites.dcache[name]['tape_api'].value
             if not url:
                 raise ValueError(f"No URL found for RSE {name} in config")
         elif not url:
@@ -562,8 +783,10 @@ class GenericRSE(BaseRSE):
             self.distance = float(config.sites.rse_distances['disk'])
             if self.staging is None:
                 self.staging = float(config.sites.rse_distances['tape']) - self.distance
-        # Add ping time to the distance
-        self.distance += self.ping()
+
+    async def add_ping(self) -> None:
+        """Add the ping time to the distance, once the RSE has been created"""
+        self.distance += await self.ping()
 
 class RucioRSE(BaseRSE):
     """Class to store information about a Rucio RSE"""
@@ -576,6 +799,7 @@ class RucioRSE(BaseRSE):
         self.write = info['availability_write'] and not info.get('deleted', False)
         if self.name in config.sites.dcache:
             self.staging = float(config.sites.dcache[self.name]['staging'])
+            self.tape_api = config.sites.dcache[self.name]['tape_api'].value
             logger.debug("RSE %s is dcache with staging penalty %.0f", self.name, self.staging)
             self.disk = True
         elif info['rse_type'] == 'DISK':
@@ -630,6 +854,14 @@ class PathFinder(MetaRetriever):
         self.rses = {}
         self.replica_queue = None
         self.workers = []
+        self.pending = {}
+        self.candidates = {}
+        self.held = {} # {did: [replicas deferred by an open circuit breaker]}
+        self.deferred = {} # {endpoint key: [(file, replica, size, cksums)]}
+        self.retried = set()
+        self.retries = {} # {endpoint key: retry task}
+        self.resolved = None
+        self.slots = None
 
     @property
     def files(self) -> MergeSet:
@@ -639,31 +871,266 @@ class PathFinder(MetaRetriever):
     async def replica_checker(self) -> None:
         """Asynchronous worker method to check the status of replicas from the replica queue"""
         while True:
-            # Wait for a replica to check from the queue
+            # Wait for a replica to check from an endpoint with free capacity
             job = await self.replica_queue.get()
-            # If we get a None job, it means we should stop the checker
+            # If we get a None job, it means the queue was closed
             if job is None:
-                self.replica_queue.task_done()
                 break
             # Check the replica and mark the job as done
-            await job[0].rse.check(job[0], size=job[1], cksums=job[2])
-            self.replica_queue.task_done()
-
-    async def check_replica(self, replica: Replica, size: int = None, cksums: dict = None) -> None:
+            key, (file, replica, size, cksums) = job
+            deferred = False
+            try:
+                deferred = not await replica.rse.check(replica, size=size, cksums=cksums)
+            finally:
+                # Queue any follow-up check before marking this one done, so join() can't
+                # return while the file still has replicas to check
+                if deferred:
+                    await self.defer(key, file, replica, size, cksums)
+                else:
+                    await self.replica_checked(file, replica)
+                await self.replica_queue.done(key)
+
+    async def check_replica(self, file: MergeFile, replica: Replica, size: int = None,
+                            cksums: dict = None) -> None:
         """
         Add a replica to the replica queue for asynchronous checking
 
+        :param file: MergeFile object the replica belongs to
+        :param replica: Replica object to check
+        :param size: optionally check the file size against an expected value
+        :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        """
+        entry = self.pending.get(file.did)
+        if entry is not None:
+            entry[0] += 1
+            # Hold the replica back until we know the file's other replicas
+            if config.frozen().validation.short_circuit.distance is not None:
+                self.candidates.setdefault(file.did, []).append((replica, size, cksums))
+                return
+        await self.queue_check(file, replica, size, cksums)
+
+    async def queue_check(self, file: MergeFile, replica: Replica, size: int = None,
+                          cksums: dict = None) -> None:
+        """
+        Put a replica on the replica queue
+
+        :param file: MergeFile object the replica belongs to
         :param replica: Replica object to check
         :param size: optionally check the file size against an expected value
         :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
         """
         logger.debug("Queueing replica %s on RSE %s for checking", replica.path, replica.rse.name)
-        await self.replica_queue.put((replica, size, cksums))
+        key = (replica.rse.name, get_host(replica.path))
+        await self.replica_queue.put(key, (file, replica, size, cksums))
+
+    async def next_check(self, file: MergeFile, candidates: list) -> None:
+        """
+        Queue the next replica of a file for short-circuit evaluation, taking the nearest
+        replica on an endpoint that is not currently being skipped by its circuit breaker.
+
+        :param file: MergeFile object the replicas belong to
+        :param candidates: list of (replica, size, cksums) tuples that have not been checked
+        """
+        # Sort so that the best candidate is at the end of the list
+        candidates.sort(key=lambda c: (
+            endpoints.health.is_open((c[0].rse.name, get_host(c[0].path))), c[0].rse.distance
+        ), reverse=True)
+        await self.queue_check(file, *candidates.pop())
+
+    async def start_checks(self, file: MergeFile) -> None:
+        """
+        Start checking the replicas of a file that were held back for short-circuit
+        evaluation, beginning with the replica at the nearest RSE.
+
+        :param file: MergeFile object whose replicas have all been added
+        """
+        candidates = self.candidates.get(file.did)
+        if not candidates:
+            return
+        await self.next_check(file, candidates)
+
+    @staticmethod
+    def confirmed(replica: Replica) -> bool:
+        """
+        Check if a replica is close enough that the file's other replicas can be skipped
+
+        :param replica: Replica object that has been checked
+        :return: True if the replica is within the short-circuit thresholds
+        """
+        cfg = config.frozen().validation.short_circuit
+        if not replica.status.good or replica.distance > cfg.distance:
+            return False
+        return replica.status == Status.ONLINE or cfg.status == 'NEARLINE'
+
+    async def replica_checked(self, file: MergeFile, replica: Replica) -> None:
+        """
+        Record that one replica check for a file has finished, and release the file
+        downstream once all of its replicas are resolved. In short-circuit mode, either
+        check the next nearest replica or skip the rest if this one is good enough.
+
+        :param file: MergeFile object the replica belongs to
+        :param replica: Replica object that has been checked
+        """
+        entry = self.pending.get(file.did)
+        if entry is None:
+            return
+        # A deferred replica that was retried is not part of the short-circuit sequence
+        retried = self.unhold(file, replica)
+        candidates = self.candidates.get(file.did)
+        if candidates:
+            if not self.confirmed(replica):
+                entry[0] -= 1
+                if not retried:
+                    await self.next_check(file, candidates)
+                return
+            logger.debug("Skipping %d more distant replicas of %s", len(candidates), file.did)
+            for skipped, _, _ in candidates:
+                skipped.rse.presume(skipped)
+            entry[0] -= len(candidates)
+        self.candidates.pop(file.did, None)
+        entry[0] -= 1
+        self.settle(file)
+
+    def unhold(self, file: MergeFile, replica: Replica) -> bool:
+        """
+        Stop holding back a deferred replica once it has been checked.
+
+        :param file: MergeFile object the replica belongs to
+        :param replica: Replica object that has been checked
+        :return: True if the replica had been deferred
+        """
+        held = self.held.get(file.did)
+        if not held or not any(r is replica for r in held):
+            return False
+        held.remove(replica)
+        self.retried.discard(id(replica))
+        if not held:
+            del self.held[file.did]
+        return True
+
+    async def defer(self, key: tuple[str, str], file: MergeFile, replica: Replica,
+                    size: int = None, cksums: dict = None) -> None:
+        """
+        Hold back a replica on an endpoint whose circuit breaker is open, and queue it again
+        once the endpoint is re-tested. The file's other replicas are checked in the meantime,
+        and if none of them are good the file waits for this one. A replica that has already
+        been retried is marked UNREACHABLE if the endpoint failed its re-test.
+
+        :param key: tuple of (RSE name, host name) for the replica's endpoint
+        :param file: MergeFile object the replica belongs to
+        :param replica: Replica object that was not checked
+        :param size: optionally check the file size against an expected value
+        :param cksums: optionally check the file checksums against a dict of {algorithm: checksum}
+        """
+        entry = self.pending.get(file.did)
+        if entry is None:
+            return
+        if id(replica) in self.retried and endpoints.health.state(key) == endpoints.OPEN:
+            logger.debug("RSE %s is still failing at %s, giving up on replica %s",
+                         key[0], key[1], replica.path)
+            replica.status = Status.UNREACHABLE
+            await self.replica_checked(file, replica)
+            return
+        held = self.held.setdefault(file.did, [])
+        retried = any(r is replica for r in held)
+        if not retried:
+            held.append(replica)
+        waiting = self.deferred.setdefault(key, [])
+        waiting.append((file, replica, size, cksums))
+        if len(waiting) == 1:
+            task = asyncio.create_task(self.retry(key))
+            self.retries[key] = task
+            task.add_done_callback(
+                lambda t: self.retries.pop(key) if self.retries.get(key) is t else None
+            )
+        # In short-circuit mode, move on to the next candidate in the meantime
+        candidates = self.candidates.get(file.did)
+        if candidates and not retried:
+            await self.next_check(file, candidates)
+            return
+        self.settle(file)
+
+    async def retry(self, key: tuple[str, str]) -> None:
+        """
+        Queue the deferred replicas on an endpoint again once its circuit breaker
+        lets requests through, skipping files that were resolved in the meantime.
+
+        :param key: tuple of (RSE name, host name) for the endpoint
+        """
+        await asyncio.sleep(endpoints.health.retry_in(key))
+        for file, replica, size, cksums in self.deferred.pop(key, []):
+            held = self.held.get(file.did)
+            if not held or not any(r is replica for r in held):
+                continue
+            self.retried.add(id(replica))
+            await self.queue_check(file, replica, size, cksums)
+
+    def settle(self, file: MergeFile) -> None:
+        """
+        Release a file once all of its replicas have been added and resolved, apart from
+        any deferred replicas. Deferred replicas are only waited for if the file has no
+        good replicas elsewhere, otherwise they are marked UNREACHABLE.
+
+        :param file: MergeFile object to check
+        """
+        entry = self.pending.get(file.did)
+        if entry is None or not entry[1]:
+            return
+        held = self.held.get(file.did, [])
+        if entry[0] > len(held):
+            return
+        if held:
+            if not any(replica.status.good for replica in file.replicas):
+                return
+            logger.debug("Skipping %d replicas of %s on failing endpoints", len(held), file.did)
+            for replica in held:
+                replica.status = Status.UNREACHABLE
+                self.retried.discard(id(replica))
+            del self.held[file.did]
+            self.cancel_retries()
+        self.release(file)
+
+    def cancel_retries(self) -> None:
+        """Stop waiting to retry endpoints that no longer have any deferred replicas"""
+        for key, waiting in list(self.deferred.items()):
+            if any(r is replica for file, replica, _, _ in waiting
+                   for r in self.held.get(file.did, [])):
+                continue
+            del self.deferred[key]
+            task = self.retries.get(key)
+            if task is not None:
+                task.cancel()
+
+    def paths_done(self, batch: InputBatch) -> None:
+        """
+        Record that all replicas for a batch of files have been queued, releasing
+        any files with no replica checks still in flight.
+
+        :param batch: InputBatch object whose paths have been set
+        """
+        for file in batch.files:
+            entry = self.pending.get(file.did)
+            if entry is None:
+                continue
+            entry[1] = True
+            self.settle(file)
+
+    def release(self, file: MergeFile) -> None:
+        """
+        Pass a file with resolved replicas to the output stage.
+
+        :param file: MergeFile object to release
+        """
+        del self.pending[file.did]
+        self.resolved.put_nowait(file)
 
     async def connect(self) -> None:
         """Connect to the file source and rucio"""
         await asyncio.gather(self.meta.connect(), self.client.connect())
-        self.replica_queue = asyncio.Queue()
+        self.replica_queue = endpoints.EndpointQueue(
+            rse_limit=int(config.validation.rse_concurrency or 0),
+            host_limit=int(config.validation.host_concurrency or 0)
+        )
         for _ in range(int(config.validation.concurrency)):
             worker = asyncio.create_task(self.replica_checker())
             self.workers.append(worker)
@@ -672,13 +1139,31 @@ class PathFinder(MetaRetriever):
         """Disconnect from the file source and rucio, and stop the replica checkers"""
         await asyncio.gather(self.meta.disconnect(), self.client.disconnect())
         # Stop the replica checkers
-        for _ in self.workers:
-            await self.replica_queue.put(None)
+        await self.replica_queue.close()
         await asyncio.gather(*self.workers)
+        xrootd_utils.sessions.close()
+        await asyncio.to_thread(replica_cache.cache.close)
+        endpoints.health.summary()
 
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
         raise NotImplementedError("PathFinder does not implement get_metadata")
 
+    async def check_locality(self, files: list[MergeFile]) -> None:
+        """
+        Resolve deferred cache checks for a batch of files, grouping the replicas
+        by RSE and host so that each group needs a single bulk locality query
+
+        :param files: list of MergeFile objects to check
+        """
+        groups = collections.defaultdict(list)
+        for file in files:
+            for replica in file.replicas:
+                if replica.status == Status.UNKNOWN and replica.rse.tape_api:
+                    groups[(replica.rse, get_host(replica.path))].append(replica)
+        if not groups:
+            return
+        await asyncio.gather(*[rse.check_locality(reps) for (rse, _), reps in groups.items()])
+
     @abstractmethod
     async def add_replica(self, file: MergeFile, path: str, rse_name: str = None) -> None:
         """
@@ -709,44 +1194,87 @@ class PathFinder(MetaRetriever):
         """
         # process files to find paths
 
-    async def input_batches(self) -> AsyncGenerator[InputBatch, None]:
+    async def add_batches(self) -> None:
         """
-        Asynchronously retrieve paths for the next batch of files.
-
-        :return: InputBatch object containing skip index and list of MergeFile objects
+        Retrieve paths for each batch of files from the metadata source and queue their
+        replicas for checking. Waits for free slots before starting each batch, so that
+        the number of files in flight stays bounded.
         """
         batch = None
         task = None
-        async for new_batch in self.meta.input_batches():
-            # Get paths for previous batch, if we have a request in flight
-            paths = await task if task is not None else None
-            task = None
-            # Start request for next batch
-            if new_batch:
-                task = asyncio.create_task(self.get_batch(self.get_paths, new_batch))
-            # Process previous batch while we wait, if we have one
-            if batch:
-                logger.info("Processing new %s input batch %d", self.name, batch.skip)
-                await self.set_paths(batch, paths.files)
-                # Wait for any pending path checks to finish before yielding the batch
+        try:
+            async for new_batch in self.meta.input_batches():
+                # Get paths for previous batch, if we have a request in flight
+                paths = await task if task is not None else None
+                task = None
+                # Queue replica checks for the previous batch
+                if batch:
+                    logger.info("Processing new %s input batch %d", self.name, batch.skip)
+                    await self.set_paths(batch, paths.files)
+                    self.paths_done(batch)
+                # Wait for space in the pipeline, then start request for next batch
+                for file in new_batch:
+                    await self.slots.acquire()
+                    self.pending[file.did] = [0, False]
+                if new_batch:
+                    task = asyncio.create_task(self.get_batch(self.get_paths, new_batch))
+                # Save new batch for processing in the next iteration
+                batch = new_batch
+            # Wait for any stragglers before signalling completion, including deferred
+            # replicas that are waiting for their endpoints to be re-tested
+            await self.replica_queue.join()
+            while self.retries:
+                await asyncio.gather(*self.retries.values(), return_exceptions=True)
                 await self.replica_queue.join()
-                # Check for replica errors
-                good_files = []
-                no_replicas = []
-                unreachable = []
-                for file in batch:
-                    if not file.replicas:
-                        no_replicas.append(file.did)
-                    elif all(r.status.bad for r in file.replicas):
-                        unreachable.append(file.did)
-                    elif not file.errors:
-                        good_files.append(file)
-                self.files.set_error(no_replicas, MergeFileError.NO_REPLICAS)
-                self.files.set_error(unreachable, MergeFileError.UNREACHABLE)
-                if good_files:
-                    yield InputBatch(skip=batch.skip, files=good_files)
-            # Save new batch for processing in the next iteration
-            batch = new_batch
+        finally:
+            self.resolved.put_nowait(None)
+
+    async def input_batches(self) -> AsyncGenerator[InputBatch, None]:
+        """
+        Asynchronously yield batches of files as soon as all of their replicas are
+        resolved, without waiting for the rest of the input batch they came from.
+
+        :return: InputBatch object containing skip index and list of MergeFile objects
+        """
+        step = int(config.validation.batch_size)
+        self.resolved = asyncio.Queue()
+        self.slots = asyncio.Semaphore(max(step, int(config.validation.max_pending or 0)))
+        producer = asyncio.create_task(self.add_batches())
+        skip = int(config.input.skip or 0)
+        done = False
+        while not done:
+            # Wait for at least one file, then take whatever else is ready
+            file = await self.resolved.get()
+            files = []
+            while file is not None:
+                files.append(file)
+                if len(files) >= step or self.resolved.empty():
+                    break
+                file = self.resolved.get_nowait()
+            done = file is None
+            if not files:
+                continue
+            await self.check_locality(files)
+            await asyncio.to_thread(replica_cache.cache.flush)
+            # Check for replica errors
+            good_files = []
+            no_replicas = []
+            unreachable = []
+            for file in files:
+                self.slots.release()
+                if not file.replicas:
+                    no_replicas.append(file.did)
+                elif all(r.status.bad for r in file.replicas):
+                    unreachable.append(file.did)
+                elif not file.errors:
+                    good_files.append(file)
+            self.files.set_error(no_replicas, MergeFileError.NO_REPLICAS)
+            self.files.set_error(unreachable, MergeFileError.UNREACHABLE)
+            if good_files:
+                yield InputBatch(skip=skip, files=good_files)
+            skip += len(files)
+        # Raise any errors from retrieving the paths
+        await producer
         # Yield empty batch to signal completion
         yield InputBatch()
 
@@ -755,6 +1283,10 @@ class RucioFinder (PathFinder):
     """Class for managing asynchronous queries to the Rucio web API."""
     name: str = "rucio"
 
+    def __init__(self, meta: MetaRetriever):
+        super().__init__(meta)
+        self.streamed = set()
+
     async def connect(self) -> None:
         """Connect to the file source and rucio"""
         await super().connect()
@@ -783,8 +1315,8 @@ class RucioFinder (PathFinder):
         replica = Replica(path=path, rse=rse)
         file.replicas.append(replica)
         # Assume Rucio has already validated replica size and checksums
-        #await self.check_replica(replica, size=file.size, cksums=file.checksums)
-        await self.check_replica(replica)
+        #await self.check_replica(file, replica, size=file.size, cksums=file.checksums)
+        await self.check_replica(file, replica)
 
     async def checksum(self, file: MergeFile, rucio: dict) -> bool:
         """
@@ -794,25 +1326,24 @@ class RucioFinder (PathFinder):
         :param rucio: Rucio replicas dictionary
         :return: True if files match, False otherwise
         """
+        cfg = config.frozen().validation
+        crit = cfg.handling.unreachable == 'quit'
         # Check the file size
         if file.size != rucio['bytes']:
-            crit = config.validation.error_handling.unreachable == 'quit'
             lvl = logging.CRITICAL if crit else logging.ERROR
             logger.log(lvl, "Size mismatch for %s: %d != %d", file.did, file.size, rucio['bytes'])
             return False
         # See if we should skip the checksum check
-        if len(config.validation.checksums) == 0:
+        if len(cfg.checksums) == 0:
             return True
         # Check the checksums
-        for algo in config.validation.checksums:
-            algo = str(algo)
+        for algo in cfg.checksums:
             if algo in file.checksums and algo in rucio:
                 csum1 = file.checksums[algo]
                 csum2 = rucio[algo]
                 if csum1 == csum2:
                     logger.debug("Found matching %s checksum for %s", algo, file.did)
                     return True
-                crit = config.validation.error_handling.unreachable == 'quit'
                 lvl = logging.CRITICAL if crit else logging.ERROR
                 logger.log(lvl, "%s checksum err for %s: %s != %s", algo, file.did, csum1, csum2)
                 return False
@@ -821,7 +1352,6 @@ class RucioFinder (PathFinder):
             if algo not in rucio:
                 logger.debug("Rucio missing %s checksum for %s", algo, file.did)
         # If we get here, we have no matching checksums
-        crit = config.validation.error_handling.unreachable == 'quit'
         lvl = logging.CRITICAL if crit else logging.ERROR
         logger.log(lvl, "No matching checksums for %s", file.did)
         return False
@@ -829,16 +1359,36 @@ class RucioFinder (PathFinder):
     async def get_paths(self, batch: InputBatch) -> list:
         """
         Asynchronously retrieve paths for a specific batch of files.
+        Replicas are added to the files as each chunk of results arrives from Rucio,
+        so that checking them can start before the whole batch has been retrieved.
 
         :param batch: InputBatch object containing files to retrieve paths for
         :return: list of file path dictionaries
         """
-        return await self.client.get_replicas(batch.files)
+        paths = []
+        async for chunk in self.client.stream_replicas(batch.files):
+            paths.extend(chunk)
+            await self.add_paths(batch, chunk)
+        self.streamed.add(batch.skip)
+        return paths
 
     async def set_paths(self, batch: InputBatch, paths: list) -> None:
         """
         Asynchronously set paths for a specific batch of files.
         
+        :param batch: InputBatch object containing files to process
+        :param paths: list of file path dictionaries from Rucio
+        """
+        # Skip batches that already had their replicas added while streaming
+        if batch.skip in self.streamed:
+            self.streamed.discard(batch.skip)
+            return
+        await self.add_paths(batch, paths)
+
+    async def add_paths(self, batch: InputBatch, paths: list) -> None:
+        """
+        Add replicas from Rucio to the files in a batch.
+
         :param batch: InputBatch object containing files to process
         :param paths: list of file path dictionaries from Rucio
         """
@@ -856,6 +1406,7 @@ class RucioFinder (PathFinder):
             for pfn, info in pfns.items():
                 rse = info['rse']
                 await self.add_replica(file, pfn, rse_name=rse)
+            await self.start_checks(file)
 
 
 class PathListFinder(PathFinder):
@@ -865,12 +1416,14 @@ class PathListFinder(PathFinder):
     def __init__(self, source: MetaRetriever, paths: dict = None):
         super().__init__(source)
         self.paths = paths or {}
+        self.prefixes = {}
 
     def add_rse(self, rse: BaseRSE) -> None:
         """Add an RSE to the list of known RSEs"""
         for protocol, url in rse.urls.items():
             rses = self.rses.setdefault(protocol, {})
             rses[url] = rse
+            self.prefixes.setdefault(protocol, PrefixTrie()).insert(url, rse)
 
     async def connect(self) -> None:
         """Connect to the file source and rucio"""
@@ -885,13 +1438,24 @@ class PathListFinder(PathFinder):
             logger.critical("Failed to connect to Rucio client")
             sys.exit(1)
         # For local jobs, fall back to generic RSEs for DCACHE locations
-        for name in config.sites.dcache.keys():
-            self.add_rse(GenericRSE(name=name))
+        rses = [GenericRSE(name=name) for name in config.sites.dcache.keys()]
         # Also check for path-like keys in the distance config to create generic RSEs for those
-        for url in config.sites.rse_distances.keys():
-            if '/' not in url:
-                continue
-            self.add_rse(GenericRSE(url=url))
+        rses.extend(GenericRSE(url=url) for url in config.sites.rse_distances.keys() if '/' in url)
+        # Ping all the hosts at once
+        await asyncio.gather(*[rse.add_ping() for rse in rses])
+        for rse in rses:
+            self.add_rse(rse)
+
+    def find_rse(self, path: str) -> BaseRSE:
+        """
+        Find the known RSE with the longest URL prefix matching a path
+
+        :param path: file path or URL
+        :return: matching RSE, or None if there is no match
+        """
+        trie = self.prefixes.get(get_protocol(path))
+        match = trie.match(path) if trie else None
+        return match[1] if match else None
 
     async def add_replica(self, file: MergeFile, path: str, rse_name: str = None) -> None:
         """
@@ -906,12 +1470,7 @@ class PathListFinder(PathFinder):
         if protocol == 'file':
             path = io_utils.expand_path(path)
         # Try to find an existing RSE that matches the path prefix
-        rses = self.rses.setdefault(protocol, {})
-        rse = None
-        for prefix, candidate in sorted(rses.items(), key=lambda x: len(x[0]), reverse=True):
-            if path.startswith(prefix):
-                rse = candidate
-                break
+        rse = self.find_rse(path)
         # Add a new RSE for this path if we don't have a match
         if not rse:
             if protocol == 'file':
@@ -920,10 +1479,11 @@ class PathListFinder(PathFinder):
                 prefix = f"{protocol}://{get_host(path)}:{get_port(path)}/"
             rse = GenericRSE(url=prefix)
             self.add_rse(rse)
+            await rse.add_ping()
         # Add the replica to the file
         replica = Replica(path=path, rse=rse)
         file.replicas.append(replica)
-        await self.check_replica(replica, size=file.size, cksums=file.checksums)
+        await self.check_replica(file, replica, size=file.size, cksums=file.checksums)
 
     async def get_paths(self, batch: InputBatch) -> list:
         """
@@ -959,6 +1519,11 @@ class PathListFinder(PathFinder):
         for file in paths:
             path_dict.update(file)
 
+        # Ping any new hosts for the batch at once, instead of one by one as RSEs are created
+        hosts = set(get_host(path) for paths in path_dict.values() for path in paths
+                    if get_protocol(path) != 'file' and self.find_rse(path) is None)
+        await ping_utils.pings.ping(hosts)
+
         # Assign paths to files
         for file in batch.files:
             name = file.name
@@ -969,6 +1534,7 @@ class PathListFinder(PathFinder):
                 continue
             for path in replicas:
                 await self.add_replica(file, path)
+            await self.start_checks(file)
 
 
 def get(metadata: MetaRetriever) -> PathFinder:
@@ -985,7 +1551,6 @@ def get(metadata: MetaRetriever) -> PathFinder:
         # Group data file paths by name
         paths = collections.defaultdict(set)
         for path in config.input.inputs:
-            path = str(path)
             # If we have a JSON file, strip the extension and look for a matching data file
             if path.endswith('.json'):
                 path = path[:-5]
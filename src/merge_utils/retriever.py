@@ -4,7 +4,11 @@ import logging
 import os
 import sys
 import json
+import math
 import asyncio
+import logging.handlers
+import multiprocessing
+import concurrent.futures
 from abc import ABC, abstractmethod
 import collections
 from dataclasses import dataclass
@@ -12,7 +16,7 @@ from dataclasses import dataclass
 from typing import AsyncGenerator, Callable
 
 from merge_utils import config, io_utils
-from merge_utils.merge_set import MergeSet, MergeFileError
+from merge_utils.merge_set import MergeSet, MergeFileError, validate_files
 from merge_utils.metacat_utils import MetaCatWrapper
 
 logger = logging.getLogger(__name__)
@@ -45,6 +49,18 @@ def file_serializer(obj):
         return obj.name
     raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
+def init_worker(cfg: dict, log_queue: multiprocessing.Queue) -> None:
+    """
+    Initialize a metadata validation worker process.
+
+    :param cfg: configuration settings exported from the main process
+    :param log_queue: queue for forwarding log records to the main process
+    """
+    root = logging.getLogger()
+    root.handlers = [logging.handlers.QueueHandler(log_queue)]
+    root.setLevel(logging.DEBUG)
+    config.restore(cfg)
+
 class MetaRetriever(ABC):
     """Base class for retrieving metadata from a source"""
     name: str = "metadata"
@@ -56,6 +72,8 @@ class MetaRetriever(ABC):
         self.dir = os.path.join(str(config.job.dir), 'cache', self.name)
         os.makedirs(self.dir, exist_ok=True)
         self.client = MetaCatWrapper()
+        self.pool = None
+        self.log_listener = None
 
     @property
     def files(self) -> MergeSet:
@@ -101,12 +119,61 @@ class MetaRetriever(ABC):
 
     async def connect(self) -> None:
         """Connect to the MetaCat web API"""
+        self.start_workers()
         await self.client.connect()
         await self.get_done()
 
     async def disconnect(self) -> None:
         """Disconnect from the MetaCat web API"""
         await self.client.disconnect()
+        self.stop_workers()
+
+    def start_workers(self) -> None:
+        """Start the pool of metadata validation processes, if enabled"""
+        workers = int(config.validation.workers or 0)
+        if workers <= 0 or self.pool is not None:
+            return
+        logger.info("Starting %d metadata validation processes", workers)
+        # Use spawn so workers do not inherit the event loop or open connections
+        ctx = multiprocessing.get_context('spawn')
+        log_queue = ctx.Queue()
+        self.log_listener = logging.handlers.QueueListener(
+            log_queue, *logging.getLogger().handlers, respect_handler_level=True)
+        self.log_listener.start()
+        # Workers do not need the (potentially very long) input list
+        cfg = config.export()
+        cfg['input']['inputs'] = []
+        self.pool = concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers, mp_context=ctx,
+            initializer=init_worker, initargs=(cfg, log_queue))
+
+    def stop_workers(self) -> None:
+        """Shut down the pool of metadata validation processes"""
+        if self.pool is not None:
+            self.pool.shutdown(wait=True, cancel_futures=True)
+            self.pool = None
+        if self.log_listener is not None:
+            self.log_listener.stop()
+            self.log_listener = None
+
+    async def add_files(self, batch: InputBatch) -> list:
+        """
+        Validate a batch of files and add them to the merge set.
+        If worker processes are enabled, the batch is split between them for validation.
+
+        :param batch: InputBatch object containing file metadata dictionaries
+        :return: list of good MergeFile objects that were added
+        """
+        if self.pool is None:
+            return await asyncio.to_thread(self.files.add, batch.skip, batch.files)
+        loop = asyncio.get_running_loop()
+        step = math.ceil(len(batch) / int(config.validation.workers))
+        tasks = [
+            loop.run_in_executor(self.pool, validate_files, batch.files[i:i+step])
+            for i in range(0, len(batch), step)
+        ]
+        records = [record for res in await asyncio.gather(*tasks) for record in res]
+        return await asyncio.to_thread(self.files.add, batch.skip, batch.files, records)
 
     @abstractmethod
     async def get_metadata(self, batch: InputBatch, limit: int) -> list:
@@ -303,7 +370,7 @@ class MetaRetriever(ABC):
                 continue
             logger.info("Processing new %s input batch %d", self.name, batch.skip)
             # Add file to merge set, and yield if we added any
-            added = await asyncio.to_thread(self.files.add, batch.skip, batch.files)
+            added = await self.add_files(batch)
             if added:
                 yield InputBatch(skip=batch.skip, files=added)
             # If there is no next task, we're done
@@ -325,7 +392,7 @@ class MetaRetriever(ABC):
         async for _ in self.input_batches():
             self.files.check_errors()
         # Close connections and do final error checking
-        await self.client.disconnect()
+        await self.disconnect()
         self.files.check_errors(final = True)
 
     def run(self) -> None:
@@ -546,7 +613,7 @@ def get() -> MetaRetriever:
     :return: MetaRetriever object for retrieving file metadata
     """
     # Determine input mode and retrieve metadata
-    inputs = [str(f) for f in config.input.inputs]
+    inputs = config.input.inputs
     if config.input.mode == 'files':
         # We need to sort the input files into data and metadata files
         # Start by getting the set of all metadata file names (without the .json suffix)
@@ -1,22 +1,123 @@
 """Utility functions for interacting with the Rucio web API."""
 from __future__ import annotations
 
+import os
+import json
+import time
 import logging
 import asyncio
 from typing import AsyncGenerator
 
+from merge_utils import io_utils, config
+
 logger = logging.getLogger(__name__)
 
-try:
-    from rucio.client import Client #type: ignore pylint: disable=import-error
-    #from rucio.client.replicaclient import ReplicaClient #type: ignore pylint: disable=import-error
-    #from rucio.client.rseclient import RSEClient #type: ignore pylint: disable=import-error
-    HAS_RUCIO = True
-except ImportError:
-    logger.warning("Failed to import Rucio client, Rucio functionality will be unavailable!")
-    HAS_RUCIO = False
+# The Rucio client is slow to import, so only load it when we first connect
+Client = None # pylint: disable=invalid-name
+HAS_RUCIO = None
+
+def import_rucio() -> bool:
+    """
+    Import the Rucio client on first use.
+
+    :return: True if the Rucio client is available
+    """
+    global Client, HAS_RUCIO # pylint: disable=global-statement
+    if HAS_RUCIO is None:
+        try:
+            from rucio.client import Client #type: ignore pylint: disable=import-error,import-outside-toplevel,redefined-outer-name
+            HAS_RUCIO = True
+        except ImportError:
+            logger.warning("Failed to import Rucio client, Rucio functionality will be unavailable!")
+            HAS_RUCIO = False
+    return HAS_RUCIO
+
+class RSECatalog:
+    """Cache of RSE information from Rucio, saved to disk so that later runs can reuse it"""
+
+    def __init__(self, path: str = None):
+        """
+        Initialize the RSECatalog.
+
+        :param path: path to the JSON cache file, defaults to 'rucio_rses.json' in the cache directory
+        """
+        self.path = path
+        self.listed = None
+        self.rses = None
+
+    @staticmethod
+    def ttl() -> float:
+        """Get how long cached RSE information stays valid, in seconds"""
+        return float(config.sites.rse_ttl or 0) * 3600
+
+    def load(self) -> dict:
+        """
+        Read the cached RSE information on first use.
+
+        :return: dictionary of {name: (timestamp, rse)}
+        """
+        if self.rses is not None:
+            return self.rses
+        self.rses = {}
+        self.path = self.path or os.path.join(io_utils.cache_dir(), 'rucio_rses.json')
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                data = json.load(f)
+            self.listed = data['listed']
+            self.rses = {name: tuple(val) for name, val in data['rses'].items()}
+        except (OSError, ValueError, TypeError, KeyError) as err:
+            logger.debug("No usable RSE catalog at %s: %s", self.path, err)
+        return self.rses
+
+    def save(self) -> None:
+        """Write the RSE information back to disk"""
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}"
+            with open(tmp, 'w', encoding="utf-8") as f:
+                json.dump({'listed': self.listed, 'rses': self.rses}, f, default=str)
+            os.replace(tmp, self.path)
+        except OSError as err:
+            logger.debug("Failed to save RSE catalog %s: %s", self.path, err)
+
+    def get(self, name: str) -> dict:
+        """
+        Get cached information for an RSE, if it has not expired.
+
+        :param name: name of the RSE
+        :return: dictionary of RSE attributes, or None if there is no valid entry
+        """
+        entry = self.load().get(name)
+        if entry is None or time.time() - entry[0] > self.ttl():
+            return None
+        return entry[1]
+
+    def all(self) -> list[dict]:
+        """
+        Get cached information for all RSEs, if the full list has not expired.
+
+        :return: list of RSE dictionaries, or None if the full list is not cached
+        """
+        self.load()
+        if self.listed is None or time.time() - self.listed > self.ttl():
+            return None
+        return [rse for _, rse in self.rses.values()]
+
+    def update(self, rses: list[dict], listed: bool = False) -> None:
+        """
+        Add RSE information to the catalog and save it.
 
-#from merge_utils import io_utils, config
+        :param rses: list of RSE dictionaries
+        :param listed: True if this is the full list of RSEs
+        """
+        self.load()
+        now = time.time()
+        if listed:
+            self.listed = now
+            self.rses = {}
+        for rse in rses:
+            self.rses[rse['rse']] = (now, rse)
+        self.save()
 
 class RucioWrapper:
     """Class for sending asynchronous requests to the Rucio web API."""
@@ -25,6 +126,8 @@ class RucioWrapper:
         """Initialize the RucioWrapper."""
         self.client = None
         self.rses = {}
+        self.catalog = RSECatalog()
+        self.limit = None
 
     def __bool__(self) -> bool:
         """Return True if the Rucio client is connected."""
@@ -32,7 +135,8 @@ class RucioWrapper:
 
     async def connect(self) -> None:
         """Connect to the Rucio web API"""
-        if not HAS_RUCIO:
+        self.limit = None # The request limit belongs to the current event loop
+        if not await asyncio.to_thread(import_rucio):
             logger.warning("Rucio client is not available!")
         elif not self.client:
             logger.debug("Connecting to Rucio")
@@ -47,6 +151,42 @@ class RucioWrapper:
     async def disconnect(self) -> None:
         """No need to explicitly disconnect from Rucio?"""
 
+    async def call(self, method: str, *args, **kwargs) -> any:
+        """
+        Call a blocking Rucio client method in a worker thread, limiting the number
+        of concurrent requests to the validation concurrency setting.
+
+        :param method: name of the client method
+        :param args: positional arguments for the method
+        :param kwargs: keyword arguments for the method
+        :return: result of the method, with generators expanded into lists
+        """
+        if self.limit is None:
+            self.limit = asyncio.Semaphore(int(config.validation.concurrency or 1))
+        def run():
+            res = getattr(self.client, method)(*args, **kwargs)
+            return res if isinstance(res, (dict, list)) else list(res)
+        async with self.limit:
+            return await asyncio.to_thread(run)
+
+    async def rse_details(self, rse: dict) -> dict:
+        """
+        Asynchronously add the detailed information and attributes to an RSE dictionary.
+
+        :param rse: RSE dictionary from list_rses or get_rse
+        :return: the updated RSE dictionary
+        """
+        name = rse['rse']
+        details, rse['attrs'] = await asyncio.gather(
+            self.call('get_rse', name), self.call('list_rse_attributes', name)
+        )
+        for key, value in details.items():
+            if key in rse and rse[key] != value:
+                logger.warning("RSE %s has conflicting values for %s: %s != %s",
+                            name, key, rse[key], value)
+            rse[key] = value
+        return rse
+
     async def get_rse(self, name: str) -> dict:
         """
         Asynchronously retrieve information for a specific RSEfrom Rucio.
@@ -57,8 +197,10 @@ class RucioWrapper:
         # Check if we already have information about this RSE cached
         if name in self.rses:
             return self.rses[name]
-        rse = await asyncio.to_thread(self.client.get_rse, name)
-        rse['attrs'] = await asyncio.to_thread(self.client.list_rse_attributes, name)
+        rse = self.catalog.get(name)
+        if rse is None:
+            rse = await self.rse_details({'rse': name})
+            self.catalog.update([rse])
         self.rses[name] = rse
         return rse
 
@@ -69,21 +211,38 @@ class RucioWrapper:
         :param detailed: whether to include detailed RSE information
         :return: dictionary of RSE attributes for each RSE
         """
-        for rse in await asyncio.to_thread(self.client.list_rses):
-            name = rse['rse']
-            if rse['deleted']:
-                continue
+        rses = self.catalog.all() if detailed else None
+        if rses is None:
+            rses = [rse for rse in await self.call('list_rses') if not rse['deleted']]
             if detailed:
-                details = await asyncio.to_thread(self.client.get_rse, name)
-                for key, value in details.items():
-                    if key in rse and rse[key] != value:
-                        logger.warning("RSE %s has conflicting values for %s: %s != %s",
-                                    name, key, rse[key], value)
-                    rse[key] = value
-            rse['attrs'] = await asyncio.to_thread(self.client.list_rse_attributes, name)
-            self.rses[name] = rse
+                rses = await asyncio.gather(*[self.rse_details(rse) for rse in rses])
+                self.catalog.update(rses, listed=True)
+            else:
+                attrs = await asyncio.gather(*[
+                    self.call('list_rse_attributes', rse['rse']) for rse in rses
+                ])
+                for rse, attr in zip(rses, attrs):
+                    rse['attrs'] = attr
+        for rse in rses:
+            self.rses[rse['rse']] = rse
             yield rse
 
+    async def stream_replicas(self, files: list) -> AsyncGenerator[list, None]:
+        """
+        Asynchronously retrieve replicas for a list of files, splitting it into
+        chunks that are queried concurrently and yielding each chunk as it arrives.
+
+        :param files: list of files to retrieve paths for
+        :return: list of file path dictionaries for each chunk
+        """
+        size = max(1, int(config.validation.replica_chunk or len(files) or 1))
+        tasks = []
+        for i in range(0, len(files), size):
+            query = [{'scope':f.namespace, 'name':f.name} for f in files[i:i+size]]
+            tasks.append(self.call('list_replicas', query, ignore_availability=False))
+        for task in asyncio.as_completed(tasks):
+            yield await task
+
     async def get_replicas(self, files: list) -> list:
         """
         Asynchronously retrieve replicas for a specific batch of files.
@@ -91,10 +250,45 @@ class RucioWrapper:
         :param files: list of files to retrieve paths for
         :return: list of file path dictionaries
         """
-        query = [{'scope':f.namespace, 'name':f.name} for f in files]
-        res = await asyncio.to_thread(self.client.list_replicas, query,
-                                      ignore_availability=False)
-        return list(res)
+        res = []
+        async for chunk in self.stream_replicas(files):
+            res.extend(chunk)
+        return res
+
+    async def get_pfns(self, rse: str, dids: list[str], scheme: str = 'root') -> dict:
+        """
+        Asynchronously get the physical file names that files would have on an RSE.
+
+        :param rse: name of the RSE
+        :param dids: list of file DIDs (namespace:name)
+        :param scheme: protocol scheme for the PFNs
+        :return: dictionary of {did: pfn}
+        """
+        size = max(1, int(config.validation.replica_chunk or len(dids) or 1))
+        res = await asyncio.gather(*[
+            self.call('lfns2pfns', rse, dids[i:i+size], scheme=scheme)
+            for i in range(0, len(dids), size)
+        ])
+        return {did: pfn for chunk in res for did, pfn in chunk.items()}
+
+    async def add_rule(self, dids: list[str], rse: str, lifetime: float = None) -> list[str]:
+        """
+        Asynchronously create a replication rule for a list of files.
+
+        :param dids: list of file DIDs (namespace:name)
+        :param rse: RSE expression for the rule
+        :param lifetime: lifetime of the rule in seconds, or None for no limit
+        :return: list of rule IDs
+        """
+        query = []
+        for did in dids:
+            scope, name = did.split(':', 1)
+            query.append({'scope': scope, 'name': name})
+        # Rucio expects the lifetime as a whole number of seconds
+        if lifetime is not None:
+            lifetime = int(lifetime)
+        return await self.call('add_replication_rule', query, 1, rse, lifetime=lifetime,
+                               comment=f"merge-utils input consolidation {config.uuid()}")
 
 
 # Example RSE info from FNAL_DCACHE, as of February 2026
@@ -9,14 +9,17 @@ import tarfile
 import subprocess
 import collections
 import math
+import bisect
+import itertools
 import asyncio
 from abc import ABC, abstractmethod
 from typing import AsyncGenerator
 
-from merge_utils import io_utils, config, justin_utils
+from merge_utils import io_utils, config, naming, justin_utils, prestage
 from merge_utils.merge_set import MergeFileError, MergeSet, MergeFile, MergeChunk
 from merge_utils.retriever import InputBatch
-from merge_utils.replicas import Replica, PathFinder, GenericRSE, RucioRSE
+from merge_utils.replicas import Replica, Status, PathFinder, GenericRSE, RucioRSE
+from merge_utils.distance_matrix import DistanceMatrix
 
 logger = logging.getLogger(__name__)
 
@@ -40,7 +43,10 @@ class JobScheduler(ABC):
         self.source = source
         self.dir = os.path.join(str(config.job.dir), 'merge')
         self.distances = {} # Cache of RSE-site distances
+        self.matrix = None  # File-site distances, built once all replicas are resolved
         self.jobs = []
+        self.plan = [] # Merge job dependencies, written to plan.json
+        self.spec_names = {} # Spec file names for each chunk that has been written
 
     @property
     def files(self) -> MergeSet:
@@ -75,16 +81,7 @@ class JobScheduler(ABC):
         :param file: MergeFile object to get distances for
         :return: Dictionary mapping site names to distances
         """
-        site_dists = {}
-        for replica in file.replicas:
-            if not replica.status.good:
-                continue
-            rse_dists = self.distances[replica.rse.name]
-            for site, dist in rse_dists.items():
-                site_dists[site] = min(site_dists.get(site, float('inf')), dist + replica.distance)
-        if not site_dists:
-            raise RuntimeError(f"File {file.did} has no available replicas")
-        return site_dists
+        return self.matrix.file(file)
 
     def chunk_distances(self, chunk: MergeChunk) -> dict:
         """
@@ -94,18 +91,7 @@ class JobScheduler(ABC):
         :param chunk: MergeChunk object to get distances for
         :return: Dictionary mapping site names to distances
         """
-        site_dists = self.file_distances(chunk.files[0])
-        for file in chunk.files[1:]:
-            file_dists = self.file_distances(file)
-            for site, dist in file_dists.items():
-                if site in site_dists:
-                    site_dists[site] += dist
-                else:
-                    site_dists[site] = float('inf')
-            for site in site_dists:
-                if site not in file_dists:
-                    site_dists[site] = float('inf')
-        return site_dists
+        return self.matrix.chunk(chunk.files)
 
     async def input_batches(self) -> AsyncGenerator[InputBatch, None]:
         """
@@ -113,6 +99,7 @@ class JobScheduler(ABC):
 
         :return: InputBatch object containing skip index and list of MergeFile objects
         """
+        max_distance = config.frozen().sites.max_distance
         async for batch in self.source.input_batches():
             unreachable = []
             for file in batch:
@@ -127,7 +114,7 @@ class JobScheduler(ABC):
                     dist = replica.distance + min(replica_dists.values())
                     min_dist = min(min_dist, dist)
                 # File is unreachable no RSE-site distance was below threshold
-                if min_dist > config.sites.max_distance:
+                if min_dist > max_distance:
                     logger.warning("File %s has no replicas within max distance", file.did)
                     unreachable.append(file.did)
             # Set unreachable flag for bad files
@@ -155,6 +142,7 @@ class JobScheduler(ABC):
             sys.exit(1)
 
         self.files.check_errors(final = True)
+        self.matrix = DistanceMatrix(self.files.good_files, self.distances)
 
     def assign_site(self, chunk: MergeChunk, site: str = None) -> None:
         """
@@ -178,21 +166,199 @@ class JobScheduler(ABC):
                 raise RuntimeError(f"File {file.did} has no good replicas for site {site}")
             file.replicas = [best_replica]
 
+    @staticmethod
+    def file_sizes(files: list) -> list[float]:
+        """
+        Get the sizes of a list of files, using the average size for files without one.
+
+        :param files: List of MergeFile objects
+        :return: List of file sizes in bytes
+        """
+        known = [file.size for file in files if file.size]
+        avg = sum(known) / len(known) if known else 0
+        return [file.size or avg for file in files]
+
+    @staticmethod
+    def disk_usage(sizes: list[float]) -> float:
+        """
+        Estimate the scratch disk space needed to merge a group of files, from the size specs
+        of the merging method outputs plus the inputs themselves if they are copied locally.
+
+        :param sizes: List of input file sizes in bytes
+        :return: Estimated disk usage in bytes
+        """
+        return JobScheduler.group_usage(sum(sizes), len(sizes))
+
+    @staticmethod
+    def output_size(total: float, count: int) -> float:
+        """
+        Estimate the total size of the outputs from merging a group of files, from the size
+        specs of the merging method outputs, which only depend on the total size and number
+        of the inputs.
+
+        :param total: Total size of the input files in bytes
+        :param count: Number of input files
+        :return: Estimated output size in bytes
+        """
+        specs = [output.size for output in config.frozen().method.outputs if output.size]
+        return sum(spec.evaluate(total, count) for spec in specs) if specs else total
+
+    @staticmethod
+    def group_usage(total: float, count: int) -> float:
+        """
+        Estimate the scratch disk space needed to merge a group of files from their total size
+        and number, including the inputs themselves if they are copied locally.
+
+        :param total: Total size of the input files in bytes
+        :param count: Number of input files
+        :return: Estimated disk usage in bytes
+        """
+        usage = JobScheduler.output_size(total, count)
+        if not config.frozen().input.streaming:
+            usage += total
+        return usage
+
+    def fits(self, files: list, sizes: list[float] = None) -> bool:
+        """
+        Check if a group of files is within the chunks.max_count and chunks.max_size limits.
+
+        :param files: List of MergeFile objects
+        :param sizes: Optional list of file sizes, if already known
+        :return: True if the files can be merged in a single job
+        """
+        limits = config.frozen().method.chunks
+        if len(files) > limits.max_count:
+            return False
+        if not limits.max_size:
+            return True
+        if sizes is None:
+            sizes = self.file_sizes(files)
+        return self.disk_usage(sizes) <= limits.max_size * 1024**3
+
+    def range_fits(self, prefix: list[float], start: int, end: int) -> bool:
+        """
+        Check if a consecutive range of files is within the chunk limits, using the running
+        total of the file sizes instead of summing the range again.
+
+        :param prefix: running total of the file sizes, starting from 0
+        :param start: index of the first file in the range
+        :param end: index after the last file in the range
+        :return: True if the files can be merged in a single job
+        """
+        limits = config.frozen().method.chunks
+        if end - start > limits.max_count:
+            return False
+        if not limits.max_size:
+            return True
+        return self.group_usage(prefix[end] - prefix[start], end - start) <= limits.max_size * 1024**3
+
     def split_files(self, files: list) -> list[list]:
         """
-        Split a list of files into groups for merging, based on the configured chunk size.
+        Split a list of files into groups for merging, based on the configured chunk limits.
+        Files that are too large to merge with anything else get their own groups, and the
+        runs of files between them are divided into the smallest number of consecutive groups
+        that are within both the count and size limits, with the group boundaries chosen to
+        balance their sizes.
         
         :param files: List of MergeFile objects to split
         :return: List of lists of MergeFile objects, where each sublist is a group for merging
         """
         if not files:
             return []
-        chunk_max = config.method.chunks.max_count
-        if len(files) <= chunk_max:
+        sizes = self.file_sizes(files)
+        if self.fits(files, sizes):
             return [files]
-        n_chunks = math.ceil(len(files) / chunk_max)
-        target_size = len(files) / n_chunks
-        return [files[int(i*target_size):int((i+1)*target_size)] for i in range(n_chunks)]
+        groups = []
+        start = 0
+        for idx, file in enumerate(files):
+            if self.fits([file], sizes[idx:idx+1]):
+                continue
+            groups.extend(self.split_run(files[start:idx], sizes[start:idx]))
+            groups.append([file])
+            start = idx + 1
+        if start > 0:
+            logger.warning("Some input files are larger than the chunks.max_size limit")
+        groups.extend(self.split_run(files[start:], sizes[start:]))
+        return groups
+
+    def split_run(self, files: list, sizes: list[float]) -> list[list]:
+        """
+        Split a run of files that each fit in a chunk into the fewest balanced groups.
+        The count and size limits give a lower bound on the number of groups, and if the
+        balanced split with that many groups does not fit, the number of groups found by
+        packing the files greedily is used instead.
+
+        :param files: List of MergeFile objects to split
+        :param sizes: List of file sizes in bytes
+        :return: List of lists of MergeFile objects
+        """
+        if not files:
+            return []
+        if self.fits(files, sizes):
+            return [files]
+        limits = config.frozen().method.chunks
+        prefix = list(itertools.accumulate(sizes, initial=0))
+        n_chunks = math.ceil(len(files) / limits.max_count)
+        if limits.max_size:
+            usage = self.group_usage(prefix[-1], len(files))
+            n_chunks = max(n_chunks, math.ceil(usage / (limits.max_size * 1024**3)))
+        groups = self.balance(prefix, n_chunks)
+        if not all(self.range_fits(prefix, a, b) for a, b in groups):
+            packed = self.pack(prefix)
+            groups = self.balance(prefix, len(packed))
+            if not all(self.range_fits(prefix, a, b) for a, b in groups):
+                groups = packed
+        return [files[a:b] for a, b in groups]
+
+    @staticmethod
+    def balance(prefix: list[float], n_chunks: int) -> list[tuple[int, int]]:
+        """
+        Divide a list of files into consecutive groups of roughly equal total size.
+
+        :param prefix: running total of the file sizes, starting from 0
+        :param n_chunks: number of groups
+        :return: List of (start, end) indices for each group
+        """
+        n_files = len(prefix) - 1
+        n_chunks = min(n_chunks, n_files)
+        # Put each boundary where the running size is closest to an equal share
+        divs = [0]
+        for idx in range(1, n_chunks):
+            target = prefix[-1] * idx / n_chunks
+            div = bisect.bisect_left(prefix, target)
+            if div > 0 and target - prefix[div-1] < prefix[div] - target:
+                div -= 1
+            # Every group needs at least one file
+            div = min(max(div, divs[-1] + 1), n_files - (n_chunks - idx))
+            divs.append(div)
+        divs.append(n_files)
+        return [(divs[i], divs[i+1]) for i in range(n_chunks)]
+
+    def pack(self, prefix: list[float]) -> list[tuple[int, int]]:
+        """
+        Divide a list of files into consecutive groups by making each group as large as
+        the limits allow, which gives the fewest possible groups.
+
+        :param prefix: running total of the file sizes, starting from 0, for files that are
+                       each within the limits on their own
+        :return: List of (start, end) indices for each group
+        """
+        max_count = config.frozen().method.chunks.max_count
+        n_files = len(prefix) - 1
+        groups = []
+        start = 0
+        while start < n_files:
+            # Binary search for the largest group that fits
+            lo, hi = start + 1, min(n_files, start + max_count)
+            while lo < hi:
+                mid = (lo + hi + 1) // 2
+                if self.range_fits(prefix, start, mid):
+                    lo = mid
+                else:
+                    hi = mid - 1
+            groups.append((start, lo))
+            start = lo
+        return groups
 
     @abstractmethod
     def schedule(self, chunk: MergeChunk) -> None:
@@ -202,15 +368,92 @@ class JobScheduler(ABC):
         :param chunk: MergeChunk object to schedule
         """
 
+    def plan_tree(self, chunk: MergeChunk) -> None:
+        """
+        Limit the inputs to each pass 2+ merge by adding tiers of intermediate chunks.
+        The children of a chunk are divided into the fewest consecutive, equally sized groups
+        within the chunks.fan_in limit whose estimated outputs also fit within chunks.max_size,
+        until the chunk itself is within the fan_in limit, so the number of tiers grows with the
+        logarithm of both the number and total size of the pass 1 chunks. Children left alone
+        in a group are merged directly by the chunk instead of by an extra job.
+
+        :param chunk: scheduled MergeChunk object
+        """
+        limits = config.frozen().method.chunks
+        fan_in = limits.fan_in or limits.max_count
+        if fan_in < 2:
+            logger.critical("Merge fan_in must be at least 2, got %d", fan_in)
+            sys.exit(1)
+        while len(chunk.children) > fan_in:
+            children = chunk.children
+            # Each intermediate merge reads the estimated outputs of its children
+            sizes = [self.output_size(sum(self.file_sizes(child.files)), len(child.files))
+                     for child in children]
+            prefix = list(itertools.accumulate(sizes, initial=0))
+            n_groups = math.ceil(len(children) / fan_in)
+            divs = self.tier_divisions(prefix, n_groups)
+            if divs is None:
+                logger.warning("Pass 2+ merges exceed the chunks.max_size limit")
+                divs = [len(children) * idx // n_groups for idx in range(n_groups + 1)]
+            groups = [children[divs[idx]:divs[idx+1]] for idx in range(len(divs) - 1)]
+            chunk.add_tier(groups)
+            logger.debug("Added tier of %d intermediate chunks",
+                         sum(len(group) > 1 for group in groups))
+
+    def tier_divisions(self, prefix: list[float], n_groups: int) -> list[int]:
+        """
+        Find the fewest equally sized groups of chunks, starting from n_groups, whose
+        merges are within the chunks.max_size limit.
+
+        :param prefix: running total of the estimated chunk output sizes, starting from 0
+        :param n_groups: minimum number of groups
+        :return: List of group boundaries, or None if even pairs of chunks are too large
+        """
+        max_size = config.frozen().method.chunks.max_size
+        n_chunks = len(prefix) - 1
+        if max_size:
+            usage = self.group_usage(prefix[-1], n_chunks)
+            n_groups = max(n_groups, math.ceil(usage / (max_size * 1024**3)))
+        # Stop before every chunk is in a group of its own, which would not reduce the inputs
+        while n_groups < n_chunks:
+            divs = [n_chunks * idx // n_groups for idx in range(n_groups + 1)]
+            if not max_size or all(
+                self.group_usage(prefix[b] - prefix[a], b - a) <= max_size * 1024**3
+                for a, b in zip(divs, divs[1:]) if b - a > 1
+            ):
+                return divs
+            n_groups += 1
+        return None
+
     def write_specs(self, chunk) -> None:
         """
-        Write merge specs for a chunk to JSON dictionary files.
+        Write merge specs for a chunk and all of its children to JSON dictionary files.
         
         :param chunk: MergeChunk object to write
         """
         # Recursively write specs for child chunks, if any
         for child in chunk.children:
             self.write_specs(child)
+        self.write_chunk(chunk)
+
+    def write_ready(self, chunk: MergeChunk) -> None:
+        """
+        Write merge specs for a pass 1 chunk that is ready to merge, followed by any
+        later pass chunks whose inputs have now all been written.
+
+        :param chunk: pass 1 MergeChunk object to write
+        """
+        while chunk is not None and all(child in self.spec_names for child in chunk.children):
+            self.write_chunk(chunk)
+            chunk = chunk.parent
+
+    def write_chunk(self, chunk) -> None:
+        """
+        Write merge specs for a single chunk to JSON dictionary files.
+        The specs of its children must already have been written.
+
+        :param chunk: MergeChunk object to write
+        """
         # Get site job list for this tier, creating it if necessary
         tier = chunk.tier
         if tier >= len(self.jobs):
@@ -220,11 +463,58 @@ class JobScheduler(ABC):
         if chunk.site:
             prefix = f"{prefix}_{chunk.site}"
         # Write a JSON file for each output spec from the chunk
-        for spec in chunk.specs:
+        names = []
+        for output_id, spec in enumerate(chunk.specs):
             name = os.path.join(self.dir, f"{prefix}_{len(site_jobs)+1:>06}.json")
             with open(name, 'w', encoding="utf-8") as fjson:
                 fjson.write(json.dumps(spec, indent=2))
             site_jobs.append((name, chunk))
+            names.append(os.path.basename(name))
+            # Pass 1 chunks have one spec for all outputs, later passes have one per output
+            needs = [self.spec_names[child][output_id if len(self.spec_names[child]) > 1 else 0]
+                     for child in chunk.children]
+            self.plan.append({
+                'spec': names[-1],
+                'pass': tier + 1,
+                'site': chunk.site,
+                'outputs': [output['name'] for output in spec['outputs']],
+                'needs': needs
+            })
+        self.spec_names[chunk] = names
+
+    def write_plan(self) -> str:
+        """
+        Write the merge tree to a JSON file, listing the spec files that each job depends on.
+
+        :return: Name of the plan file
+        """
+        name = os.path.join(self.dir, "plan.json")
+        plan = {
+            'passes': len(self.jobs),
+            'jobs': self.plan
+        }
+        with open(name, 'w', encoding="utf-8") as fjson:
+            fjson.write(json.dumps(plan, indent=2))
+        return name
+
+    async def release(self, chunks: list[MergeChunk]) -> None:
+        """
+        Write merge specs for each pass 1 chunk once its inputs have been staged, so that a
+        slow file only holds back its own merge, and for later passes once all of their
+        inputs are written. The plan is rewritten as chunks become ready, so that it always
+        lists the jobs that can be submitted.
+
+        :param chunks: list of scheduled MergeChunk objects
+        """
+        leaves = [leaf for chunk in chunks for leaf in chunk.leaves]
+        n_ready = 0
+        async for ready in prestage.Prestager().release(leaves):
+            for chunk in ready:
+                self.write_ready(chunk)
+            n_ready += len(ready)
+            if self.jobs:
+                self.write_plan()
+            logger.info("Wrote merge specs for %d of %d pass 1 chunks", n_ready, len(leaves))
 
     @abstractmethod
     def write_script(self) -> list:
@@ -243,9 +533,12 @@ class JobScheduler(ABC):
         self.run_loop()
         os.makedirs(self.dir, exist_ok=True)
 
-        for chunk in self.files.groups():
+        chunks = []
+        for chunk in self.files.groups(self.matrix):
             self.schedule(chunk)
-            self.write_specs(chunk)
+            self.plan_tree(chunk)
+            chunks.append(chunk)
+        asyncio.run(self.release(chunks))
         if not self.jobs:
             logger.critical("No files to merge")
             return
@@ -305,7 +598,7 @@ class LocalScheduler(JobScheduler):
             if self.justin:
                 distances[None] = float('inf')
             elif isinstance(replica.rse, RucioRSE):
-                distances[None] = replica.rse.ping()
+                distances[None] = await replica.rse.ping()
             else:
                 distances[None] = 0
         return distances
@@ -319,7 +612,7 @@ class LocalScheduler(JobScheduler):
         # Just set site to None for local jobs
         self.assign_site(chunk, site=None)
         # Split into subchunks if there are too many files
-        if len(chunk.files) > config.method.chunks.max_count:
+        if not self.fits(chunk.files):
             for subchunk in self.split_files(chunk.files):
                 chunk.make_child(subchunk)
 
@@ -375,6 +668,8 @@ class JustinScheduler(JobScheduler):
         """
         super().__init__(source)
         self.cvmfs_dir = None
+        self.capacity = None # Remaining number of files each site can take
+        self.consolidations = [] # Chunks to replicate to a single RSE, as (chunk, RSE) pairs
 
     async def connect(self) -> None:
         """Connect to the file source"""
@@ -386,65 +681,248 @@ class JustinScheduler(JobScheduler):
             logger.critical("Cannot run batch jobs without JustIN connection!")
             sys.exit(1)
 
+    def site_capacity(self) -> dict:
+        """
+        Get the remaining number of input files each merging site can take, based on the
+        sites.max_jobs limits. Only used for flow assignment.
+
+        :return: dictionary of {site: number of files}, sites without a limit are omitted
+        """
+        if self.capacity is None:
+            cfg = config.frozen()
+            max_jobs = cfg.sites.max_jobs
+            self.capacity = {}
+            for site in self.matrix.sites:
+                jobs = max_jobs[site] if site in max_jobs else max_jobs.get('default')
+                if jobs:
+                    self.capacity[site] = int(jobs) * int(cfg.method.chunks.max_count)
+        return self.capacity
+
+    def group_files(self, chunk: MergeChunk, capacity: dict) -> list[list]:
+        """
+        Group the files in a chunk by their assigned merging site.
+
+        :param chunk: MergeChunk object to group
+        :param capacity: remaining site capacities for flow assignment
+        :return: list of [site, files] pairs, largest group first
+        """
+        best = self.matrix.best_sites(chunk.files)
+        if config.frozen().sites.assignment == 'flow':
+            sites = self.matrix.assign(chunk.files, capacity)
+            overflow = sites.count(None)
+            if overflow:
+                logger.warning("%d files do not fit within sites.max_jobs, "
+                               "assigning them to their nearest sites", overflow)
+            best = [site if site is not None else b_site for site, b_site in zip(sites, best)]
+        best_sites = collections.defaultdict(list)
+        for file, best_site in zip(chunk.files, best):
+            best_sites[best_site].append(file)
+        best_sites = sorted(best_sites.items(), key=lambda x: len(x[1]), reverse=True)
+        logger.info("Best sites: %s", ", ".join([f"{s[0]} ({len(s[1])})" for s in best_sites]))
+        return [list(s) for s in best_sites]
+
+    def consolidation(self, files: list[MergeFile], n_sites: int, capacity: dict) -> tuple:
+        """
+        Find the cheapest RSE to replicate a fragmented group of files to, so that it can be
+        merged at a single site. Each file costs the distance from the RSE to its nearest
+        site with room for the whole group, plus the transfer_cost if the file has to be
+        copied there. Consolidating only happens if that is cheaper than the best distance
+        for each file plus the fragment_penalty for each extra site.
+
+        :param files: list of MergeFile objects
+        :param n_sites: number of sites the files would otherwise be merged at
+        :param capacity: remaining site capacities for flow assignment
+        :return: tuple of (RucioRSE, site), or None if the files should not be consolidated
+        """
+        cfg = config.frozen().sites
+        if cfg.consolidate.mode == 'off' or n_sites < cfg.consolidate.min_sites:
+            return None
+        cost = sum(min(self.file_distances(file).values()) for file in files)
+        cost += cfg.fragment_penalty * (n_sites - 1)
+        best = None
+        rses = [rse for rse in self.source.rses.values() if isinstance(rse, RucioRSE)]
+        for rse in rses:
+            if not rse.write or not rse.disk or not self.distances.get(rse.name):
+                continue
+            sites = [(site, dist) for site, dist in self.distances[rse.name].items()
+                     if capacity.get(site, len(files)) >= len(files)]
+            if not sites:
+                continue
+            site, dist = min(sites, key=lambda x: x[1])
+            missing = sum(1 for file in files if not any(
+                replica.rse is rse and replica.status.good for replica in file.replicas))
+            rse_cost = len(files) * (rse.distance + dist) + missing * cfg.consolidate.transfer_cost
+            if rse_cost < cost:
+                cost = rse_cost
+                best = (rse, site)
+        return best
+
     def schedule(self, chunk: MergeChunk) -> None:
         """
         Schedule a chunk for merging, subdividing and assigning to sites as necessary.
         
         :param chunk: MergeChunk object to schedule
         """
+        cfg = config.frozen()
+        flow = cfg.sites.assignment == 'flow'
+        capacity = self.site_capacity() if flow else {}
         # Try to do merge as one chunk if possible
-        if len(chunk.files) < config.method.chunks.max_count:
-            site, dist = sorted(self.chunk_distances(chunk).items(), key=lambda x: x[1])[0]
-            if dist < float('inf'):
-                self.assign_site(chunk, site=site)
-                return
+        if self.fits(chunk.files):
+            dists = sorted(self.chunk_distances(chunk).items(), key=lambda x: x[1])
+            for site, dist in dists:
+                if dist == float('inf'):
+                    break
+                if capacity.get(site, len(chunk.files)) >= len(chunk.files):
+                    self.assign_site(chunk, site=site)
+                    if site in capacity:
+                        capacity[site] -= len(chunk.files)
+                    return
         # Oherwise, group files by the best merging site
-        best_sites = collections.defaultdict(list)
-        for file in chunk.files:
-            dists = self.file_distances(file)
-            best_site = sorted(dists.items(), key=lambda p: p[1])[0][0]
-            best_sites[best_site].append(file)
-        best_sites = sorted(best_sites.items(), key=lambda x: len(x[1]), reverse=True)
-        logger.info("Best sites: %s", ", ".join([f"{s[0]} ({len(s[1])})" for s in best_sites]))
+        best_sites = self.group_files(chunk, capacity)
         # If all files are at the same site, just assign the chunk there and split if needed
         if len(best_sites) == 1:
-            self.assign_site(chunk, site=best_sites[0][0])
+            site = best_sites[0][0]
+            self.assign_site(chunk, site=site)
+            if site in capacity:
+                capacity[site] = max(0, capacity[site] - len(chunk.files))
             # Split into subchunks if there are too many files
-            if len(chunk.files) > config.method.chunks.max_count:
+            if not self.fits(chunk.files):
                 for subchunk in self.split_files(chunk.files):
                     chunk.make_child(subchunk)
             return
-        # Try to remove sites with small groups of files
-        best_sites = [list(s) for s in best_sites]
+        # Try to remove sites with small groups of files. With flow assignment, larger groups
+        # are also merged into other sites if that costs less than the fragment penalty.
+        room = {site: capacity[site] - len(files) for site, files in best_sites if site in capacity}
         for idx in range(len(best_sites)-1, 0, -1):
-            files = best_sites[idx][1]
-            if len(files) >= config.method.chunks.min_count:
+            site, files = best_sites[idx]
+            small = len(files) < cfg.method.chunks.min_count
+            if not small and not flow:
                 break
             # Find the next best site for each file in the small group
             new_sites = [-1] * len(files)
             new_dists = [float('inf')] * len(files)
+            new_room = dict(room)
             for f_idx, file in enumerate(files):
                 dists = self.file_distances(file)
                 for new_idx, (new_site, new_files) in enumerate(best_sites):
                     if new_idx == idx or len(new_files) == 0:
                         continue
+                    if new_room.get(new_site, 1) <= 0:
+                        continue
                     dist = dists.get(new_site, float('inf'))
                     if dist < new_dists[f_idx]:
                         new_sites[f_idx] = new_idx
                         new_dists[f_idx] = dist
+                if new_sites[f_idx] >= 0 and best_sites[new_sites[f_idx]][0] in new_room:
+                    new_room[best_sites[new_sites[f_idx]][0]] -= 1
             # If every file has a valid new site, move them there and clear the small group
-            if all(new_idx >= 0 for new_idx in new_sites):
-                for f_idx, file in enumerate(files):
-                    best_sites[new_sites[f_idx]][1].append(file)
-                best_sites[idx][1] = []
+            if not all(new_idx >= 0 for new_idx in new_sites):
+                continue
+            if not small:
+                extra = sum(new_dists) - sum(self.file_distances(f)[site] for f in files)
+                if extra > cfg.sites.fragment_penalty:
+                    continue
+            for f_idx, file in enumerate(files):
+                best_sites[new_sites[f_idx]][1].append(file)
+            best_sites[idx][1] = []
+            room = new_room
+            if site in room:
+                room[site] += len(files)
+        # Replicate the files to a single RSE if that is cheaper than merging at each site
+        target = self.consolidation(chunk.files, sum(1 for _, files in best_sites if files),
+                                    capacity)
+        if target is not None:
+            rse, site = target
+            logger.info("Consolidating %d files at %s for merging at %s",
+                        len(chunk.files), rse.name, site)
+            self.consolidations.append((chunk, rse))
+            chunk.site = site
+            if site in capacity:
+                capacity[site] -= len(chunk.files)
+            if not self.fits(chunk.files):
+                for subchunk in self.split_files(chunk.files):
+                    chunk.make_child(subchunk)
+            return
         # Split by best site and schedule separately
         for site, site_files in best_sites:
+            if site in capacity:
+                capacity[site] = max(0, capacity[site] - len(site_files))
             for subchunk in self.split_files(site_files):
                 child = chunk.make_child(subchunk)
                 self.assign_site(child, site=site)
         # Use default site for parent chunk
         chunk.site = str(config.sites.default)
 
+    async def consolidate(self) -> list[dict]:
+        """
+        Point the inputs of consolidated chunks at their replicas on the destination RSE,
+        and write the replication rules to rules.json. The rules are also created in Rucio
+        if the consolidate mode is 'rules', otherwise they are only planned.
+
+        :return: list of rule dictionaries
+        """
+        if not self.consolidations:
+            return []
+        cfg = config.frozen().sites.consolidate
+        client = self.source.client
+        await client.connect()
+        if not client:
+            logger.critical("Cannot consolidate merge inputs without a Rucio connection!")
+            sys.exit(1)
+        lifetime = int(cfg.lifetime * 86400) if cfg.lifetime else None
+        # Look up every destination path first, so no rules are created if any are missing
+        plans = []
+        for chunk, rse in self.consolidations:
+            moved = [file for file in chunk.files if not any(
+                replica.rse is rse and replica.status.good for replica in file.replicas)]
+            pfns = await client.get_pfns(rse.name, [file.did for file in moved])
+            missing = [file.did for file in moved if file.did not in pfns]
+            if missing:
+                logger.critical("Rucio did not return paths on RSE %s for %d files, check that "
+                                "it supports xrootd:\n  %s", rse.name, len(missing),
+                                "\n  ".join(missing))
+                sys.exit(1)
+            plans.append((chunk, rse, moved, pfns))
+        rules = []
+        for chunk, rse, moved, pfns in plans:
+            for file in chunk.files:
+                if file.did in pfns:
+                    file.replicas = [Replica(pfns[file.did], rse, Status.ONLINE, rse.distance)]
+                else:
+                    file.replicas = [next(replica for replica in file.replicas
+                                          if replica.rse is rse and replica.status.good)]
+            rule = {
+                'rse': rse.name,
+                'site': chunk.site,
+                'lifetime': lifetime,
+                'size': sum(file.size or 0 for file in moved),
+                'dids': [file.did for file in moved]
+            }
+            if cfg.mode == 'rules' and moved:
+                rule['rule_ids'] = await client.add_rule(rule['dids'], rse.name, lifetime)
+            rules.append(rule)
+        name = os.path.join(self.dir, "rules.json")
+        with open(name, 'w', encoding="utf-8") as fjson:
+            fjson.write(json.dumps(rules, indent=2))
+        n_files = sum(len(rule['dids']) for rule in rules)
+        if cfg.mode == 'rules':
+            io_utils.log_print(f"Created Rucio rules to replicate {n_files} input files, "
+                               "wait for them to finish before submitting the merge jobs")
+        else:
+            io_utils.log_print(f"Wrote Rucio rules to replicate {n_files} input files to {name}, "
+                               "create them and wait for them to finish before submitting")
+        return rules
+
+    async def release(self, chunks: list[MergeChunk]) -> None:
+        """
+        Consolidate fragmented chunks, then write merge specs for each scheduled chunk
+        once its inputs have been staged.
+
+        :param chunks: list of scheduled MergeChunk objects
+        """
+        await self.consolidate()
+        await super().release(chunks)
+
     def upload_cfg(self) -> None:
         """
         Make a tarball of the configuration files and upload them to cvmfs
@@ -462,6 +940,7 @@ class JustinScheduler(JobScheduler):
         cfg_base = os.path.join(str(config.job.dir), "config.tar")
         with tarfile.open(cfg_base,"w") as tar:
             add_file(tar, io_utils.find_runner("do_merge.py"))
+            add_file(tar, io_utils.find_runner("checksum_utils.py"))
             for dep in config.method.dependencies:
                 add_file(tar, dep)
 
@@ -526,7 +1005,7 @@ class JustinScheduler(JobScheduler):
             cmd += ['--env', f'EXTRA_PRODUCTS="{products}"']
         for output in config.method.outputs:
             name = str(output['name'])
-            cmd += ['--output-pattern', name.format(UUID='*')]
+            cmd += ['--output-pattern', naming.compile_template(name).render({'UUID': '*'})]
         if config.output.batch.rse:
             cmd += ['--output-rse', str(config.output.batch.rse)]
         return f"{' '.join(cmd)}\n"
@@ -568,11 +1047,11 @@ class JustinScheduler(JobScheduler):
                     "fi"
                 ]
                 f.write("\n".join(msg) + "\n")
-                for site in self.jobs[1]:
+                for site in self.jobs[tier]:
                     f.write(self.justin_cmd(tier, site))
             subprocess.run(['chmod', '+x', justin], check=False)
 
-            # Pass 2 submission script
+            # Pass 2+ submission script
             script_name = os.path.join(str(config.job.dir), f"submit_pass{tier+1}.sh")
             pass_cfgs = []
             for site_jobs in self.jobs[tier].values():
@@ -581,7 +1060,7 @@ class JustinScheduler(JobScheduler):
                 f.write("#!/bin/bash\n")
                 f.write(f"# This script will update the cfg files for pass {tier+1}\n")
                 pass2_fix = os.path.join(io_utils.src_dir(), 'pass2_fix.py')
-                f.write(f"python3 {pass2_fix} {self.dir} {' '.join(pass_cfgs)}\n")
+                f.write(f"python3 {pass2_fix} {self.dir} {tier+1} {' '.join(pass_cfgs)}\n")
             subprocess.run(['chmod', '+x', script_name], check=False)
             scripts.append(script_name)
 
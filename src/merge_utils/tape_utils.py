@@ -0,0 +1,165 @@
+"""Utility functions for interacting with the WLCG tape REST API on dCache and EOS endpoints."""
+
+import os
+import ssl
+import json
+import logging
+import asyncio
+import urllib.request
+import urllib.error
+
+logger = logging.getLogger(__name__)
+
+MAX_PATHS = 1000    # Maximum number of paths to send in a single request
+TIMEOUT = 60        # Timeout for requests in seconds
+
+class TapeAPIError(Exception):
+    """Error communicating with a tape REST API endpoint"""
+
+def ssl_context() -> ssl.SSLContext:
+    """
+    Create an SSL context using the grid CA certificates and X.509 proxy, if available.
+
+    :return: SSLContext for HTTPS requests
+    """
+    ctx = ssl.create_default_context()
+    capath = os.environ.get('X509_CERT_DIR', '/etc/grid-security/certificates')
+    if os.path.isdir(capath):
+        ctx.load_verify_locations(capath=capath)
+    proxy = os.environ.get('X509_USER_PROXY', f"/tmp/x509up_u{os.getuid()}")
+    if os.path.isfile(proxy):
+        ctx.load_cert_chain(proxy)
+    return ctx
+
+def bearer_token() -> str:
+    """
+    Find a WLCG bearer token, following the standard token discovery order.
+
+    :return: token string, or None if no token was found
+    """
+    token = os.environ.get('BEARER_TOKEN')
+    if token:
+        return token.strip()
+    token_files = [os.environ.get('BEARER_TOKEN_FILE')]
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        token_files.append(os.path.join(os.environ['XDG_RUNTIME_DIR'], f"bt_u{os.getuid()}"))
+    token_files.append(f"/tmp/bt_u{os.getuid()}")
+    for token_file in token_files:
+        if token_file and os.path.isfile(token_file):
+            with open(token_file, encoding="utf-8") as f:
+                return f.read().strip()
+    return None
+
+def request_json(url: str, data: dict = None, method: str = None) -> any:
+    """
+    Send a request to a tape REST API endpoint and parse the JSON response.
+
+    :param url: full URL of the endpoint
+    :param data: optional JSON body to send
+    :param method: HTTP method, defaults to POST if data is provided and GET otherwise
+    :return: parsed JSON response, or None for an empty response
+    :raises TapeAPIError: if the request failed
+    """
+    headers = {'Accept': 'application/json'}
+    body = None
+    if data is not None:
+        body = json.dumps(data).encode('utf-8')
+        headers['Content-Type'] = 'application/json'
+    token = bearer_token()
+    if token:
+        headers['Authorization'] = f"Bearer {token}"
+    req = urllib.request.Request(url, data=body, headers=headers, method=method)
+    context = ssl_context() if url.startswith('https') else None
+    try:
+        with urllib.request.urlopen(req, timeout=TIMEOUT, context=context) as res:
+            text = res.read().decode('utf-8')
+    except urllib.error.HTTPError as err:
+        raise TapeAPIError(f"HTTP error {err.code} from {url}: {err.reason}") from err
+    except (urllib.error.URLError, OSError) as err:
+        raise TapeAPIError(f"Failed to connect to {url}: {err}") from err
+    if not text.strip():
+        return None
+    try:
+        return json.loads(text)
+    except json.JSONDecodeError as err:
+        raise TapeAPIError(f"Invalid JSON response from {url}") from err
+
+async def archive_info(api_url: str, paths: list[str]) -> dict:
+    """
+    Asynchronously query the locality of a list of files, splitting large lists into
+    several requests of at most MAX_PATHS paths.
+
+    :param api_url: base URL of the tape REST API, e.g. 'https://host:3880/api/v1/tape'
+    :param paths: list of file paths in the storage namespace
+    :return: dictionary of {path: locality}, where locality is one of DISK, TAPE,
+             DISK_AND_TAPE, LOST, NONE or UNAVAILABLE, or None if the query for that file failed
+    :raises TapeAPIError: if any request failed
+    """
+    url = api_url.rstrip('/') + '/archiveinfo'
+    chunks = [paths[i:i+MAX_PATHS] for i in range(0, len(paths), MAX_PATHS)]
+    logger.debug("Querying locality of %d files from %s", len(paths), url)
+    results = await asyncio.gather(*[
+        asyncio.to_thread(request_json, url, {'paths': chunk}) for chunk in chunks
+    ])
+    localities = {}
+    for res in results:
+        for entry in res or []:
+            path = entry.get('path')
+            if 'error' in entry:
+                logger.debug("Locality query failed for %s: %s", path, entry['error'])
+            localities[path] = entry.get('locality')
+    return localities
+
+async def stage(api_url: str, paths: list[str], lifetime: str = None) -> list[str]:
+    """
+    Asynchronously submit bulk requests to stage a list of files from tape to disk,
+    splitting large lists into several requests of at most MAX_PATHS paths.
+
+    :param api_url: base URL of the tape REST API, e.g. 'https://host:3880/api/v1/tape'
+    :param paths: list of file paths in the storage namespace
+    :param lifetime: optional disk lifetime as an ISO 8601 duration, e.g. 'P7D'
+    :return: list of stage request IDs
+    :raises TapeAPIError: if any request failed
+    """
+    url = api_url.rstrip('/') + '/stage'
+    chunks = [paths[i:i+MAX_PATHS] for i in range(0, len(paths), MAX_PATHS)]
+    logger.debug("Requesting staging of %d files from %s", len(paths), url)
+    bodies = []
+    for chunk in chunks:
+        files = [{'path': path} for path in chunk]
+        if lifetime:
+            for file in files:
+                file['diskLifetime'] = lifetime
+        bodies.append({'files': files})
+    results = await asyncio.gather(*[
+        asyncio.to_thread(request_json, url, body) for body in bodies
+    ])
+    request_ids = []
+    for res in results:
+        if not isinstance(res, dict) or 'requestId' not in res:
+            raise TapeAPIError(f"No stage request ID in response from {url}")
+        request_ids.append(res['requestId'])
+    return request_ids
+
+async def stage_status(api_url: str, request_id: str) -> dict:
+    """
+    Asynchronously query the progress of a stage request.
+
+    :param api_url: base URL of the tape REST API
+    :param request_id: stage request ID returned by stage()
+    :return: dictionary of {path: state}, where state is COMPLETED once the file is on disk,
+             or one of SUBMITTED, STARTED, FAILED or CANCELLED otherwise
+    :raises TapeAPIError: if the request failed
+    """
+    url = api_url.rstrip('/') + f"/stage/{request_id}"
+    res = await asyncio.to_thread(request_json, url)
+    states = {}
+    for entry in (res or {}).get('files', []):
+        path = entry.get('path')
+        if entry.get('onDisk'):
+            states[path] = 'COMPLETED'
+            continue
+        states[path] = entry.get('state', 'SUBMITTED')
+        if 'error' in entry:
+            logger.debug("Staging failed for %s: %s", path, entry['error'])
+    return states
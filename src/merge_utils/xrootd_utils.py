@@ -0,0 +1,180 @@
+"""Utility functions for accessing xRootD servers over persistent connections."""
+from __future__ import annotations
+
+import logging
+import asyncio
+import math
+from dataclasses import dataclass
+from types import SimpleNamespace
+from typing import Callable
+
+logger = logging.getLogger(__name__)
+
+# The XRootD python bindings are optional, callers fall back to xrdfs without them
+client = None # pylint: disable=invalid-name
+HAS_XROOTD = None
+
+ERRNO_NOT_FOUND = 3011  # kXR_NotFound
+QUERY_CHECKSUM = 3      # kXR_Qcksum
+FLAG_READABLE = 16      # StatInfoFlags.IS_READABLE
+
+# Extra time to wait for a callback after the client's own timeout, in seconds
+CALLBACK_GRACE = 5.0
+# Status for operations whose callback never arrived, treated as a client-side failure
+TIMED_OUT = SimpleNamespace(ok=False, errno=0, message="[ERROR] Operation expired")
+
+def import_xrootd() -> bool:
+    """
+    Import the XRootD python bindings on first use.
+
+    :return: True if the XRootD bindings are available
+    """
+    global client, HAS_XROOTD # pylint: disable=global-statement
+    if HAS_XROOTD is None:
+        try:
+            from XRootD import client #type: ignore pylint: disable=import-error,import-outside-toplevel,redefined-outer-name
+            HAS_XROOTD = True
+        except ImportError:
+            logger.info("XRootD python bindings not found, falling back to xrdfs subprocesses")
+            HAS_XROOTD = False
+    return HAS_XROOTD
+
+class XRootDError(Exception):
+    """Error returned by an xRootD server"""
+
+    def __init__(self, message: str, missing: bool = False, transport: bool = False):
+        """
+        Initialize the error.
+
+        :param message: error message
+        :param missing: True if the server reported that the file does not exist
+        :param transport: True if the server did not respond, e.g. a connection error or timeout
+        """
+        super().__init__(message)
+        self.missing = missing
+        self.transport = transport
+
+@dataclass
+class StatInfo:
+    """Basic information about a remote file"""
+    size: int
+    readable: bool = True
+
+class SessionPool:
+    """Pool of persistent xRootD sessions, with one FileSystem object per server"""
+
+    def __init__(self, factory: Callable = None):
+        """
+        Initialize the SessionPool.
+
+        :param factory: optional callable to create a session from a server URL,
+                        defaults to XRootD.client.FileSystem
+        """
+        self.factory = factory
+        self.sessions = {}
+
+    @property
+    def available(self) -> bool:
+        """Return True if persistent sessions can be used"""
+        return self.factory is not None or import_xrootd()
+
+    def session(self, server: str):
+        """
+        Get the session for a server, opening a new one if needed.
+
+        :param server: server URL of the form 'root://host:port'
+        :return: FileSystem object connected to the server
+        """
+        fs = self.sessions.get(server)
+        if fs is None:
+            logger.debug("Opening xRootD session to %s", server)
+            factory = self.factory or client.FileSystem
+            fs = factory(server)
+            self.sessions[server] = fs
+        return fs
+
+    def close(self) -> None:
+        """Drop all open sessions"""
+        self.sessions.clear()
+
+    @staticmethod
+    def check_status(status, server: str, path: str) -> None:
+        """
+        Raise an XRootDError if an operation failed.
+
+        :param status: XRootDStatus object returned by the operation
+        :param server: server URL
+        :param path: file path on the server
+        """
+        if status.ok:
+            return
+        if status.errno == ERRNO_NOT_FOUND:
+            raise XRootDError(f"No such file {server}/{path}", missing=True)
+        # Errors reported by the server carry an errno, client-side failures do not
+        raise XRootDError(f"Failed to access {server}/{path}\n  {str(status.message).strip()}",
+                          transport=not status.errno)
+
+    @staticmethod
+    async def call(method: Callable, *args, timeout: float = 1) -> tuple:
+        """
+        Run an asynchronous XRootD client operation without tying up a thread. The bindings
+        run the callback on their own thread, so the result is handed back to the event loop.
+
+        :param method: FileSystem method to call
+        :param args: positional arguments for the method
+        :param timeout: timeout for the operation in seconds
+        :return: tuple of (XRootDStatus, response)
+        """
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def resolve(status, response) -> None:
+            if not future.done():
+                future.set_result((status, response))
+
+        def callback(status, response, hostlist=None) -> None: # pylint: disable=unused-argument
+            loop.call_soon_threadsafe(resolve, status, response)
+
+        submitted = method(*args, timeout=math.ceil(timeout), callback=callback)
+        if not submitted.ok:
+            return submitted, None
+        # The client enforces the timeout itself, this only guards against a lost callback
+        try:
+            return await asyncio.wait_for(future, timeout + CALLBACK_GRACE)
+        except asyncio.TimeoutError:
+            return TIMED_OUT, None
+
+    async def stat(self, server: str, path: str, timeout: float = 1) -> StatInfo:
+        """
+        Get the size and permissions of a remote file.
+
+        :param server: server URL of the form 'root://host:port'
+        :param path: file path on the server
+        :param timeout: timeout for the operation in seconds
+        :return: StatInfo object for the file
+        :raises XRootDError: if the operation failed
+        """
+        fs = self.session(server)
+        status, info = await self.call(fs.stat, path, timeout=timeout)
+        self.check_status(status, server, path)
+        return StatInfo(size=int(info.size), readable=bool(info.flags & FLAG_READABLE))
+
+    async def checksum(self, server: str, path: str, timeout: float = 1) -> str:
+        """
+        Query the checksum of a remote file.
+
+        :param server: server URL of the form 'root://host:port'
+        :param path: file path on the server
+        :param timeout: timeout for the operation in seconds
+        :return: checksum response in the same format as 'xrdfs query checksum'
+        :raises XRootDError: if the operation failed
+        """
+        fs = self.session(server)
+        status, response = await self.call(fs.query, QUERY_CHECKSUM, path, timeout=timeout)
+        self.check_status(status, server, path)
+        if isinstance(response, bytes):
+            response = response.decode('utf-8', errors='replace')
+        return response.strip('\x00 \n')
+
+# Shared pool of sessions for all RSEs
+sessions = SessionPool()
@@ -0,0 +1,44 @@
+"""Calculate file checksums, shared by merge_utils and the merge runner"""
+
+import os
+import zlib
+import hashlib
+
+# Read buffer size for checksum calculations
+CHECKSUM_BUFFER = 8*1024*1024
+
+# This module only uses the standard library, since it is shipped in the job tarball next to
+# do_merge.py and runs on grid nodes where merge_utils is not installed.
+def checksums(path: str, algos: list[str] = None, buffer_size: int = CHECKSUM_BUFFER) -> dict:
+    """
+    Calculate several checksums of a file in a single pass, reading it in large chunks.
+    Adler-32 and CRC-32 use zlib, any other algorithm name is looked up in hashlib.
+    Both release the GIL on large buffers, so this can run in a worker thread without
+    blocking an event loop.
+
+    :param path: path to the local file
+    :param algos: names of the checksum algorithms to calculate, defaults to adler32
+    :param buffer_size: size of the read buffer in bytes
+    :return: dictionary of {algorithm: checksum} for each supported algorithm
+    """
+    running = {}
+    hashes = {}
+    for algo in algos or ['adler32']:
+        if algo in ('adler32', 'crc32'):
+            running[algo] = 1 if algo == 'adler32' else 0 # Adler-32 state starts at 1
+        elif algo in hashlib.algorithms_available:
+            hashes[algo] = hashlib.new(algo)
+    buf = bytearray(buffer_size)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while n := f.readinto(buf):
+            chunk = view[:n]
+            for algo, value in running.items():
+                running[algo] = getattr(zlib, algo)(chunk, value)
+            for hsh in hashes.values():
+                hsh.update(chunk)
+    results = {algo: f"{value:08x}" for algo, value in running.items()}
+    results.update({algo: hsh.hexdigest() for algo, hsh in hashes.items()})
+    return results
@@ -9,17 +9,10 @@ import shutil
 import socket
 from datetime import datetime, timezone
 import tarfile
-import zlib
 import h5py #type: ignore pylint: disable=import-error
 import ROOT #type: ignore pylint: disable=import-error
-
-def checksums(filename: str, chunk_size=8192) -> dict:
-    """Calculate the Adler-32 checksum of a file, working in chunks"""
-    checksum = 1  # Adler-32 state must be initialized to 1 (not 0)
-    with open(filename, "rb") as f:
-        while chunk := f.read(chunk_size):
-            checksum = zlib.adler32(chunk, checksum)
-    return {'adler32': "%08x" % checksum}
+# Shipped alongside this script in the job tarball
+from checksum_utils import checksums #type: ignore pylint: disable=import-error
 
 def list_root(folder, base="") -> list:
     """
@@ -190,6 +183,7 @@ def get_settings(config: dict, script_dir: str) -> dict:
     """Get the merging settings from the config"""
     settings = config.pop('settings', {})
     settings.setdefault('streaming', False)
+    settings.setdefault('checksums', ['adler32'])
     # Merge method settings
     if 'cfg' in settings:
         settings['cfg'] = os.path.join(script_dir, settings['cfg'])
@@ -243,7 +237,7 @@ def get_outputs(config: dict, script_dir: str, out_dir: str) -> list[dict]:
             print(f"WARNING: Output {i} JSON file {json_path} already exists, renaming to {old}")
     return outputs
 
-def write_metadata(outputs: list[dict], out_dir: str, config: dict) -> None:
+def write_metadata(outputs: list[dict], out_dir: str, config: dict, algos: list[str]) -> None:
     """Write file metadata to JSON files"""
     valid = True
     for output in outputs:
@@ -269,7 +263,9 @@ def write_metadata(outputs: list[dict], out_dir: str, config: dict) -> None:
         metadata['metadata'].update(output.get('metadata', {}))
         metadata['name'] = name
         metadata['size'] = size
-        metadata['checksums'] = checksums(path)
+        metadata['checksums'] = checksums(path, algos)
+        for algo in set(algos or []) - set(metadata['checksums']):
+            print(f"WARNING: Unsupported checksum algorithm {algo}")
         # Write metadata to JSON file
         with open(path+'.json', 'w', encoding="utf-8") as fjson:
             fjson.write(json.dumps(metadata, indent=2))
@@ -308,7 +304,7 @@ def merge(config: dict, script_dir: str, out_dir: str) -> None:
         print(f"ERROR: Merging failed with return code {ret.returncode}")
         sys.exit(ret.returncode)
 
-    write_metadata(outputs, out_dir, config)
+    write_metadata(outputs, out_dir, config, settings['checksums'])
 
     # Clean up temporary files
     if len(tmp_files) > 0:
@@ -0,0 +1,21 @@
+"""Tests for the config_keys module"""
+
+from merge_utils import config_keys
+from merge_utils.config_keys import ConfigStrList
+
+def test_str_list_grow():
+    """Test that a ConfigStrList can be grown in place"""
+    key = ConfigStrList('test.str_list')
+    rev = config_keys.revision
+    key.append(1)
+    key.append(None)
+    assert config_keys.revision > rev
+    rev = config_keys.revision
+    key.extend(['a', 2.5])
+    key.extend(None)
+    assert config_keys.revision > rev
+    assert key._freeze() == ('1', 'a', '2.5') # pylint: disable=protected-access
+    rev = config_keys.revision
+    key[0] = 0
+    assert config_keys.revision > rev
+    assert key._json() == ['0', 'a', '2.5'] # pylint: disable=protected-access
@@ -0,0 +1,13 @@
+"""Shared setup for the merge-utils tests"""
+
+import pytest
+from merge_utils import config
+
+@pytest.fixture(name="cache_dir", scope="session", autouse=True)
+def fixture_cache_dir(tmp_path_factory):
+    """Keep every cache in a fresh directory for each test run, then load the default config"""
+    path = tmp_path_factory.mktemp("cache")
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setenv("MERGE_UTILS_CACHE", str(path))
+        config.load()  # Load the default configuration for testing
+        yield path
@@ -0,0 +1,99 @@
+"""Tests for the distance matrix module"""
+
+from types import SimpleNamespace
+import pytest
+from merge_utils import distance_matrix
+from merge_utils.distance_matrix import DistanceMatrix
+from merge_utils.replicas import Replica, Status
+
+INF = float('inf')
+
+DISTANCES = {
+    "RSE_A": {"SITE_1": 1.0, "SITE_2": 5.0},
+    "RSE_B": {"SITE_2": 2.0, "SITE_3": 3.0},
+}
+
+def make_file(did, replicas):
+    """Make a file with replicas given as (RSE name, replica distance, status)"""
+    return SimpleNamespace(did=did, replicas=[
+        Replica(f"root://host//{did}", SimpleNamespace(name=rse), status, dist)
+        for rse, dist, status in replicas
+    ])
+
+FILES = [
+    make_file("f1", [("RSE_A", 0.0, Status.ONLINE), ("RSE_B", 0.0, Status.ONLINE)]),
+    make_file("f2", [("RSE_A", 10.0, Status.NEARLINE), ("RSE_B", 0.0, Status.ONLINE)]),
+    make_file("f3", [("RSE_A", 0.0, Status.ONLINE), ("RSE_B", 0.0, Status.MISSING)]),
+]
+
+@pytest.fixture(name="numpy", params=[True, False], ids=["numpy", "python"])
+def fixture_numpy(request, monkeypatch):
+    """Run each test with and without NumPy"""
+    if request.param:
+        pytest.importorskip("numpy")
+        distance_matrix.import_numpy()
+    monkeypatch.setattr(distance_matrix, "HAS_NUMPY", request.param)
+    return request.param
+
+def test_file_distances(numpy): # pylint: disable=unused-argument
+    """Each file gets the minimum distance over its good replicas"""
+    matrix = DistanceMatrix(FILES, DISTANCES)
+    assert matrix.file(FILES[0]) == {"SITE_1": 1.0, "SITE_2": 2.0, "SITE_3": 3.0}
+    assert matrix.file(FILES[1]) == {"SITE_1": 11.0, "SITE_2": 2.0, "SITE_3": 3.0}
+    assert matrix.file(FILES[2]) == {"SITE_1": 1.0, "SITE_2": 5.0, "SITE_3": INF}
+
+def test_chunk_distances(numpy): # pylint: disable=unused-argument
+    """Chunk distances are sums, and unreachable files make the site unreachable"""
+    matrix = DistanceMatrix(FILES, DISTANCES)
+    assert matrix.chunk(FILES[:2]) == {"SITE_1": 12.0, "SITE_2": 4.0, "SITE_3": 6.0}
+    assert matrix.chunk(FILES) == {"SITE_1": 13.0, "SITE_2": 9.0, "SITE_3": INF}
+    assert matrix.best_sites(FILES) == ["SITE_1", "SITE_2", "SITE_1"]
+
+def test_no_replicas(numpy): # pylint: disable=unused-argument
+    """Files without good replicas raise an error"""
+    bad = make_file("bad", [("RSE_A", 0.0, Status.MISSING)])
+    matrix = DistanceMatrix([bad], DISTANCES)
+    with pytest.raises(RuntimeError):
+        matrix.file(bad)
+
+def test_min_cost_flow():
+    """Supply is sent to the cheapest sinks with free capacity"""
+    costs = [[1.0, 5.0, INF], [1.0, 2.0, -1.0], [INF, INF, INF]]
+    flows = distance_matrix.min_cost_flow([4, 4, 1], [5, None, 2], costs)
+    assert flows == [[4, 0, 0], [1, 1, 2], [0, 0, 0]]
+
+def test_assign(numpy): # pylint: disable=unused-argument
+    """Files overflow to their next best site once the nearest site is full"""
+    files = [make_file(f"a{i}", [("RSE_A", 0.0, Status.ONLINE)]) for i in range(3)]
+    files += [make_file(f"b{i}", [("RSE_A", 0.0, Status.ONLINE), ("RSE_B", 0.0, Status.ONLINE)])
+              for i in range(3)]
+    matrix = DistanceMatrix(files, DISTANCES)
+    assert matrix.assign(files, {}) == ["SITE_1"] * 6
+    sites = matrix.assign(files, {"SITE_1": 4})
+    assert sites[:3] == ["SITE_1"] * 3
+    assert sorted(sites[3:]) == ["SITE_1", "SITE_2", "SITE_2"]
+    sites = matrix.assign(files, {"SITE_1": 2, "SITE_2": 0, "SITE_3": 0})
+    assert sites.count(None) == 4
+
+def test_backends_agree(monkeypatch):
+    """The NumPy and pure python matrices give the same distances and assignments"""
+    pytest.importorskip("numpy")
+    distance_matrix.import_numpy()
+    distances = {
+        f"RSE_{rse}": {f"SITE_{site}": float((rse * 7 + site * 3) % 11)
+                       for site in range(5) if (rse + site) % 4}
+        for rse in range(6)
+    }
+    statuses = [Status.ONLINE, Status.NEARLINE, Status.MISSING]
+    files = [make_file(f"f{idx}", [(f"RSE_{(idx + rep) % 6}", float((idx * rep) % 5),
+                                    statuses[(idx + rep) % 3]) for rep in range(idx % 4)])
+             for idx in range(40)]
+    results = []
+    for numpy in (True, False):
+        monkeypatch.setattr(distance_matrix, "HAS_NUMPY", numpy)
+        matrix = DistanceMatrix(files, distances)
+        assert isinstance(matrix.data, list) != numpy
+        rows = [[float(dist) for dist in matrix.data[row]] for row in range(len(files))]
+        results.append((rows, matrix.chunk(files[::3]), matrix.best_sites(files),
+                        matrix.assign(files, {"SITE_1": 5, "SITE_2": 8})))
+    assert results[0] == results[1]
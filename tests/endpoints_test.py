@@ -0,0 +1,101 @@
+"""Tests for the endpoints module"""
+
+import asyncio
+import collections
+from merge_utils import config
+from merge_utils.endpoints import EndpointQueue, HealthMonitor, CLOSED, OPEN, HALF_OPEN
+
+async def run_queue(queue: EndpointQueue, jobs: list, workers: int, delays: dict) -> tuple:
+    """Process jobs with several workers, recording the order and peak concurrency per RSE and host"""
+    order = []
+    active = collections.Counter()
+    peak = collections.Counter()
+    async def worker():
+        while (job := await queue.get()) is not None:
+            key, item = job
+            order.append(item)
+            for name in key:
+                active[name] += 1
+                peak[name] = max(peak[name], active[name])
+            await asyncio.sleep(delays.get(key[0], 0.01))
+            for name in key:
+                active[name] -= 1
+            await queue.done(key)
+    for key, item in jobs:
+        await queue.put(key, item)
+    tasks = [asyncio.create_task(worker()) for _ in range(workers)]
+    await queue.join()
+    await queue.close()
+    await asyncio.gather(*tasks)
+    return order, peak
+
+def test_limits():
+    """A slow RSE only gets its own share of the workers"""
+    jobs = [(("SLOW", "slow.host"), f"slow{i}") for i in range(20)]
+    jobs += [(("FAST", "fast.host"), f"fast{i}") for i in range(20)]
+    queue = EndpointQueue(rse_limit=2, host_limit=0)
+    order, peak = asyncio.run(run_queue(queue, jobs, 8, {"SLOW": 0.05}))
+    assert peak["SLOW"] == 2
+    assert peak["FAST"] == 2
+    # All of the fast jobs finish before most of the slow ones start
+    assert order.index("fast19") < order.index("slow10")
+    assert len(order) == 40
+
+def test_host_limit():
+    """Hosts shared by several RSEs are limited as a whole"""
+    jobs = [((f"RSE{i % 4}", "shared.host"), i) for i in range(20)]
+    queue = EndpointQueue(rse_limit=0, host_limit=3)
+    _, peak = asyncio.run(run_queue(queue, jobs, 10, {}))
+    assert peak["shared.host"] == 3
+
+def test_round_robin():
+    """Items for different endpoints are interleaved"""
+    jobs = [(("A", "a.host"), f"a{i}") for i in range(3)]
+    jobs += [(("B", "b.host"), f"b{i}") for i in range(3)]
+    queue = EndpointQueue()
+    order, _ = asyncio.run(run_queue(queue, jobs, 1, {}))
+    assert order == ["a0", "b0", "a1", "b1", "a2", "b2"]
+
+def test_adaptive_timeout():
+    """Timeouts follow the p99 latency of each host once there are enough samples"""
+    monitor = HealthMonitor()
+    key = ("RSE1", "host1")
+    assert monitor.timeout(key) == 1.0
+    for latency in range(100, 1100, 100):
+        monitor.record(key, True, latency)
+    assert monitor.timeout(key) == 2.0
+    # Limited by the configured range
+    for _ in range(10):
+        monitor.record(key, False, 60000)
+    assert monitor.timeout(key) == 10.0
+    assert monitor.timeout(("RSE1", "host2")) == 1.0
+
+def test_circuit_breaker():
+    """Failing endpoints are skipped, then re-tested with a few sample requests"""
+    cooldown = config.validation.health.cooldown.value
+    monitor = HealthMonitor()
+    key = ("RSE1", "host1")
+    for _ in range(10):
+        assert monitor.allow(key)
+        monitor.record(key, False, 1000)
+    assert monitor.endpoints[key].state == OPEN
+    assert monitor.is_open(key)
+    assert not monitor.allow(key)
+    # Other endpoints on the same RSE are unaffected
+    assert monitor.allow(("RSE1", "host2"))
+    try:
+        config.validation.health.cooldown = 0.0
+        # Only a limited number of probes are let through
+        assert [monitor.allow(key) for _ in range(4)] == [True, True, True, False]
+        assert monitor.endpoints[key].state == HALF_OPEN
+        # A failed probe reopens the circuit
+        monitor.record(key, False, 1000)
+        assert monitor.endpoints[key].state == OPEN
+        for _ in range(3):
+            assert monitor.allow(key)
+        for _ in range(3):
+            monitor.record(key, True, 10)
+        assert monitor.endpoints[key].state == CLOSED
+        assert not monitor.is_open(key)
+    finally:
+        config.validation.health.cooldown = cooldown
@@ -0,0 +1,87 @@
+"""Tests for the io_utils module"""
+
+import os
+import time
+import zlib
+import asyncio
+import hashlib
+import subprocess
+import pytest
+from merge_utils import io_utils
+from runners import checksum_utils
+
+def test_run_cmd():
+    """Test capturing the output and return code of a command"""
+    ret = asyncio.run(io_utils.run_cmd(['sh', '-c', 'echo out; echo err >&2; exit 3']))
+    assert ret.returncode == 3
+    assert ret.stdout == "out\n"
+    assert ret.stderr == "err\n"
+
+def test_run_cmd_timeout():
+    """A timeout kills the whole process group, even if a child holds the output pipe"""
+    start = time.monotonic()
+    with pytest.raises(subprocess.TimeoutExpired):
+        asyncio.run(io_utils.run_cmd(['sh', '-c', 'sleep 10 & sleep 10'], timeout=0.2))
+    assert time.monotonic() - start < 5
+
+def test_run_cmd_cancel():
+    """Cancelling the calling task stops the command"""
+    async def cancel():
+        task = asyncio.create_task(io_utils.run_cmd(['sleep', '10']))
+        await asyncio.sleep(0.2)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+    start = time.monotonic()
+    asyncio.run(cancel())
+    assert time.monotonic() - start < 5
+
+@pytest.mark.parametrize('size', [0, 1000, checksum_utils.CHECKSUM_BUFFER + 12345])
+def test_checksums(tmp_path, size):
+    """Test single-pass checksums against zlib and hashlib, on both sides of the buffer size"""
+    data = os.urandom(size)
+    path = tmp_path / "data.bin"
+    path.write_bytes(data)
+    algos = ['adler32', 'crc32', 'md5', 'sha256']
+    expected = {
+        'adler32': f"{zlib.adler32(data):08x}",
+        'crc32': f"{zlib.crc32(data):08x}",
+        'md5': hashlib.md5(data).hexdigest(),
+        'sha256': hashlib.sha256(data).hexdigest(),
+    }
+    assert io_utils.checksums(str(path), algos + ['bogus']) == expected
+    assert io_utils.checksums(str(path), algos, buffer_size=4096) == expected
+    assert checksum_utils.checksums(str(path), algos) == expected
+    assert io_utils.checksums(str(path), []) == {}
+
+def test_cache_dir(monkeypatch):
+    """The cache directory defaults to the user's cache directory"""
+    monkeypatch.setenv("MERGE_UTILS_CACHE", "/some/cache")
+    assert io_utils.cache_dir() == "/some/cache"
+    monkeypatch.delenv("MERGE_UTILS_CACHE")
+    monkeypatch.setenv("XDG_CACHE_HOME", "/xdg")
+    assert io_utils.cache_dir() == "/xdg/merge-utils"
+    monkeypatch.delenv("XDG_CACHE_HOME")
+    monkeypatch.setenv("HOME", "/home/user")
+    assert io_utils.cache_dir() == "/home/user/.cache/merge-utils"
+
+def test_read_cached_config(tmp_path, monkeypatch):
+    """Parsed config files are cached as JSON until they are modified"""
+    monkeypatch.setenv("MERGE_UTILS_CACHE", str(tmp_path / "cache"))
+    path = tmp_path / "test.yaml"
+    path.write_text("a: 1\nb: [x, y]\n", encoding="utf-8")
+    assert io_utils.read_cached_config(str(path)) == {'a': 1, 'b': ['x', 'y']}
+    cached = list((tmp_path / "cache" / "config").iterdir())
+    assert [f.suffix for f in cached] == [".json"]
+    # The cached copy is used while the file is unchanged
+    cached[0].write_text(cached[0].read_text(encoding="utf-8").replace('"a": 1', '"a": 2'),
+                         encoding="utf-8")
+    assert io_utils.read_cached_config(str(path))['a'] == 2
+    path.write_text("a: 3\n", encoding="utf-8")
+    os.utime(path, ns=(0, 0))
+    assert io_utils.read_cached_config(str(path)) == {'a': 3}
+    # Values that JSON can't represent are never cached
+    path.write_text("1: one\n", encoding="utf-8")
+    os.utime(path, ns=(1, 1))
+    assert io_utils.read_cached_config(str(path)) == {1: 'one'}
+    assert io_utils.read_cached_config(str(path)) == {1: 'one'}
@@ -0,0 +1,83 @@
+"""Tests for the justin_utils module"""
+
+import os
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from merge_utils import config, justin_utils
+from merge_utils.justin_utils import SiteStorageTable
+
+CSV_PATH = os.path.join(os.path.dirname(__file__), "data", "sites_storages.csv")
+
+class SiteStorageHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the JustIN site-storage CSV endpoint"""
+    etag = '"v1"'
+    requests = []
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Send the site-storage table, unless the client already has this version"""
+        if self.path != justin_utils.SITE_STORAGE_URL:
+            self.send_error(404)
+            return
+        SiteStorageHandler.requests.append(self.headers.get('If-None-Match'))
+        if self.headers.get('If-None-Match') == SiteStorageHandler.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        with open(CSV_PATH, 'rb') as f:
+            data = f.read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/csv')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('ETag', SiteStorageHandler.etag)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Silence request logging"""
+
+@pytest.fixture(name="justin_url")
+def fixture_justin_url():
+    """Run a local JustIN stand-in and point the config at it"""
+    pytest.importorskip("requests")
+    SiteStorageHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), SiteStorageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    old_url, old_ttl = config.sites.justin_url.value, config.sites.justin_ttl.value
+    config.sites.justin_url = f"http://127.0.0.1:{server.server_port}"
+    yield str(config.sites.justin_url)
+    config.sites.justin_url = old_url
+    config.sites.justin_ttl = old_ttl
+    server.shutdown()
+    server.server_close()
+
+def test_site_rse_distances(justin_url, tmp_path, monkeypatch): # pylint: disable=unused-argument
+    """Distances include the site offsets, and skip disabled or excluded sites and RSEs"""
+    monkeypatch.setattr(justin_utils, "table", SiteStorageTable(str(tmp_path / "sites.json")))
+    distances = asyncio.run(justin_utils.get_site_rse_distances())
+    assert distances == {
+        "FNAL_DCACHE": {"US_FNAL-FermiGrid": -5.0, "CERN": 50.0},
+        "DUNE_CERN_EOS": {"US_FNAL-FermiGrid": 45.0, "CERN": 0.0},
+    }
+
+def test_table_cache(justin_url, tmp_path):
+    """The table is reused until it expires, then revalidated with its ETag"""
+    path = str(tmp_path / "sites.json")
+    url = justin_url + justin_utils.SITE_STORAGE_URL
+    rows = asyncio.run(SiteStorageTable(path).rows(url))
+    assert len(rows) == 7
+    assert SiteStorageHandler.requests == [None]
+    # A new run reads the table from disk without contacting JustIN
+    assert asyncio.run(SiteStorageTable(path).rows(url)) == rows
+    assert SiteStorageHandler.requests == [None]
+    # Once the table expires, an unchanged table is not downloaded again
+    config.sites.justin_ttl = 0.0
+    assert asyncio.run(SiteStorageTable(path).rows(url)) == rows
+    assert SiteStorageHandler.requests == [None, '"v1"']
+    # If JustIN is unavailable, the expired table is still used
+    table = SiteStorageTable(path)
+    table.load()['url'] = justin_url + "/missing.csv"
+    assert asyncio.run(table.rows(justin_url + "/missing.csv")) == rows
+    assert asyncio.run(SiteStorageTable(str(tmp_path / "new.json")).rows(url + ".bad")) is None
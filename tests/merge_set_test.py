@@ -1,10 +1,12 @@
 """Tests for the metacat utils module"""
 
+import copy
+from types import SimpleNamespace
 import pytest
-from merge_utils import config
-from merge_utils.merge_set import MergeFile, MergeFileError, MergeSet
-
-config.load()  # Load the default configuration for testing
+from merge_utils import config, meta
+from merge_utils.merge_set import MergeFile, MergeFileError, MergeSet, validate_files
+from merge_utils.distance_matrix import DistanceMatrix
+from merge_utils.replicas import Replica, Status
 
 FILE_DEFAULTS = {
     "namespace": "fardet-hd",
@@ -122,3 +124,98 @@ def test_merge_file(spec, errors):
             value = str(value)
         assert f_obj.get_fields([field]) == (f_dict['namespace'], value)
     assert f_obj.errors == errors
+
+def test_add_validated():
+    """Test adding pre-validated files to a MergeSet"""
+    files = [file_dict({'name': f"file{i}", 'fid': str(i)}) for i in range(3)]
+    files.append(file_dict({'name': "file3", 'fid': None}))
+    expected = MergeSet()
+    expected.add(5, files)
+    # Validate copies of the files, as a worker process would
+    records = validate_files(copy.deepcopy(files))
+    assert all(isinstance(record, tuple) for record in records)
+    merge_set = MergeSet()
+    added = merge_set.add(5, files, records)
+    assert [f.did for f in added] == [f.did for f in expected.good_files]
+    assert [f.errors for f in merge_set.all_files] == [f.errors for f in expected.all_files]
+    assert [f.metadata for f in added] == [f.metadata for f in expected.good_files]
+    assert merge_set.errors == expected.errors
+
+def test_validation_record():
+    """Metadata fixes made during validation are carried by the validation record"""
+    record = MergeFile({'namespace': "ns", 'name': "file0", 'errors': 'INVALID'}).record({})
+    assert record == (MergeFileError.INVALID.value, {}, [])
+    data = file_dict({'name': "file0", 'fid': "0", 'metadata': {}})
+    record = (0, {'core.data_tier': "fixed-tier"}, ['core.group'])
+    metadata = MergeFile(data, record).metadata
+    assert metadata['core.data_tier'] == "fixed-tier"
+    assert 'core.group' not in metadata
+    assert FILE_DEFAULTS['metadata']['core.group'] == "dune"
+
+@pytest.fixture(name="locality")
+def fixture_locality():
+    """Group by count with locality grouping enabled"""
+    grouping = config.output.grouping
+    old = {key: grouping[key].value for key in ['target', 'locality', 'tolerance']}
+    old['mode'] = str(grouping.mode)
+    grouping.mode = 'count'
+    grouping.target = 4
+    grouping.locality = True
+    yield grouping
+    for key, value in old.items():
+        grouping[key] = value
+
+def locality_set():
+    """Make a MergeSet with files nearest to SITE_1 or SITE_2, and their distance matrix"""
+    files = [file_dict({'name': f"file{i}", 'fid': str(i),
+                        'metadata': {'dune_mc.gen_fcl_filename': "gen.fcl"}}) for i in range(10)]
+    merge_set = MergeSet()
+    merge_set.add(0, files)
+    for idx, file in enumerate(merge_set.good_files):
+        file.replicas = [Replica(f"root://a//{file.name}", SimpleNamespace(name="RSE_A"),
+                                 Status.ONLINE, 0.0 if idx % 3 else 10.0)]
+        if idx % 3 == 0:
+            file.replicas.append(Replica(f"root://b//{file.name}", SimpleNamespace(name="RSE_B"),
+                                         Status.ONLINE, 0.0))
+    distances = {"RSE_A": {"SITE_1": 1.0}, "RSE_B": {"SITE_2": 2.0}}
+    return merge_set, DistanceMatrix(merge_set.good_files, distances)
+
+def test_locality_groups(locality, monkeypatch):
+    """Files are grouped separately at each merging site"""
+    monkeypatch.setattr(meta, "make_names", lambda files: None)
+    merge_set, matrix = locality_set()
+    assert merge_set.site_partitions(range(10), matrix) == [[0, 3, 6, 9], [1, 2, 4, 5, 7, 8]]
+    groups = list(merge_set.groups(matrix))
+    assert [[f.name for f in group.files] for group in groups] == [
+        ["file0", "file3", "file6", "file9"], ["file1", "file2", "file4"], ["file5", "file7", "file8"]
+    ]
+    assert [(group.skip, group.limit, group.group) for group in groups] == [
+        (None, None, 0), (None, None, 1), (None, None, 5)
+    ]
+    md = groups[1].metadata
+    assert md['merge.group'] == 1
+    assert 'merge.skip' not in md and 'merge.limit' not in md
+    # The group number keeps the output names unique, including those of child chunks
+    names = {group.make_name("out_{UUID}.root", []) for group in groups}
+    assert len(names) == 3
+    assert groups[1].make_child(groups[1].files).group == 1
+    # Without a distance matrix, files are grouped in order
+    groups = list(merge_set.groups())
+    assert [len(group) for group in groups] == [3, 4, 3]
+    assert [(group.skip, group.limit) for group in groups] == [(0, 3), (3, 4), (7, 3)]
+    assert all(group.group is None for group in groups)
+    # Small sites are merged into other sites
+    locality.tolerance = 1.1
+    assert merge_set.site_partitions(range(10), matrix) == [list(range(10))]
+    assert len(list(merge_set.groups(matrix))) == 3
+
+def test_locality_partitions_by_size(locality):
+    """Site partitions are measured by size, as the sum of the inputs without a size spec"""
+    merge_set, matrix = locality_set()
+    locality.mode = 'size'
+    locality.target = 1.0
+    locality.tolerance = 0.05
+    assert merge_set.site_partitions(range(10), matrix) == [[0, 3, 6, 9], [1, 2, 4, 5, 7, 8]]
+    # About 0.1 GB of files are nearest to SITE_2 and 0.15 GB to SITE_1
+    locality.tolerance = 0.12
+    assert merge_set.site_partitions(range(10), matrix) == [list(range(10))]
@@ -0,0 +1,27 @@
+"""Tests for the naming module"""
+
+import pytest
+from merge_utils import naming
+
+@pytest.mark.parametrize("name, expected", [
+    ("a", ("a", [])),
+    ("0", (0, [])),
+    ("a.b.c", ("a", [(True, "b"), (True, "c")])),
+    ("a[0]", ("a", [(False, 0)])),
+    ("a[-1]", ("a", [(False, "-1")])),
+    ("a[key].b[1][x y]", ("a", [(False, "key"), (True, "b"), (False, 1), (False, "x y")])),
+])
+def test_split_field_name(name, expected):
+    """Field names are split the same way as str.format() does"""
+    assert naming.split_field_name(name) == expected
+
+@pytest.mark.parametrize("name", ["a.", "a[", "a[]", "a[0]b", "a..b"])
+def test_split_field_name_errors(name):
+    """Malformed field names are rejected"""
+    with pytest.raises(ValueError):
+        naming.split_field_name(name)
+
+def test_render():
+    """Templates look up attributes and indices of their fields"""
+    template = naming.compile_template("{a.real}_{b[1]}_{c[k]!r:>5}")
+    assert template.render({'a': 3, 'b': [1, 2], 'c': {'k': 'v'}}) == "3_2_  'v'"
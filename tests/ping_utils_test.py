@@ -0,0 +1,73 @@
+"""Tests for the ping_utils module"""
+
+import json
+import asyncio
+import pytest
+from merge_utils import ping_utils
+from merge_utils.ping_utils import PingCache
+
+RTTS = {"near.host": 1.5, "far.host": 80.0, "down.host": float('inf')}
+
+@pytest.fixture(name="pinged")
+def fixture_pinged(monkeypatch):
+    """Replace real pings with fixed round-trip times, recording each host pinged"""
+    pinged = []
+    async def fake_ping(host, timeout=2): # pylint: disable=unused-argument
+        pinged.append(host)
+        await asyncio.sleep(0.01)
+        return RTTS[host]
+    monkeypatch.setattr(ping_utils, "ping", fake_ping)
+    return pinged
+
+def test_ping_saved(tmp_path, pinged):
+    """Successful pings are saved and reused by later runs"""
+    path = str(tmp_path / "pings.json")
+    cache = PingCache(path)
+    rtts = asyncio.run(cache.ping({"near.host", "far.host"}))
+    assert rtts == {"near.host": 1.5, "far.host": 80.0}
+    assert sorted(pinged) == ["far.host", "near.host"]
+    cache = PingCache(path)
+    assert asyncio.run(cache.ping({"near.host"})) == {"near.host": 1.5}
+    assert len(pinged) == 2
+
+def test_ping_concurrent(tmp_path, pinged):
+    """Concurrent callers share a single ping per host"""
+    cache = PingCache(str(tmp_path / "pings.json"))
+    async def run():
+        return await asyncio.gather(cache.ping({"near.host"}), cache.ping({"near.host"}))
+    assert asyncio.run(run()) == [{"near.host": 1.5}, {"near.host": 1.5}]
+    assert pinged == ["near.host"]
+
+def test_ping_failure(tmp_path, pinged):
+    """Failed pings are remembered for this run only"""
+    path = str(tmp_path / "pings.json")
+    cache = PingCache(path)
+    assert asyncio.run(cache.ping({"down.host"})) == {"down.host": float('inf')}
+    assert asyncio.run(cache.ping({"down.host"})) == {"down.host": float('inf')}
+    assert pinged == ["down.host"]
+    with open(path, encoding="utf-8") as f:
+        assert json.load(f) == {}
+    cache = PingCache(path)
+    asyncio.run(cache.ping({"down.host"}))
+    assert pinged == ["down.host", "down.host"]
+
+def test_ping_expired(tmp_path, pinged):
+    """Entries older than the ping TTL are pinged again"""
+    path = tmp_path / "pings.json"
+    path.write_text(json.dumps({"near.host": [9.0, 0.0]}), encoding="utf-8")
+    cache = PingCache(str(path))
+    assert cache.get("near.host") is None
+    assert asyncio.run(cache.ping({"near.host"})) == {"near.host": 1.5}
+    assert pinged == ["near.host"]
+
+@pytest.mark.parametrize("content", [
+    "{not json", "[1, 2, 3]", '{"near.host": 5}', '{"near.host": ["a"]}'
+])
+def test_ping_corrupt(tmp_path, pinged, content):
+    """A corrupt cache file is ignored and replaced"""
+    path = tmp_path / "pings.json"
+    path.write_text(content, encoding="utf-8")
+    cache = PingCache(str(path))
+    assert asyncio.run(cache.ping({"near.host"})) == {"near.host": 1.5}
+    assert pinged == ["near.host"]
+    assert json.loads(path.read_text(encoding="utf-8"))["near.host"][0] == 1.5
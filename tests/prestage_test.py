@@ -0,0 +1,144 @@
+"""Tests for the prestage module"""
+
+import re
+import json
+import asyncio
+import threading
+from types import SimpleNamespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from merge_utils import config, tape_utils
+from merge_utils.prestage import Prestager
+from merge_utils.replicas import Replica, Status
+
+POLLS_TO_STAGE = {
+    "/pnfs/dune/tape_backed/file1.root": 1,
+    "/pnfs/dune/tape_backed/file2.root": 3,
+}
+
+class StageHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the stage endpoints of a WLCG tape REST API"""
+    stage_requests = {}
+    polls = {}
+
+    def send_json(self, res, code=200):
+        """Send a JSON response"""
+        data = json.dumps(res).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Submit a stage request"""
+        if self.path != "/api/v1/tape/stage":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        request_id = f"req{len(StageHandler.stage_requests) + 1}"
+        StageHandler.stage_requests[request_id] = [file['path'] for file in body['files']]
+        StageHandler.polls[request_id] = 0
+        self.send_json({'requestId': request_id}, 201)
+
+    def do_GET(self): # pylint: disable=invalid-name
+        """Report the progress of a stage request"""
+        match = re.fullmatch(r"/api/v1/tape/stage/(\w+)", self.path)
+        if not match or match.group(1) not in StageHandler.stage_requests:
+            self.send_error(404)
+            return
+        request_id = match.group(1)
+        StageHandler.polls[request_id] += 1
+        files = []
+        for path in StageHandler.stage_requests[request_id]:
+            if path not in POLLS_TO_STAGE:
+                files.append({'path': path, 'state': 'FAILED', 'error': "No such file"})
+            elif StageHandler.polls[request_id] >= POLLS_TO_STAGE[path]:
+                files.append({'path': path, 'state': 'COMPLETED', 'onDisk': True})
+            else:
+                files.append({'path': path, 'state': 'STARTED', 'onDisk': False})
+        self.send_json({'id': request_id, 'files': files})
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Silence request logging"""
+
+@pytest.fixture(name="api_url")
+def fixture_api_url():
+    """Run a local tape REST API stand-in and return its base URL"""
+    StageHandler.stage_requests = {}
+    StageHandler.polls = {}
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/api/v1/tape"
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture(name="fast_polling")
+def fixture_fast_polling():
+    """Enable prestaging, and poll the stage endpoint without waiting"""
+    poll, max_wait = config.sites.prestage.poll.value, config.sites.prestage.max_wait.value
+    config.sites.prestage.enabled = True
+    config.sites.prestage.poll = 0.01
+    yield
+    config.sites.prestage.enabled = False
+    config.sites.prestage.poll = poll
+    config.sites.prestage.max_wait = max_wait
+
+def make_chunk(api_url, paths, status=Status.NEARLINE):
+    """Make a scheduled chunk with one replica per file"""
+    rse = SimpleNamespace(name="TAPE_RSE", tape_api=api_url, staging=10.0)
+    files = []
+    for path in paths:
+        replica = Replica(f"root://tape.host:1094{path}", rse, status, 10.0)
+        files.append(SimpleNamespace(replicas=[replica]))
+    return SimpleNamespace(files=files, children=[])
+
+async def release_order(chunks):
+    """Collect the chunks in the order they are released"""
+    return [chunk async for ready in Prestager().release(chunks) for chunk in ready]
+
+def test_stage(api_url):
+    """Test submitting a stage request and polling it"""
+    paths = list(POLLS_TO_STAGE)
+    assert asyncio.run(tape_utils.stage(api_url, paths)) == ["req1"]
+    states = asyncio.run(tape_utils.stage_status(api_url, "req1"))
+    assert states == {paths[0]: 'COMPLETED', paths[1]: 'STARTED'}
+    with pytest.raises(tape_utils.TapeAPIError):
+        asyncio.run(tape_utils.stage_status(api_url, "missing"))
+
+def test_release(api_url, fast_polling): # pylint: disable=unused-argument
+    """Chunks are released as soon as all of their inputs are on disk"""
+    slow = make_chunk(api_url, ["/pnfs/dune/tape_backed/file2.root"])
+    fast = make_chunk(api_url, ["/pnfs/dune/tape_backed/file1.root"])
+    online = make_chunk(api_url, ["/pnfs/dune/persistent/file3.root"], Status.ONLINE)
+    order = asyncio.run(release_order([slow, fast, online]))
+    assert order == [online, fast, slow]
+    # All nearline files go in one bulk request
+    assert len(StageHandler.stage_requests) == 1
+    for chunk in (slow, fast):
+        assert chunk.files[0].replicas[0].status == Status.ONLINE
+        assert chunk.files[0].replicas[0].distance == 0.0
+
+def test_release_failures(api_url, fast_polling): # pylint: disable=unused-argument
+    """Chunks are still released if staging fails or times out"""
+    failed = make_chunk(api_url, ["/pnfs/dune/tape_backed/missing.root"])
+    order = asyncio.run(release_order([failed]))
+    assert order == [failed]
+    assert failed.files[0].replicas[0].status == Status.NEARLINE
+
+    config.sites.prestage.max_wait = 0.0
+    slow = make_chunk(api_url, ["/pnfs/dune/tape_backed/file2.root"])
+    assert asyncio.run(release_order([slow])) == [slow]
+    assert slow.files[0].replicas[0].status == Status.NEARLINE
+
+    unreachable = make_chunk(api_url + "/bad", ["/pnfs/dune/tape_backed/file1.root"])
+    assert asyncio.run(release_order([unreachable])) == [unreachable]
+
+def test_release_disabled(api_url):
+    """Without prestaging, every chunk is released at once and nothing is staged"""
+    chunks = [make_chunk(api_url, ["/pnfs/dune/tape_backed/file1.root"]) for _ in range(2)]
+    async def batches():
+        return [ready async for ready in Prestager().release(chunks)]
+    assert asyncio.run(batches()) == [chunks]
+    assert not StageHandler.stage_requests
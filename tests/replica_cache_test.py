@@ -0,0 +1,107 @@
+"""Tests for the replica cache module"""
+
+import asyncio
+from dataclasses import dataclass
+import pytest
+from merge_utils import config
+from merge_utils.replicas import Status
+from merge_utils.replica_cache import ReplicaCache
+
+CKSUMS = {"adler32": "489d301a"}
+
+@dataclass
+class StubReplica:
+    """Minimal replica with a status and latency"""
+    status: Status
+    latency: float = 1.5
+
+def test_round_trip(tmp_path):
+    """Verified replicas are returned from a new cache instance"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.ONLINE), "root://host//file1", 100, CKSUMS)
+    cache.put(StubReplica(Status.MISSING), "root://host//file2", 100, CKSUMS)
+    cache.close()
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    assert cache.get("root://host//file1", 100, CKSUMS) == ("ONLINE", 1.5)
+    # Negative results are rechecked every run by default
+    assert cache.get("root://host//file2", 100, CKSUMS) is None
+    # Different expected size or checksum is a different key
+    assert cache.get("root://host//file1", 200, CKSUMS) is None
+    assert cache.get("root://host//file1", 100, {"adler32": "00000000"}) is None
+    cache.close()
+
+def test_deferred(tmp_path):
+    """Replicas with a pending locality check are saved once resolved"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    replica = StubReplica(Status.UNKNOWN)
+    cache.put(replica, "root://host//file1")
+    cache.flush()
+    assert cache.get("root://host//file1") is None
+    replica.status = Status.NEARLINE
+    cache.flush()
+    assert cache.get("root://host//file1") == ("NEARLINE", 1.5)
+    cache.close()
+
+def test_transient(tmp_path):
+    """Inconclusive results are never cached"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.UNREACHABLE), "root://host//file1")
+    cache.close()
+    assert cache.get("root://host//file1") is None
+    cache.close()
+
+def test_expired(tmp_path):
+    """Entries older than the TTL for their status are ignored"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.NEARLINE), "root://host//file1")
+    cache.flush()
+    cache.db.execute("UPDATE replicas SET verified = verified - 7200")
+    assert cache.get("root://host//file1") is None
+    cache.close()
+
+@pytest.fixture(name="ttls")
+def fixture_ttls():
+    """Restore the cache TTLs after a test changes them"""
+    ttls = dict(config.frozen().validation.cache_ttl)
+    yield config.validation.cache_ttl
+    for key, val in ttls.items():
+        config.validation.cache_ttl[key] = val
+
+def test_negative_ttl(tmp_path, ttls):
+    """Negative results are cached if given a TTL"""
+    ttls['default'] = 0.25
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.MISSING), "root://host//file1")
+    cache.flush()
+    assert cache.get("root://host//file1") == ("MISSING", 1.5)
+    cache.db.execute("UPDATE replicas SET verified = verified - 1800")
+    assert cache.get("root://host//file1") is None
+    cache.close()
+
+def test_disabled(tmp_path, ttls):
+    """With every TTL at 0 the database is neither read nor pruned"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.ONLINE), "root://host//file1")
+    cache.close()
+    for key in ttls.keys():
+        ttls[key] = 0.0
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    assert cache.get("root://host//file1") is None
+    assert not cache.enabled
+    for key in ('default', 'ONLINE', 'NEARLINE'):
+        ttls[key] = 12.0
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    assert cache.get("root://host//file1") == ("ONLINE", 1.5)
+    cache.close()
+
+def test_threads(tmp_path):
+    """The cache can be used from worker threads"""
+    cache = ReplicaCache(str(tmp_path / "replicas.sqlite"))
+    cache.put(StubReplica(Status.ONLINE), "root://host//file1")
+    async def run():
+        await asyncio.to_thread(cache.flush)
+        return await asyncio.gather(*(
+            asyncio.to_thread(cache.get, f"root://host//file{i}") for i in range(1, 4)
+        ))
+    assert asyncio.run(run()) == [("ONLINE", 1.5), None, None]
+    cache.close()
@@ -0,0 +1,369 @@
+"""Tests for the replicas module"""
+
+import time
+import zlib
+import asyncio
+import pytest
+from merge_utils import config, replicas, replica_cache, endpoints
+from merge_utils.merge_set import MergeSet, MergeFileError
+from merge_utils.retriever import InputBatch
+from merge_utils.replicas import PrefixTrie, BaseRSE, PathFinder, Replica, Status
+from .merge_set_test import file_dict
+
+FNAL = "US_FNAL-FermiGrid"
+
+def test_prefix_trie():
+    """Test longest-prefix matching"""
+    trie = PrefixTrie({"/pnfs/": 1, "/pnfs/dune/": 2, "/pnfs/dune/tape/": 3})
+    assert trie.match("/pnfs/dune/tape/file.root") == ("/pnfs/dune/tape/", 3)
+    assert trie.match("/pnfs/dune/disk/file.root") == ("/pnfs/dune/", 2)
+    assert trie.match("/pnfs/duneX/file.root") == ("/pnfs/", 1)
+    assert trie.match("/pnfs/dune/") == ("/pnfs/dune/", 2)
+    assert trie.match("/pnfs") is None
+    assert trie.match("/eos/dune/file.root") is None
+    assert trie.match("") is None
+    # Inserting the same prefix replaces the value, and an empty prefix matches anything
+    trie.insert("/pnfs/dune/", 4)
+    trie.insert("", 0)
+    assert trie.match("/pnfs/dune/disk/file.root") == ("/pnfs/dune/", 4)
+    assert trie.match("/eos/dune/file.root") == ("", 0)
+
+@pytest.fixture(name="local_site")
+def fixture_local_site():
+    """Run a test at FNAL, using the default xrootd mappings"""
+    config.local.site = FNAL
+    yield FNAL
+    config.local.site = None
+
+def test_xrootd_to_path(local_site): # pylint: disable=unused-argument
+    """Test converting xrootd URLs to local paths, including the host and port"""
+    path = "/pnfs/dune/file.root"
+    for door in ["fndcadoor", "fndca1"]:
+        url = f"root://{door}.fnal.gov:1094/pnfs/fnal.gov/usr/dune/file.root"
+        assert replicas.xrootd_to_path(url) == path
+        assert replicas.get_host(url) == f"{door}.fnal.gov"
+        assert replicas.get_port(url) == 1094
+        assert replicas.get_path(url) == "/pnfs/fnal.gov/usr/dune/file.root"
+    # Other hosts and ports, or a missing port, are not mapped
+    for url in [
+        "root://fndca1.fnal.gov:1095/pnfs/fnal.gov/usr/dune/file.root",
+        "root://fndca1.fnal.gov:10945/pnfs/fnal.gov/usr/dune/file.root",
+        "root://fndca1.fnal.gov/pnfs/fnal.gov/usr/dune/file.root",
+        "root://fndca1.fnal.gov.evil:1094/pnfs/fnal.gov/usr/dune/file.root",
+    ]:
+        assert replicas.xrootd_to_path(url) is None
+    assert replicas.get_port("root://fndca1.fnal.gov/pnfs/file.root") is None
+    assert replicas.get_host(path) == "local"
+
+def test_path_to_xrootd(local_site): # pylint: disable=unused-argument
+    """Test converting local paths to xrootd URLs, preferring the first listed URL"""
+    assert replicas.path_to_xrootd("/pnfs/dune/file.root") == \
+        "root://fndcadoor.fnal.gov:1094/pnfs/fnal.gov/usr/dune/file.root"
+    assert replicas.path_to_xrootd("/eos/dune/file.root") is None
+
+def test_no_local_site():
+    """Without a local site, nothing is converted"""
+    assert replicas.xrootd_tries() == (None, None)
+    assert replicas.path_to_xrootd("/pnfs/dune/file.root") is None
+    assert replicas.xrootd_to_path(
+        "root://fndca1.fnal.gov:1094/pnfs/fnal.gov/usr/dune/file.root") is None
+
+class FakeRSE(BaseRSE):
+    """RSE that answers replica checks from a fixed table of statuses"""
+
+    def __init__(self, name: str, distance: float, statuses: dict = None):
+        super().__init__()
+        self.name = name
+        self.distance = distance
+        self.urls = {'root': f"root://{name}.host:1094/"}
+        self.statuses = statuses or {}
+        self.checked = []
+        self.monitor = None
+        self.down = False
+
+    async def verify(self, replica: Replica, size: int = None, cksums: dict = None,
+                     timeout: float = 1):
+        self.checked.append(replica.path)
+        if self.monitor:
+            self.monitor()
+        await asyncio.sleep(0.001)
+        if self.down:
+            raise endpoints.EndpointError(f"{self.name} is down")
+        replica.status = self.statuses.get(replica.path, Status.ONLINE)
+
+class FakeMeta:
+    """Metadata source that yields fixed batches of files"""
+
+    def __init__(self, n_files: int, batch_size: int):
+        self.files = MergeSet()
+        self.batches = []
+        for skip in range(0, n_files, batch_size):
+            dicts = [
+                file_dict({'name': f"file{i}", 'fid': str(i),
+                           'metadata': {'dune_mc.gen_fcl_filename': "gen.fcl"}})
+                for i in range(skip, min(n_files, skip + batch_size))
+            ]
+            self.batches.append(InputBatch(skip=skip, files=self.files.add(skip, dicts)))
+
+    async def input_batches(self):
+        """Yield the batches of files"""
+        for batch in self.batches:
+            yield batch
+        yield InputBatch()
+
+    async def connect(self):
+        """Nothing to connect to"""
+
+    async def disconnect(self):
+        """Nothing to disconnect from"""
+
+class FakeFinder(PathFinder):
+    """Finder that places replicas on fake RSEs from a fixed table"""
+    name = "fake_replicas"
+
+    def __init__(self, meta: FakeMeta, rses: list[FakeRSE], paths: dict):
+        super().__init__(meta)
+        self.rses = {rse.name: rse for rse in rses}
+        self.paths = paths
+
+    async def add_replica(self, file, path, rse_name=None):
+        replica = Replica(path=path, rse=self.rses[rse_name])
+        file.replicas.append(replica)
+        await self.check_replica(file, replica, size=file.size, cksums=file.checksums)
+
+    async def get_paths(self, batch):
+        return [{'did': f.did, 'paths': self.paths.get(f.name, [])} for f in batch.files]
+
+    async def set_paths(self, batch, paths):
+        files = {f.did: f for f in batch.files}
+        for entry in paths:
+            file = files[entry['did']]
+            for rse_name, path in entry['paths']:
+                await self.add_replica(file, path, rse_name)
+            await self.start_checks(file)
+
+@pytest.fixture(name="pipeline")
+def fixture_pipeline(tmp_path, monkeypatch):
+    """Isolate the job directory, replica cache and endpoint health for pipeline tests"""
+    monkeypatch.setattr(replica_cache, "cache", replica_cache.ReplicaCache(
+        str(tmp_path / "replicas.sqlite")))
+    monkeypatch.setattr(endpoints, "health", endpoints.HealthMonitor())
+    saved = {key: str(config.validation[key]) for key in ('batch_size', 'max_pending')}
+    job_dir = str(config.job.dir)
+    config.job.dir = str(tmp_path)
+    yield config.validation
+    config.job.dir = job_dir
+    for key, value in saved.items():
+        config.validation[key] = int(value)
+    config.validation.short_circuit.distance = None
+
+def in_flight(finder: PathFinder) -> int:
+    """Count the files holding a pipeline slot, ignoring the end-of-input marker"""
+    # pylint: disable-next=protected-access
+    return len(finder.pending) + sum(1 for file in finder.resolved._queue if file is not None)
+
+def run_finder(finder: PathFinder, delay: float = 0) -> list:
+    """
+    Run a finder to completion, consuming its output batches slowly.
+
+    :param finder: PathFinder to run
+    :param delay: time to wait between output batches in seconds
+    :return: list of (number of files yielded, files in flight while the consumer waited)
+    """
+    async def run():
+        await finder.connect()
+        results = []
+        try:
+            async for batch in finder.input_batches():
+                await asyncio.sleep(delay)
+                results.append((len(batch), in_flight(finder)))
+        finally:
+            await finder.disconnect()
+        return results
+    return asyncio.run(run())
+
+def test_pipeline(pipeline):
+    """Replica checks stay within max_pending, and every file reaches a final state"""
+    pipeline.batch_size = 5
+    pipeline.max_pending = 12
+    rses = [FakeRSE("near", 1.0), FakeRSE("far", 10.0)]
+    paths = {}
+    for i in range(40):
+        paths[f"file{i}"] = [("near", f"root://near.host:1094/file{i}"),
+                             ("far", f"root://far.host:1094/file{i}")]
+    # Some files have no replicas, or only bad ones
+    for i in range(0, 40, 7):
+        paths[f"file{i}"] = []
+    for i in range(3, 40, 7):
+        rses[0].statuses[f"root://near.host:1094/file{i}"] = Status.MISSING
+        rses[1].statuses[f"root://far.host:1094/file{i}"] = Status.BAD_CHECKSUM
+    meta = FakeMeta(40, 5)
+    finder = FakeFinder(meta, rses, paths)
+    # Measure the files in flight whenever a replica is checked
+    checks = []
+    for rse in rses:
+        rse.monitor = lambda: checks.append(in_flight(finder))
+    results = run_finder(finder, delay=0.02)
+    assert max(checks) <= 12
+    # With a slow consumer the producer fills every slot, but no more
+    assert max(n for _, n in results) == 12
+    # Every file is either yielded or marked with an error
+    no_replicas = {f"file{i}" for i in range(0, 40, 7)}
+    unreachable = {f"file{i}" for i in range(3, 40, 7)}
+    assert sum(n for n, _ in results) == 40 - len(no_replicas) - len(unreachable)
+    assert not finder.pending and not finder.candidates
+    for file in meta.files.all_files:
+        if file.name in no_replicas:
+            assert file.errors == MergeFileError.NO_REPLICAS
+        elif file.name in unreachable:
+            assert file.errors == MergeFileError.UNREACHABLE
+        else:
+            assert not file.errors
+            assert {r.status for r in file.replicas} == {Status.ONLINE}
+
+def short_circuit_run(statuses: dict) -> tuple[FakeFinder, list[FakeRSE]]:
+    """
+    Check one file with replicas at three RSEs in short-circuit mode.
+
+    :param statuses: dictionary of {RSE name: status} for the replicas
+    :return: tuple of (finder after the run, list of RSEs)
+    """
+    config.validation.short_circuit.distance = 5.0
+    rses = [FakeRSE(name, dist) for name, dist in [("far", 20.0), ("near", 1.0), ("mid", 4.0)]]
+    rses[0].staging = 100.0
+    paths = {"file0": []}
+    for rse in rses:
+        path = f"root://{rse.name}.host:1094/file0"
+        rse.statuses[path] = statuses[rse.name]
+        paths["file0"].append((rse.name, path))
+    finder = FakeFinder(FakeMeta(1, 1), rses, paths)
+    run_finder(finder)
+    assert not finder.pending and not finder.candidates
+    return finder, rses
+
+def test_short_circuit_hit(pipeline): # pylint: disable=unused-argument
+    """The nearest replica is confirmed, so the others are kept unchecked as fallbacks"""
+    finder, rses = short_circuit_run({"near": Status.ONLINE, "mid": Status.ONLINE,
+                                      "far": Status.ONLINE})
+    assert [len(rse.checked) for rse in rses] == [0, 1, 0]
+    file = finder.files.good_files[0]
+    assert not file.errors
+    replicas = {r.rse.name: r for r in file.replicas}
+    assert replicas["near"].status == Status.ONLINE
+    assert replicas["mid"].status == Status.UNCHECKED
+    assert replicas["mid"].status.good
+    assert replicas["mid"].distance == 4.0
+    # Unchecked replicas on tape RSEs include the staging penalty
+    assert replicas["far"].distance == 120.0
+    assert [r.rse.name for r in sorted(file.replicas)] == ["near", "mid", "far"]
+
+def test_short_circuit_miss(pipeline, tmp_path, monkeypatch): # pylint: disable=unused-argument
+    """Replicas are checked nearest first until one is close enough"""
+    finder, rses = short_circuit_run({"near": Status.MISSING, "mid": Status.NEARLINE,
+                                      "far": Status.ONLINE})
+    # A nearline replica does not end the search by default
+    assert [len(rse.checked) for rse in rses] == [1, 1, 1]
+    file = finder.files.good_files[0]
+    assert {r.rse.name: r.status for r in file.replicas} == {
+        "near": Status.MISSING, "mid": Status.NEARLINE, "far": Status.ONLINE
+    }
+    # With the status threshold relaxed, the nearline replica is good enough
+    monkeypatch.setattr(replica_cache, "cache", replica_cache.ReplicaCache(
+        str(tmp_path / "fresh.sqlite")))
+    config.validation.short_circuit.status = 'NEARLINE'
+    try:
+        finder, rses = short_circuit_run({"near": Status.MISSING, "mid": Status.NEARLINE,
+                                          "far": Status.ONLINE})
+    finally:
+        config.validation.short_circuit.status = None
+    assert [len(rse.checked) for rse in rses] == [0, 1, 1]
+    assert {r.rse.name: r.status for r in finder.files.good_files[0].replicas} == {
+        "near": Status.MISSING, "mid": Status.NEARLINE, "far": Status.UNCHECKED
+    }
+
+def test_short_circuit_all_bad(pipeline): # pylint: disable=unused-argument
+    """A file is only unreachable once every candidate has been checked"""
+    finder, rses = short_circuit_run({"near": Status.MISSING, "mid": Status.BAD_SIZE,
+                                      "far": Status.OFFLINE})
+    assert [len(rse.checked) for rse in rses] == [1, 1, 1]
+    assert not finder.files.good_files
+    file = next(iter(finder.files.all_files))
+    assert file.errors == MergeFileError.UNREACHABLE
+    assert all(r.status != Status.UNCHECKED for r in file.replicas)
+
+@pytest.fixture(name="breaker")
+def fixture_breaker(pipeline):
+    """Short cooldown and probe settings for circuit breaker tests"""
+    health = config.validation.health
+    saved = {key: float(health[key]) for key in ('cooldown', 'timeout')}
+    probes = int(health.probes)
+    health.cooldown = 0.2
+    health.timeout = 0.02
+    health.probes = 1
+    yield pipeline
+    for key, value in saved.items():
+        health[key] = value
+    health.probes = probes
+
+def open_circuit(rse: FakeRSE) -> None:
+    """Open the circuit breaker for a fake RSE's endpoint"""
+    key = (rse.name, f"{rse.name}.host")
+    health = endpoints.health.get(endpoints.health.endpoints, key)
+    health.state = endpoints.OPEN
+    health.opened = time.monotonic()
+
+def test_deferred_retry(breaker): # pylint: disable=unused-argument
+    """Replicas on an open circuit are retried once it half-opens, unless not needed"""
+    rses = [FakeRSE("flaky", 1.0), FakeRSE("good", 5.0)]
+    paths = {
+        "file0": [("flaky", "root://flaky.host:1094/file0")],
+        "file1": [("flaky", "root://flaky.host:1094/file1"),
+                  ("good", "root://good.host:1094/file1")],
+        "file2": [("good", "root://good.host:1094/file2")],
+    }
+    rses[1].statuses["root://good.host:1094/file2"] = Status.MISSING
+    open_circuit(rses[0])
+    finder = FakeFinder(FakeMeta(3, 3), rses, paths)
+    run_finder(finder)
+    assert not finder.pending and not finder.held and not finder.retries
+    files = {f.name: f for f in finder.files.all_files}
+    # The only replica of file0 was checked after the cooldown instead of failing
+    assert rses[0].checked == ["root://flaky.host:1094/file0"]
+    assert not files["file0"].errors
+    assert files["file0"].replicas[0].status == Status.ONLINE
+    # file1 did not wait for its deferred replica
+    assert not files["file1"].errors
+    assert {r.rse.name: r.status for r in files["file1"].replicas} == {
+        "flaky": Status.UNREACHABLE, "good": Status.ONLINE
+    }
+    assert files["file2"].errors == MergeFileError.UNREACHABLE
+    # The probe closed the circuit, and missing files do not count against an endpoint
+    assert endpoints.health.state(("flaky", "flaky.host")) == endpoints.CLOSED
+    assert endpoints.health.endpoints[("good", "good.host")].failures == 0
+
+def test_deferred_failure(breaker): # pylint: disable=unused-argument
+    """Deferred replicas are unreachable once the endpoint fails its re-test"""
+    rse = FakeRSE("flaky", 1.0)
+    rse.down = True
+    paths = {f"file{i}": [("flaky", f"root://flaky.host:1094/file{i}")] for i in range(3)}
+    open_circuit(rse)
+    finder = FakeFinder(FakeMeta(3, 3), [rse], paths)
+    run_finder(finder)
+    assert not finder.pending and not finder.held and not finder.retries
+    # Only the probe contacted the storage
+    assert len(rse.checked) == 1
+    for file in finder.files.all_files:
+        assert file.errors == MergeFileError.UNREACHABLE
+        assert file.replicas[0].status == Status.UNREACHABLE
+    assert endpoints.health.state(("flaky", "flaky.host")) == endpoints.OPEN
+
+def test_checksum_local(tmp_path):
+    """A local file is accepted if any of its checksums match"""
+    path = tmp_path / "data.bin"
+    path.write_bytes(b"merge-utils")
+    rse = FakeRSE("local", 0.0)
+    good = {'adler32': f"{zlib.adler32(b'merge-utils'):08x}", 'md5': "0" * 32}
+    assert asyncio.run(rse.checksum_local(str(path), good))
+    bad = {'adler32': "00000000", 'md5': "0" * 32}
+    assert not asyncio.run(rse.checksum_local(str(path), bad))
+    assert not asyncio.run(rse.checksum_local(str(path), {'bogus': "1234"}))
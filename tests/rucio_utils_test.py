@@ -0,0 +1,138 @@
+"""Tests for the rucio utils module"""
+
+import time
+import asyncio
+import threading
+from collections import namedtuple
+from merge_utils import config
+from merge_utils.rucio_utils import RucioWrapper, RSECatalog
+
+File = namedtuple("File", ["namespace", "name"])
+
+class StubClient:
+    """Stand-in for the Rucio client, which records the requests it is sent"""
+
+    def __init__(self, delay: float = 0, parties: int = 0):
+        """
+        Initialize the stub.
+
+        :param delay: time to wait in each request, as if talking to a remote server
+        :param parties: if set, hold each list_replicas request until this many are in flight
+        """
+        self.delay = delay
+        self.barrier = threading.Barrier(parties, timeout=10) if parties else None
+        self.calls = []
+        self.rules = []
+        self.active = 0
+        self.max_active = 0
+        self.lock = threading.Lock()
+
+    def request(self, method: str, *args):
+        """Record a request and wait as if talking to a remote server"""
+        with self.lock:
+            self.calls.append((method, args))
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+        if self.barrier and method == 'list_replicas':
+            self.barrier.wait()
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+
+    def list_replicas(self, dids, ignore_availability=True): # pylint: disable=unused-argument
+        """Return one replica per file, as a generator like the real client"""
+        self.request('list_replicas', len(dids))
+        for did in dids:
+            yield {
+                'scope': did['scope'], 'name': did['name'], 'bytes': 1,
+                'pfns': {f"root://host:1094/{did['name']}": {'rse': 'TEST_RSE'}}
+            }
+
+    def add_replication_rule(self, dids, copies, rse, lifetime=None, comment=None): # pylint: disable=unused-argument
+        """Record a replication rule"""
+        self.request('add_replication_rule', len(dids), copies, rse, lifetime)
+        self.rules.append(lifetime)
+        return [f"rule{len(self.rules)}"]
+
+    def list_rses(self):
+        """List two RSEs, one of which is deleted"""
+        self.request('list_rses')
+        return [{'rse': 'TEST_RSE', 'deleted': False}, {'rse': 'OLD_RSE', 'deleted': True}]
+
+    def get_rse(self, name):
+        """Get RSE details"""
+        self.request('get_rse', name)
+        return {'rse': name, 'rse_type': 'DISK', 'protocols': []}
+
+    def list_rse_attributes(self, name):
+        """Get RSE attributes"""
+        self.request('list_rse_attributes', name)
+        return {'site': 'TEST_SITE'}
+
+def make_wrapper(tmp_path, client: StubClient) -> RucioWrapper:
+    """Create a RucioWrapper connected to a stub client"""
+    wrapper = RucioWrapper()
+    wrapper.client = client
+    wrapper.catalog = RSECatalog(str(tmp_path / "rucio_rses.json"))
+    return wrapper
+
+def stream(wrapper: RucioWrapper, files: list) -> list:
+    """Collect the chunks of replicas streamed for a list of files"""
+    async def run():
+        return [chunk async for chunk in wrapper.stream_replicas(files)]
+    return asyncio.run(run())
+
+def test_stream_replicas(tmp_path):
+    """Chunks of a batch are queried concurrently"""
+    # Every request waits until all four chunks are in flight, so a serial
+    # implementation fails with a broken barrier instead of running slowly
+    client = StubClient(parties=4)
+    wrapper = make_wrapper(tmp_path, client)
+    files = [File("test", f"file{i}.root") for i in range(100)]
+    chunks = stream(wrapper, files)
+    assert client.calls == [('list_replicas', (25,))] * 4
+    assert client.max_active == 4
+    # Each chunk holds a consecutive slice of the batch
+    assert {tuple(r['name'] for r in chunk) for chunk in chunks} == {
+        tuple(f.name for f in files[i:i+25]) for i in range(0, 100, 25)
+    }
+
+def test_stream_limit(tmp_path):
+    """No more than validation.concurrency requests are in flight at once"""
+    concurrency = int(config.validation.concurrency)
+    config.validation.concurrency = 2
+    try:
+        client = StubClient(delay=0.01)
+        wrapper = make_wrapper(tmp_path, client)
+        chunks = stream(wrapper, [File("test", f"file{i}.root") for i in range(100)])
+    finally:
+        config.validation.concurrency = concurrency
+    assert len(chunks) == 4
+    assert client.max_active <= 2
+
+def test_add_rule(tmp_path):
+    """Rule lifetimes are passed to Rucio as whole seconds"""
+    client = StubClient()
+    wrapper = make_wrapper(tmp_path, client)
+    dids = ["test:file0.root", "test:file1.root"]
+    assert asyncio.run(wrapper.add_rule(dids, "TEST_RSE", 2.5 * 86400)) == ["rule1"]
+    assert asyncio.run(wrapper.add_rule(dids, "TEST_RSE")) == ["rule2"]
+    assert client.rules == [216000, None]
+    assert isinstance(client.rules[0], int)
+
+def test_rse_catalog(tmp_path):
+    """RSE information is fetched once and reused from the persisted catalog"""
+    client = StubClient()
+    wrapper = make_wrapper(tmp_path, client)
+    async def run(wrapper):
+        return [rse async for rse in wrapper.get_rses()]
+    rses = asyncio.run(run(wrapper))
+    assert [rse['rse'] for rse in rses] == ['TEST_RSE']
+    assert rses[0]['attrs'] == {'site': 'TEST_SITE'}
+    assert rses[0]['rse_type'] == 'DISK'
+    # A new wrapper should not need to contact Rucio at all
+    client = StubClient()
+    wrapper = make_wrapper(tmp_path, client)
+    assert asyncio.run(run(wrapper)) == rses
+    assert asyncio.run(wrapper.get_rse('TEST_RSE')) == rses[0]
+    assert not client.calls
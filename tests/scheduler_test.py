@@ -0,0 +1,308 @@
+"""Tests for the scheduler module"""
+
+import json
+import asyncio
+from types import SimpleNamespace
+import pytest
+from merge_utils import config, prestage
+from merge_utils.merge_set import MergeChunk
+from merge_utils.scheduler import LocalScheduler, JustinScheduler
+from merge_utils.distance_matrix import DistanceMatrix
+from merge_utils.replicas import Replica, RucioRSE, Status
+
+GB = 1024**3
+
+def make_files(sizes):
+    """Make input files with the given sizes in GB"""
+    return [SimpleNamespace(size=int(size * GB), good=True) for size in sizes]
+
+def placeholder_specs(chunk):
+    """Merge specs that only list the output names, with two output streams"""
+    n_specs = 2 if chunk.children else 1
+    return [{'outputs': [{'name': f"{chunk.chunk_id}_{n}"}]} for n in range(n_specs)]
+
+@pytest.fixture(name="fan_in")
+def fixture_fan_in():
+    """Limit pass 2+ merges to 4 inputs"""
+    fan_in = config.method.chunks.fan_in.value
+    config.method.chunks.fan_in = 4
+    yield 4
+    config.method.chunks.fan_in = fan_in
+
+def make_tree(n_children):
+    """Make a chunk with one pass 1 child per file"""
+    chunk = MergeChunk(files=make_files([0.1] * n_children))
+    for file in chunk.files:
+        chunk.make_child([file])
+    return chunk
+
+def test_split_by_count():
+    """Small files are split into balanced groups by count"""
+    sched = LocalScheduler(SimpleNamespace())
+    groups = sched.split_files(make_files([0.01] * 250))
+    assert [len(group) for group in groups] == [83, 84, 83]
+
+def test_split_by_size():
+    """Large files are split into groups within the size limit"""
+    sched = LocalScheduler(SimpleNamespace())
+    files = make_files([2.0] * 30 + [0.1] * 60)
+    groups = sched.split_files(files)
+    assert sum(groups, []) == files
+    totals = [sum(f.size for f in group) / GB for group in groups]
+    assert len(groups) == 4
+    assert max(totals) <= 20.0
+    assert max(totals) - min(totals) < 4.0
+    # Files without a size count as the average size
+    files[0].size = None
+    assert len(sched.split_files(files)) == 4
+
+def test_split_oversized():
+    """Files larger than the size limit get their own groups"""
+    sched = LocalScheduler(SimpleNamespace())
+    files = make_files([30.0, 1.0, 30.0])
+    assert sched.split_files(files) == [[f] for f in files]
+    # The other files are still grouped normally
+    files = make_files([30.0] + [0.01] * 200)
+    groups = sched.split_files(files)
+    assert sum(groups, []) == files
+    assert groups[0] == files[:1]
+    assert [len(group) for group in groups[1:]] == [100, 100]
+    files = make_files([0.01] * 150 + [30.0] + [0.01] * 50 + [30.0])
+    groups = sched.split_files(files)
+    assert [len(group) for group in groups] == [75, 75, 1, 50, 1]
+
+def test_split_uneven():
+    """Uneven sizes that defeat a balanced split still give the fewest groups"""
+    sched = LocalScheduler(SimpleNamespace())
+    files = make_files([9.0, 9.0, 9.0, 2.0, 2.0, 2.0, 2.0, 2.0, 2.0])
+    groups = sched.split_files(files)
+    assert sum(groups, []) == files
+    assert len(groups) == 3
+    assert all(sched.fits(group) for group in groups)
+
+def test_split_prefix_sums(monkeypatch):
+    """Packing checks groups against running totals instead of re-evaluating the disk usage"""
+    sched = LocalScheduler(SimpleNamespace())
+    files = make_files([9.0, 9.0, 9.0, 2.0, 2.0, 2.0, 2.0, 2.0, 2.0] * 20)
+    calls = []
+    disk_usage, pack = sched.disk_usage, sched.pack
+    monkeypatch.setattr(sched, "disk_usage", lambda sizes: calls.append(sizes) or disk_usage(sizes))
+    monkeypatch.setattr(sched, "pack", lambda prefix: calls.append(None) or pack(prefix))
+    groups = sched.split_files(files)
+    # Only the whole input and each file on its own are evaluated
+    assert None in calls
+    assert all(sizes is None or len(sizes) in (1, len(files)) for sizes in calls)
+    assert sum(groups, []) == files
+    assert all(sched.fits(group) for group in groups)
+
+def test_plan_tree(fan_in):
+    """Intermediate tiers are added until every merge is within the fan-in limit"""
+    sched = LocalScheduler(SimpleNamespace())
+    chunk = make_tree(25)
+    leaves = list(chunk.children)
+    sched.plan_tree(chunk)
+    assert chunk.tier == 3
+    assert [len(child.children) for child in chunk.children] == [3, 4]
+    nodes = [chunk]
+    while nodes[0].children:
+        assert all(len(node.children) <= fan_in for node in nodes)
+        assert all(child.parent is node for node in nodes for child in node.children)
+        nodes = [child for node in nodes for child in node.children]
+    assert nodes == leaves
+    assert chunk.children[0].files == sum((leaf.files for leaf in leaves[:10]), [])
+    # Chunks within the limit are left alone
+    chunk = make_tree(fan_in)
+    sched.plan_tree(chunk)
+    assert chunk.tier == 1
+
+def test_plan_tree_single_child(fan_in): # pylint: disable=unused-argument
+    """Children left alone in a group are merged directly instead of by an extra job"""
+    sched = LocalScheduler(SimpleNamespace())
+    config.method.chunks.fan_in = 2
+    chunk = make_tree(5)
+    leaves = list(chunk.children)
+    sched.plan_tree(chunk)
+    assert chunk.leaves == leaves
+    assert chunk.children[0] is leaves[0]
+    assert chunk.tier == 3
+    nodes = [chunk]
+    while nodes:
+        assert all(len(node.children) in (0, 2) for node in nodes)
+        assert all(child.parent is node for node in nodes for child in node.children)
+        nodes = [child for node in nodes for child in node.children]
+
+def test_plan_tree_size(fan_in):
+    """Intermediate merges are also kept within the size limit"""
+    sched = LocalScheduler(SimpleNamespace())
+    chunk = MergeChunk(files=make_files([6.0] * 8))
+    for file in chunk.files:
+        chunk.make_child([file])
+    sched.plan_tree(chunk)
+    assert [len(child.children) for child in chunk.children] == [2, 3, 3]
+    assert all(sched.fits(child.files) for child in chunk.children)
+    # Chunks that are too large to merge in pairs are only limited by fan_in
+    chunk = MergeChunk(files=make_files([12.0] * 8))
+    for file in chunk.files:
+        chunk.make_child([file])
+    sched.plan_tree(chunk)
+    assert [len(child.children) for child in chunk.children] == [fan_in, fan_in]
+
+def test_plan_dependencies(fan_in, tmp_path, monkeypatch): # pylint: disable=unused-argument
+    """Each spec in the plan depends on the specs that produce its inputs"""
+    monkeypatch.setattr(MergeChunk, "specs", property(placeholder_specs))
+    sched = LocalScheduler(SimpleNamespace())
+    sched.dir = str(tmp_path)
+    chunk = make_tree(6)
+    sched.plan_tree(chunk)
+    sched.write_specs(chunk)
+    with open(sched.write_plan(), encoding="utf-8") as fjson:
+        plan = json.load(fjson)
+    assert plan['passes'] == 3
+    jobs = {job['spec']: job for job in plan['jobs']}
+    assert len(jobs) == 6 + 2*2 + 2
+    assert jobs['pass3_000001.json']['needs'] == ['pass2_000001.json', 'pass2_000003.json']
+    assert jobs['pass3_000002.json']['needs'] == ['pass2_000002.json', 'pass2_000004.json']
+    assert jobs['pass2_000001.json']['needs'] == [f"pass1_{n:06}.json" for n in (1, 2, 3)]
+    assert jobs['pass2_000004.json']['needs'] == [f"pass1_{n:06}.json" for n in (4, 5, 6)]
+    assert all(not jobs[f"pass1_{n:06}.json"]['needs'] for n in range(1, 7))
+
+def test_release_per_chunk(fan_in, tmp_path, monkeypatch): # pylint: disable=unused-argument
+    """Pass 1 chunks are written as they are staged, and later passes once their inputs are"""
+    monkeypatch.setattr(MergeChunk, "specs", property(placeholder_specs))
+    sched = LocalScheduler(SimpleNamespace())
+    sched.dir = str(tmp_path)
+    chunk = make_tree(6)
+    sched.plan_tree(chunk)
+    plans = []
+    class SlowPrestager:
+        """Holds back the first pass 1 chunk until the others have been written"""
+        async def release(self, chunks):
+            """Release all but the first chunk, then the first chunk"""
+            assert chunks == chunk.leaves
+            yield chunks[1:]
+            with open(tmp_path / "plan.json", encoding="utf-8") as fjson:
+                plans.append(json.load(fjson))
+            yield chunks[:1]
+    monkeypatch.setattr(prestage, "Prestager", SlowPrestager)
+    asyncio.run(sched.release([chunk]))
+    # Only the second pass 2 merge has all of its inputs after the first release
+    assert plans[0]['passes'] == 2
+    assert sorted(job['pass'] for job in plans[0]['jobs']) == [1]*5 + [2]*2
+    assert plans[0]['jobs'][-1]['needs'] == [f"pass1_{n:06}.json" for n in (3, 4, 5)]
+    with open(tmp_path / "plan.json", encoding="utf-8") as fjson:
+        plan = json.load(fjson)
+    assert plan['passes'] == 3
+    assert len(plan['jobs']) == 6 + 2*2 + 2
+    assert plan['jobs'][-2]['needs'] == ['pass2_000003.json', 'pass2_000001.json']
+    assert plan['jobs'][-1]['needs'] == ['pass2_000004.json', 'pass2_000002.json']
+
+class FakeRucio:
+    """Stand-in for the RucioWrapper that records the rules it is asked to create"""
+
+    def __init__(self):
+        self.rules = []
+
+    async def connect(self):
+        """Nothing to connect to"""
+
+    async def get_pfns(self, rse, dids):
+        """Make up the paths that files would have on an RSE"""
+        return {did: f"root://{rse}//{did}" for did in dids}
+
+    async def add_rule(self, dids, rse, lifetime=None):
+        """Record a rule"""
+        self.rules.append((dids, rse, lifetime))
+        return [f"rule{len(self.rules)}"]
+
+@pytest.fixture(name="consolidate")
+def fixture_consolidate():
+    """Set the consolidation mode"""
+    mode = str(config.sites.consolidate.mode)
+    yield config.sites.consolidate
+    config.sites.consolidate.mode = mode
+
+def make_scheduler(n_files, tmp_path):
+    """Make a JustIN scheduler for files at two RSEs close to different sites"""
+    rses = {
+        name: RucioRSE({'rse': name, 'availability_read': True, 'availability_write': True,
+                        'rse_type': 'DISK', 'protocols': []})
+        for name in ["RSE_A", "RSE_B"]
+    }
+    files = []
+    for name, count in zip(rses, n_files):
+        for n in range(count):
+            did = f"ns:{name}_{n}"
+            replica = Replica(f"root://{name}//{did}", rses[name], Status.ONLINE, 0.0)
+            files.append(SimpleNamespace(did=did, size=GB, good=True, replicas=[replica]))
+    sched = JustinScheduler(SimpleNamespace(rses=rses, client=FakeRucio()))
+    sched.dir = str(tmp_path)
+    sched.distances = {"RSE_A": {"SITE_1": 1.0}, "RSE_B": {"SITE_2": 2.0}}
+    sched.matrix = DistanceMatrix(files, sched.distances)
+    return sched, MergeChunk(files=files)
+
+def test_consolidate(consolidate, tmp_path):
+    """Fragmented chunks are replicated to one RSE if that costs less than splitting them"""
+    consolidate.mode = 'rules'
+    sched, chunk = make_scheduler([6, 2], tmp_path)
+    sched.schedule(chunk)
+    assert chunk.site == "SITE_1"
+    assert not chunk.children
+    rules = asyncio.run(sched.consolidate())
+    assert [rule['dids'] for rule in rules] == [["ns:RSE_B_0", "ns:RSE_B_1"]]
+    assert rules[0]['rule_ids'] == ["rule1"]
+    assert sched.source.client.rules == [(rules[0]['dids'], "RSE_A", 30 * 86400)]
+    assert [f.replicas[0].path for f in chunk.files[-2:]] == [
+        "root://RSE_A//ns:RSE_B_0", "root://RSE_A//ns:RSE_B_1"
+    ]
+    with open(tmp_path / "rules.json", encoding="utf-8") as fjson:
+        assert json.load(fjson) == rules
+    # Copying more files costs more than merging at both sites
+    sched, chunk = make_scheduler([6, 3], tmp_path)
+    sched.schedule(chunk)
+    assert [child.site for child in chunk.children] == ["SITE_1", "SITE_2"]
+    assert not sched.consolidations
+    # Rules are only planned in plan mode, and nothing is consolidated when disabled
+    consolidate.mode = 'plan'
+    sched, chunk = make_scheduler([6, 2], tmp_path)
+    sched.schedule(chunk)
+    assert 'rule_ids' not in asyncio.run(sched.consolidate())[0]
+    assert not sched.source.client.rules
+    consolidate.mode = 'off'
+    sched, chunk = make_scheduler([6, 2], tmp_path)
+    sched.schedule(chunk)
+    assert len(chunk.children) == 2
+
+def test_consolidate_missing_pfns(consolidate, tmp_path):
+    """Consolidation fails before creating any rules if Rucio has no path for a file"""
+    consolidate.mode = 'rules'
+    sched, chunk = make_scheduler([6, 2], tmp_path)
+    sched.schedule(chunk)
+    client = sched.source.client
+    async def get_pfns(rse, dids):
+        return {did: f"root://{rse}//{did}" for did in dids[1:]}
+    client.get_pfns = get_pfns
+    with pytest.raises(SystemExit):
+        asyncio.run(sched.consolidate())
+    assert not client.rules
+    assert [f.replicas[0].rse.name for f in chunk.files] == ["RSE_A"] * 6 + ["RSE_B"] * 2
+
+def test_consolidate_capacity(consolidate, tmp_path):
+    """Chunks are only consolidated at sites with room for all of their files"""
+    consolidate.mode = 'plan'
+    assignment = str(config.sites.assignment)
+    config.sites.assignment = 'flow'
+    try:
+        sched, chunk = make_scheduler([6, 2], tmp_path)
+        sched.capacity = {"SITE_1": 7}
+        sched.schedule(chunk)
+        assert not sched.consolidations
+        assert [child.site for child in chunk.children] == ["SITE_1", "SITE_2"]
+        assert sched.capacity == {"SITE_1": 1}
+        # With enough room the chunk is consolidated as usual
+        sched, chunk = make_scheduler([6, 2], tmp_path)
+        sched.capacity = {"SITE_1": 8}
+        sched.schedule(chunk)
+        assert [(c.site, rse.name) for c, rse in sched.consolidations] == [("SITE_1", "RSE_A")]
+        assert sched.capacity == {"SITE_1": 0}
+    finally:
+        config.sites.assignment = assignment
@@ -0,0 +1,71 @@
+"""Tests for the tape utils module"""
+
+import json
+import asyncio
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import pytest
+from merge_utils import tape_utils
+
+LOCALITIES = {
+    "/pnfs/dune/tape_backed/file1.root": "DISK_AND_TAPE",
+    "/pnfs/dune/tape_backed/file2.root": "TAPE",
+    "/pnfs/dune/persistent/file3.root": "DISK",
+}
+
+class TapeAPIHandler(BaseHTTPRequestHandler):
+    """Minimal stand-in for the archiveinfo endpoint of a WLCG tape REST API"""
+    requests = []
+
+    def do_POST(self): # pylint: disable=invalid-name
+        """Handle POST requests"""
+        if self.path != "/api/v1/tape/archiveinfo":
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        TapeAPIHandler.requests.append(body['paths'])
+        res = []
+        for path in body['paths']:
+            if path in LOCALITIES:
+                res.append({'path': path, 'locality': LOCALITIES[path]})
+            else:
+                res.append({'path': path, 'error': "No such file or directory"})
+        data = json.dumps(res).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args): # pylint: disable=redefined-builtin
+        """Silence request logging"""
+
+@pytest.fixture(name="api_url")
+def fixture_api_url():
+    """Run a local tape REST API stand-in and return its base URL"""
+    TapeAPIHandler.requests = []
+    server = ThreadingHTTPServer(('127.0.0.1', 0), TapeAPIHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_port}/api/v1/tape"
+    server.shutdown()
+    server.server_close()
+
+def test_archive_info(api_url):
+    """Test a bulk locality query"""
+    paths = list(LOCALITIES) + ["/pnfs/dune/missing.root"]
+    res = asyncio.run(tape_utils.archive_info(api_url, paths))
+    assert res == {**LOCALITIES, "/pnfs/dune/missing.root": None}
+    assert len(TapeAPIHandler.requests) == 1
+
+def test_archive_info_chunks(api_url, monkeypatch):
+    """Test that large queries are split into several requests"""
+    monkeypatch.setattr(tape_utils, "MAX_PATHS", 2)
+    res = asyncio.run(tape_utils.archive_info(api_url, list(LOCALITIES)))
+    assert res == LOCALITIES
+    assert sorted(len(r) for r in TapeAPIHandler.requests) == [1, 2]
+
+def test_archive_info_error(api_url):
+    """Test that failed requests raise a TapeAPIError"""
+    with pytest.raises(tape_utils.TapeAPIError):
+        asyncio.run(tape_utils.archive_info(api_url + "/bad", list(LOCALITIES)))
@@ -0,0 +1,119 @@
+"""Tests for the xrootd utils module"""
+
+import asyncio
+import threading
+import concurrent.futures
+from types import SimpleNamespace
+import pytest
+from merge_utils import xrootd_utils
+
+FILES = {
+    "/pnfs/dune/file1.root": (1234, 16 | 32, b"adler32 489d301a\x00"),
+    "/pnfs/dune/file2.root": (5678, 0, b"adler32 deadbeef\x00"),
+}
+
+class StubFileSystem:
+    """Stand-in for XRootD.client.FileSystem, serving a fixed set of files"""
+    opened = []
+
+    def __init__(self, url):
+        self.url = url
+        StubFileSystem.opened.append(url)
+
+    @staticmethod
+    def status(ok=True, errno=0):
+        """Create a status object"""
+        return SimpleNamespace(ok=ok, errno=errno, message="[ERROR] stub error")
+
+    def respond(self, callback, status, response):
+        """Answer a request from another thread, like the XRootD client does"""
+        threading.Timer(0.01, callback, (status, response, None)).start()
+        return self.status()
+
+    def stat(self, path, timeout=0, callback=None):
+        """Stat a file"""
+        assert timeout > 0
+        if path == "/pnfs/dune/down.root":
+            return self.respond(callback, self.status(False), None)
+        if path not in FILES:
+            return self.respond(callback, self.status(False, xrootd_utils.ERRNO_NOT_FOUND), None)
+        size, flags, _ = FILES[path]
+        return self.respond(callback, self.status(), SimpleNamespace(size=size, flags=flags))
+
+    def query(self, code, path, timeout=0, callback=None):
+        """Query a checksum"""
+        assert code == xrootd_utils.QUERY_CHECKSUM
+        if path == "/pnfs/dune/busy.root":
+            return self.respond(callback, self.status(False, 3012), None)
+        if path == "/pnfs/dune/lost.root":
+            # Accept the request but never answer it
+            return self.status()
+        if path not in FILES:
+            return self.respond(callback, self.status(False, xrootd_utils.ERRNO_NOT_FOUND), None)
+        return self.respond(callback, self.status(), FILES[path][2])
+
+@pytest.fixture(name="pool")
+def fixture_pool():
+    """Session pool backed by the stub file system"""
+    StubFileSystem.opened = []
+    return xrootd_utils.SessionPool(factory=StubFileSystem)
+
+def test_sessions_reused(pool):
+    """Test that each server gets a single persistent session"""
+    server = "root://fndca1.fnal.gov:1094"
+    for path in FILES:
+        asyncio.run(pool.stat(server, path))
+    asyncio.run(pool.stat("root://other.host:1094", "/pnfs/dune/file1.root"))
+    assert StubFileSystem.opened == [server, "root://other.host:1094"]
+    pool.close()
+    asyncio.run(pool.stat(server, "/pnfs/dune/file1.root"))
+    assert len(StubFileSystem.opened) == 3
+
+def test_stat(pool):
+    """Test file stat results"""
+    info = asyncio.run(pool.stat("root://host:1094", "/pnfs/dune/file1.root", timeout=0.5))
+    assert info == xrootd_utils.StatInfo(size=1234, readable=True)
+    info = asyncio.run(pool.stat("root://host:1094", "/pnfs/dune/file2.root"))
+    assert info == xrootd_utils.StatInfo(size=5678, readable=False)
+
+def test_checksum(pool):
+    """Test checksum queries"""
+    cksum = asyncio.run(pool.checksum("root://host:1094", "/pnfs/dune/file1.root"))
+    assert cksum == "adler32 489d301a"
+
+def test_errors(pool):
+    """Test error handling for missing files and other failures"""
+    with pytest.raises(xrootd_utils.XRootDError) as err:
+        asyncio.run(pool.stat("root://host:1094", "/pnfs/dune/missing.root"))
+    assert err.value.missing
+    assert not err.value.transport
+    with pytest.raises(xrootd_utils.XRootDError) as err:
+        asyncio.run(pool.checksum("root://host:1094", "/pnfs/dune/busy.root"))
+    assert not err.value.missing
+    assert not err.value.transport
+    # Client-side failures without a server errno mean the server did not respond
+    with pytest.raises(xrootd_utils.XRootDError) as err:
+        asyncio.run(pool.stat("root://host:1094", "/pnfs/dune/down.root"))
+    assert err.value.transport
+
+class NoExecutor(concurrent.futures.ThreadPoolExecutor):
+    """Executor that refuses to run anything"""
+
+    def submit(self, fn, /, *args, **kwargs):
+        raise AssertionError("xRootD operations should not need an executor thread")
+
+def test_no_threads(pool):
+    """Concurrent operations do not hold a thread from the default executor"""
+    async def run():
+        asyncio.get_running_loop().set_default_executor(NoExecutor())
+        return await asyncio.gather(*[
+            pool.checksum(f"root://host{n}:1094", "/pnfs/dune/file1.root") for n in range(20)
+        ])
+    assert asyncio.run(run()) == ["adler32 489d301a"] * 20
+
+def test_lost_callback(pool, monkeypatch):
+    """A request whose answer never arrives fails like a client-side timeout"""
+    monkeypatch.setattr(xrootd_utils, "CALLBACK_GRACE", 0.0)
+    with pytest.raises(xrootd_utils.XRootDError) as err:
+        asyncio.run(pool.checksum("root://host:1094", "/pnfs/dune/lost.root", timeout=0.01))
+    assert err.value.transport